@@ -0,0 +1,49 @@
+"""体質タイプ別アドバイスの事前レンダリング
+
+HEALTH_ADVICE から、結果画面に表示するアドバイスを
+セクションごとに1つの Markdown 文字列へ変換しておく。起動時に一度だけ作成し、
+結果画面ではセクションごとに1要素（st.info / st.markdown）を出力するだけで済む。
+"""
+from collections import namedtuple
+from itertools import zip_longest
+from types import MappingProxyType
+
+from tcm_data import HEALTH_ADVICE
+
+
+# 結果画面の1セクション（kind は "info" または "markdown"）
+AdviceSection = namedtuple("AdviceSection", ["kind", "body"])
+
+
+def _bullets(items, mark="•"):
+    return "\n".join(f"{mark} {item}  " for item in items)
+
+
+def render_advice(constitution):
+    """体質タイプのアドバイスをセクションのタプルに変換"""
+    advice = HEALTH_ADVICE[constitution]
+
+    # 体質の説明
+    about = f"**💡 あなたの体質について**\n\n{advice['description']}"
+
+    # 食事のアドバイス（おすすめ食材と控えめにする食材を2列の表で表示）
+    food_rows = "\n".join(
+        f"| {f'✅ {good}' if good else ''} | {f'❌ {bad}' if bad else ''} |"
+        for good, bad in zip_longest(advice['recommended_foods'], advice['foods_to_avoid'])
+    )
+
+    return (
+        AdviceSection("info", about),
+        AdviceSection("markdown", f"### 🌸 今日の養生アドバイス\n\n{_bullets(advice['daily_tips'])}"),
+        AdviceSection(
+            "markdown",
+            f"### 🍽️ 食事のアドバイス\n\n| おすすめ食材 | 控えめにする食材 |\n| --- | --- |\n{food_rows}"
+        ),
+        AdviceSection("markdown", f"### 🏃‍♀️ 生活習慣のアドバイス\n\n{_bullets(advice['lifestyle_tips'])}"),
+    )
+
+
+# 全体質タイプ分を起動時に作成（読み取り専用）
+ADVICE_SECTIONS = MappingProxyType({
+    constitution: render_advice(constitution) for constitution in HEALTH_ADVICE
+})
@@ -1,10 +1,14 @@
 import streamlit as st
-import pandas as pd
 import datetime
+import functools
 import os
-from tcm_data import TCM_QUESTIONS, CONSTITUTION_TYPES, HEALTH_ADVICE
-from diagnosis_engine import DiagnosisEngine
-from database import save_diagnosis_result, get_diagnosis_history, get_diagnosis_stats
+from tcm_data import TCM_QUESTIONS, CONSTITUTION_TYPES, AGE_OPTIONS, GENDER_OPTIONS
+from advice_render import ADVICE_SECTIONS
+from diagnosis_engine import get_engine, reload_engine, rule_status
+from rule_sets import RuleSetError
+from incremental_scorer import IncrementalScorer
+from write_behind import get_writer
+from instrumentation import profiled, span, prometheus_text, snapshot as stage_snapshot
 
 # ページ設定
 st.set_page_config(
@@ -13,6 +17,16 @@ st.set_page_config(
     layout="wide"
 )
 
+HISTORY_PAGE_SIZE = 50
+# 回答途中の体質の傾向（ライブプレビュー）を表示するか（回答を変更したときだけ再描画する）
+LIVE_PREVIEW = os.getenv('DIAGNOSIS_LIVE_PREVIEW', '1').strip().lower() not in ('0', 'false', 'no', 'off')
+LIVE_PREVIEW_FRAGMENT = "live_preview"
+
+# 診断エンジンを起動時に構築（全セッション・再実行で共有）
+get_engine()
+# 書き込みキューを起動（データベースの準備はワーカースレッドで行い、画面の表示を待たせない）
+get_writer().start()
+
 # セッション状態の初期化
 if 'diagnosis_complete' not in st.session_state:
     st.session_state.diagnosis_complete = False
@@ -20,16 +34,142 @@ if 'user_responses' not in st.session_state:
     st.session_state.user_responses = {}
 if 'diagnosis_result' not in st.session_state:
     st.session_state.diagnosis_result = None
+if 'live_scorer' not in st.session_state:
+    # 回答の変更を差分で反映するスコア（ライブプレビュー用）
+    st.session_state.live_scorer = IncrementalScorer(get_engine())
+
+def get_live_scorer():
+    """ライブプレビュー用のスコア（ルールの再読み込みでエンジンが替わった場合は回答を引き継いで作り直す）"""
+    scorer = st.session_state.live_scorer
+    engine = get_engine()
+    if scorer.engine is not engine:
+        scorer = IncrementalScorer.from_responses(engine, scorer.responses())
+        st.session_state.live_scorer = scorer
+    return scorer
 
 def save_result_to_database(user_data, diagnosis_result, responses):
-    """診断結果をデータベースに保存"""
+    """診断結果をデータベースに保存（バックグラウンドでまとめて書き込み）"""
     try:
-        result = save_diagnosis_result(user_data, diagnosis_result, responses)
+        get_writer().submit(user_data, diagnosis_result, responses)
         return True
     except Exception as e:
         st.error(f"結果の保存に失敗しました: {str(e)}")
         return False
 
+@st.fragment
+def render_basic_info():
+    """基本情報の入力欄（変更時はこの部分だけ再実行）"""
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        st.selectbox("年齢", AGE_OPTIONS, index=3, key="user_age")
+    with col2:
+        st.selectbox("性別", GENDER_OPTIONS, index=1, key="user_gender")
+
+def on_answer_change(i):
+    """質問 i の入力欄の変更時（on_change）に回答をスコアへ差分反映し、この質問とライブプレビューだけを再実行"""
+    question_data = TCM_QUESTIONS[i]
+    scorer = get_live_scorer()
+    if question_data.get('type') == 'free_text':
+        scorer.set_free_text(i, st.session_state.get(f"q_{i}", ""))
+    else:
+        scorer.set_answer(i, st.session_state.get(f"q_{i}", question_data['options'][0]))
+        # 再表示されるチェックボックスはセッション状態の値（無ければ未選択）で描画される
+        for j, follow_up in enumerate(question_data.get('follow_up_questions', [])):
+            for k in range(len(follow_up['options'])):
+                scorer.set_option(i, j, k, bool(st.session_state.get(f"q_{i}_follow_{j}_option_{k}", False)))
+    if LIVE_PREVIEW:
+        st.rerun([f"question_{i}", LIVE_PREVIEW_FRAGMENT])
+
+def render_question(i, question_data):
+    """質問1問分の入力欄（回答・フォローアップの変更時はこの質問だけ再実行）"""
+    st.fragment(key=f"question_{i}")(render_question_inputs)(i, question_data)
+
+def render_question_inputs(i, question_data):
+    """質問1問分の入力欄（回答はスコアと照合し、差分があれば反映する）"""
+    st.write(f"**質問 {i+1}: {question_data['question']}**")
+    
+    # 自由記述の質問かどうかチェック
+    if question_data.get('type') == 'free_text':
+        text = st.text_area(
+            f"質問{i+1}の回答",
+            placeholder=question_data.get('placeholder', ''),
+            key=f"q_{i}",
+            label_visibility="collapsed",
+            on_change=on_answer_change,
+            args=(i,)
+        )
+        get_live_scorer().set_free_text(i, text)
+        return
+    
+    # 通常の選択肢質問
+    response = st.radio(
+        f"質問{i+1}の回答",
+        question_data['options'],
+        key=f"q_{i}",
+        label_visibility="collapsed",
+        on_change=on_answer_change,
+        args=(i,)
+    )
+    
+    scorer = get_live_scorer()
+    scorer.set_answer(i, response)
+    
+    # フォローアップ質問がある場合
+    if response == "はい" and 'follow_up_questions' in question_data:
+        st.write("　　↓ 詳細をお聞かせください（複数選択可）")
+        for j, follow_up in enumerate(question_data['follow_up_questions']):
+            st.write(f"**{follow_up['question']}**")
+            
+            # 複数選択可能なチェックボックス
+            for k, option in enumerate(follow_up['options']):
+                checked = st.checkbox(
+                    option,
+                    key=f"q_{i}_follow_{j}_option_{k}",
+                    value=False,
+                    on_change=on_answer_change,
+                    args=(i,)
+                )
+                scorer.set_option(i, j, k, checked)
+
+def collect_responses():
+    """入力欄のセッション状態から回答を組み立てる（診断実行時に一度だけ呼ぶ）"""
+    responses = {}
+    
+    for i, question_data in enumerate(TCM_QUESTIONS):
+        if question_data.get('type') == 'free_text':
+            responses[f"question_{i}"] = st.session_state.get(f"q_{i}", "")
+            responses[f"question_{i}_question"] = question_data['question']
+            continue
+        
+        response = st.session_state.get(f"q_{i}", question_data['options'][0])
+        responses[f"question_{i}"] = response
+        responses[f"question_{i}_question"] = question_data['question']
+        
+        if response == "はい" and 'follow_up_questions' in question_data:
+            for j, follow_up in enumerate(question_data['follow_up_questions']):
+                selected_options = [
+                    option for k, option in enumerate(follow_up['options'])
+                    if st.session_state.get(f"q_{i}_follow_{j}_option_{k}", False)
+                ]
+                
+                # 選択された項目を保存（複数の場合はカンマ区切り）
+                if selected_options:
+                    responses[f"question_{i}_follow_up_{j}"] = ", ".join(selected_options)
+                else:
+                    responses[f"question_{i}_follow_up_{j}"] = "どれも当てはまらない"
+    
+    return responses
+
+@st.fragment(key=LIVE_PREVIEW_FRAGMENT)
+def render_live_preview():
+    """回答途中の体質別スコア（回答の変更時に on_answer_change() から再実行される）"""
+    st.subheader("🔮 現在の傾向")
+    scores = get_live_scorer().scores()
+    for constitution_type, score in sorted(scores.items(), key=lambda item: item[1], reverse=True):
+        st.progress(min(100, max(0, score)) / 100, text=f"{constitution_type} {score:.0f}")
+    st.caption("回答に合わせて更新されます。最終結果は「体質診断を実行」で確定します。")
+
 def main():
     st.title("🏥 東洋医学体質診断アプリ")
     st.markdown("---")
@@ -57,12 +197,7 @@ def main():
         
         # 基本情報の入力
         st.subheader("基本情報")
-        col1, col2 = st.columns(2)
-        
-        with col1:
-            age = st.selectbox("年齢", ["20歳未満", "20-29歳", "30-39歳", "40-49歳", "50-59歳", "60歳以上"], index=3)
-        with col2:
-            gender = st.selectbox("性別", ["男性", "女性", "その他"], index=1)
+        render_basic_info()
         
         st.markdown("---")
         
@@ -70,77 +205,45 @@ def main():
         st.subheader("体調に関する質問")
         st.write("以下の質問にお答えください。該当する場合は詳細な症状もお聞きします。")
         
-        responses = {}
-        
+        # 各質問はフラグメントとして描画し、回答を変更してもその質問だけを再実行する
         for i, question_data in enumerate(TCM_QUESTIONS):
-            st.write(f"**質問 {i+1}: {question_data['question']}**")
-            
-            # 自由記述の質問かどうかチェック
-            if question_data.get('type') == 'free_text':
-                response = st.text_area(
-                    f"質問{i+1}の回答",
-                    placeholder=question_data.get('placeholder', ''),
-                    key=f"q_{i}",
-                    label_visibility="collapsed"
-                )
-                responses[f"question_{i}"] = response
-                responses[f"question_{i}_question"] = question_data['question']
-            else:
-                # 通常の選択肢質問
-                response = st.radio(
-                    f"質問{i+1}の回答",
-                    question_data['options'],
-                    key=f"q_{i}",
-                    label_visibility="collapsed"
-                )
-                responses[f"question_{i}"] = response
-                responses[f"question_{i}_question"] = question_data['question']
-                
-                # フォローアップ質問がある場合
-                if response == "はい" and 'follow_up_questions' in question_data:
-                    st.write("　　↓ 詳細をお聞かせください（複数選択可）")
-                    for j, follow_up in enumerate(question_data['follow_up_questions']):
-                        st.write(f"**{follow_up['question']}**")
-                        
-                        # 複数選択可能なチェックボックス
-                        selected_options = []
-                        for k, option in enumerate(follow_up['options']):
-                            if st.checkbox(
-                                option,
-                                key=f"q_{i}_follow_{j}_option_{k}",
-                                value=False
-                            ):
-                                selected_options.append(option)
-                        
-                        # 選択された項目を保存（複数の場合はカンマ区切り）
-                        if selected_options:
-                            responses[f"question_{i}_follow_up_{j}"] = ", ".join(selected_options)
-                        else:
-                            responses[f"question_{i}_follow_up_{j}"] = "どれも当てはまらない"
+            render_question(i, question_data)
+        
+        # 回答途中の傾向（回答を変更したときだけ、その質問と合わせてこの部分を再描画する）
+        if LIVE_PREVIEW:
+            with st.sidebar:
+                render_live_preview()
         
         # 診断ボタン
         st.markdown("---")
         col1, col2, col3 = st.columns([1, 2, 1])
         with col2:
             if st.button("🔍 体質診断を実行", type="primary", use_container_width=True):
-                # 必須質問に回答されているかチェック
-                required_questions = [i for i, q in enumerate(TCM_QUESTIONS) if q.get('type') != 'free_text']
-                answered_questions = [i for i in range(len(TCM_QUESTIONS)) if f"question_{i}" in responses and responses[f"question_{i}"].strip()]
-                
-                if len(answered_questions) >= len(required_questions):
-                    # 診断エンジンで結果を計算
-                    engine = DiagnosisEngine()
-                    diagnosis_result = engine.diagnose(responses)
-                    
-                    # セッション状態を更新
-                    st.session_state.user_responses = responses
-                    st.session_state.diagnosis_result = diagnosis_result
-                    st.session_state.diagnosis_complete = True
+                # 処理段階ごとの所要時間を計測（DIAGNOSIS_PROFILE_SAMPLE_RATE の割合でプロファイルも取得）
+                with profiled("diagnose_request"), span("request.total"):
+                    with span("request.collect"):
+                        responses = collect_responses()
                     
-                    # 結果をデータベースに保存
-                    user_data = {'age': age, 'gender': gender}
-                    save_result_to_database(user_data, diagnosis_result, responses)
+                    # 必須質問に回答されているかチェック
+                    required_questions = [i for i, q in enumerate(TCM_QUESTIONS) if q.get('type') != 'free_text']
+                    answered_questions = [i for i in range(len(TCM_QUESTIONS)) if f"question_{i}" in responses and responses[f"question_{i}"].strip()]
                     
+                    if len(answered_questions) >= len(required_questions):
+                        # 診断エンジンで結果を計算
+                        with span("request.diagnose"):
+                            diagnosis_result = get_engine().diagnose(responses)
+                        
+                        # セッション状態を更新
+                        st.session_state.user_responses = responses
+                        st.session_state.diagnosis_result = diagnosis_result
+                        st.session_state.diagnosis_complete = True
+                        
+                        # 結果をデータベースに保存
+                        user_data = {'age': st.session_state.user_age, 'gender': st.session_state.user_gender}
+                        with span("request.save"):
+                            save_result_to_database(user_data, diagnosis_result, responses)
+                
+                if st.session_state.diagnosis_complete:
                     st.rerun()
                 else:
                     st.error("すべての質問にお答えください。")
@@ -161,37 +264,13 @@ def main():
         # AI風のアドバイス表示
         st.header("🤖 AIからの個別アドバイス")
         
+        # 事前レンダリング済みのアドバイスをセクションごとに1要素で表示
         constitution = result['constitution_type']
-        if constitution in HEALTH_ADVICE:
-            advice = HEALTH_ADVICE[constitution]
-            
-            # 体質の説明
-            st.subheader("💡 あなたの体質について")
-            st.info(advice['description'])
-            
-            # 今日の養生アドバイス
-            st.subheader("🌸 今日の養生アドバイス")
-            for tip in advice['daily_tips']:
-                st.write(f"• {tip}")
-            
-            # 食事のアドバイス
-            st.subheader("🍽️ 食事のアドバイス")
-            col1, col2 = st.columns(2)
-            
-            with col1:
-                st.write("**おすすめ食材：**")
-                for food in advice['recommended_foods']:
-                    st.write(f"✅ {food}")
-            
-            with col2:
-                st.write("**控えめにする食材：**")
-                for food in advice['foods_to_avoid']:
-                    st.write(f"❌ {food}")
-            
-            # 生活習慣のアドバイス
-            st.subheader("🏃‍♀️ 生活習慣のアドバイス")
-            for habit in advice['lifestyle_tips']:
-                st.write(f"• {habit}")
+        for section in ADVICE_SECTIONS.get(constitution, ()):
+            if section.kind == "info":
+                st.info(section.body)
+            else:
+                st.markdown(section.body)
         
         st.markdown("---")
         
@@ -207,6 +286,11 @@ def main():
         
         # 診断履歴の表示（管理者向け）
         if st.checkbox("📊 診断履歴を表示（管理者向け）"):
+            # 管理画面でしか使わないモジュールは起動時間を抑えるため表示時に読み込む
+            import pandas as pd
+            from database import get_diagnosis_history_page, get_diagnosis_stats, get_pool_status
+            from export import export_data
+            
             try:
                 # 統計情報の表示
                 stats = get_diagnosis_stats()
@@ -228,9 +312,83 @@ def main():
                 else:
                     st.info("まだ診断データがありません。")
                 
+                # 診断エンジンのスコアキャッシュの効果
+                cache_stats = get_engine().score_cache.stats()
+                st.caption(
+                    f"スコアキャッシュ: ヒット {cache_stats['hits']}件 / ミス {cache_stats['misses']}件 "
+                    f"（ヒット率 {cache_stats['hit_rate']:.1%}、{cache_stats['size']}/{cache_stats['maxsize']}件保持）"
+                )
+                
+                # 診断ルールのバージョンと再読み込みの状況
+                status = rule_status()
+                st.caption(
+                    f"診断ルール: {status['rule_version']}（{status['rules_file']}、digest {status['rule_digest']}）"
+                )
+                if status['last_reload_error']:
+                    st.warning(f"ルールファイルの再読み込みに失敗しました（現在のルールを使用中）: {status['last_reload_error']}")
+                if st.button("🔁 ルールファイルを再読み込み"):
+                    try:
+                        engine = reload_engine()
+                        st.success(f"診断ルール {engine.rule_version} を使用しています。")
+                    except (OSError, RuleSetError) as e:
+                        st.error(f"ルールファイルを読み込めませんでした: {e}")
+                
+                # データベース接続プールの利用状況
+                pool_status = get_pool_status()
+                st.caption(
+                    f"接続プール: 使用中 {pool_status['checked_out']} / 待機 {pool_status['checked_in']} "
+                    f"（プールサイズ {pool_status['pool_size']}、オーバーフロー {pool_status['overflow']}/{pool_status['max_overflow']}、"
+                    f"平均取得待ち {pool_status.get('wait_avg_ms', 0):.1f}ms、最大 {pool_status.get('wait_max_ms', 0):.1f}ms、"
+                    f"タイムアウト {pool_status.get('timeouts', 0)}件、"
+                    f"新規接続 {pool_status.get('connect_count', 0)}回・平均 {pool_status.get('connect_avg_ms', 0):.1f}ms）"
+                )
+                
+                # 書き込みキューの状況
+                writer_stats = get_writer().stats()
+                st.caption(
+                    f"書き込みキュー: 保存済み {writer_stats['written']}件（{writer_stats['batches']}回のコミット）、"
+                    f"待機中 {writer_stats['queued']}件、一時退避 {writer_stats['spilled']}件"
+                )
+                
+                # 処理段階ごとの所要時間（Prometheus 形式でも取得可能）
+                with st.expander("⏱️ 処理時間の内訳"):
+                    stage_stats = stage_snapshot()
+                    if stage_stats:
+                        st.dataframe(pd.DataFrame([
+                            {'処理段階': stage, '件数': stat['count'], '平均(ms)': round(stat['avg_ms'], 3),
+                             'p50(ms)': stat['p50_ms'], 'p99(ms)': stat['p99_ms']}
+                            for stage, stat in stage_stats.items()
+                        ]), use_container_width=True)
+                    st.download_button(
+                        "Prometheus 形式でダウンロード", prometheus_text(),
+                        file_name="diagnosis_metrics.prom", mime="text/plain"
+                    )
+                
                 # 診断履歴の詳細表示
                 st.subheader("📋 診断履歴詳細")
-                history = get_diagnosis_history(50)  # 最新50件
+                
+                # 絞り込み条件
+                filter_col1, filter_col2, filter_col3 = st.columns(3)
+                with filter_col1:
+                    constitution_filter = st.selectbox("体質タイプ", ["すべて"] + list(CONSTITUTION_TYPES.keys()), key="history_constitution")
+                with filter_col2:
+                    age_filter = st.selectbox("年齢", ["すべて"] + AGE_OPTIONS, key="history_age")
+                with filter_col3:
+                    gender_filter = st.selectbox("性別", ["すべて"] + GENDER_OPTIONS, key="history_gender")
+                history_filters = {
+                    'constitution_type': None if constitution_filter == "すべて" else constitution_filter,
+                    'age': None if age_filter == "すべて" else age_filter,
+                    'gender': None if gender_filter == "すべて" else gender_filter
+                }
+                
+                # ページ位置（各ページ先頭のカーソル）は絞り込み条件が変わったらリセット
+                if st.session_state.get('history_filters') != history_filters:
+                    st.session_state.history_filters = history_filters
+                    st.session_state.history_cursors = [None]
+                history_cursors = st.session_state.history_cursors
+                history, next_cursor = get_diagnosis_history_page(
+                    HISTORY_PAGE_SIZE, cursor=history_cursors[-1], **history_filters
+                )
                 
                 if history:
                     history_data = []
@@ -240,22 +398,50 @@ def main():
                             '年齢': record.age,
                             '性別': record.gender,
                             '体質タイプ': record.constitution_type,
-                            '気になる不調': record.free_text_concern[:50] + "..." if record.free_text_concern and len(record.free_text_concern) > 50 else record.free_text_concern
+                            '気になる不調': record.free_text_concern  # SQL 側で50文字に切り詰め済み
                         })
                     
                     df = pd.DataFrame(history_data)
                     st.dataframe(df, use_container_width=True)
                     
-                    # CSVダウンロード
-                    csv = df.to_csv(index=False, encoding='utf-8')
-                    st.download_button(
-                        label="📥 診断履歴をCSVでダウンロード",
-                        data=csv,
-                        file_name=f"tcm_diagnosis_history_{datetime.datetime.now().strftime('%Y%m%d')}.csv",
-                        mime="text/csv"
-                    )
+                    # ページ送り
+                    page_col1, page_col2, page_col3 = st.columns([1, 2, 1])
+                    with page_col1:
+                        if len(history_cursors) > 1 and st.button("◀ 前のページ"):
+                            history_cursors.pop()
+                            st.rerun()
+                    with page_col2:
+                        st.caption(f"{len(history_cursors)}ページ目")
+                    with page_col3:
+                        if next_cursor is not None and st.button("次のページ ▶"):
+                            history_cursors.append(next_cursor)
+                            st.rerun()
+                    
                 else:
                     st.info("まだ診断履歴がありません。")
+                
+                # 全件エクスポート（ダウンロードボタンを押したときだけ、サーバーサイドカーソルで一時ファイルへ逐次書き出す）
+                st.subheader("📥 診断履歴のエクスポート")
+                export_col1, export_col2, export_col3 = st.columns(3)
+                with export_col1:
+                    export_start = st.date_input("開始日", value=None, key="export_start")
+                with export_col2:
+                    export_end = st.date_input("終了日", value=None, key="export_end")
+                with export_col3:
+                    export_format = st.radio("形式", ["CSV", "Parquet"], horizontal=True, key="export_format")
+                
+                export_suffix = "csv" if export_format == "CSV" else "parquet"
+                st.download_button(
+                    label="📥 診断履歴をダウンロード",
+                    data=functools.partial(
+                        export_data, export_suffix,
+                        start_date=export_start, end_date=export_end,
+                        constitution_type=history_filters['constitution_type']
+                    ),
+                    file_name=f"tcm_diagnosis_history_{datetime.datetime.now().strftime('%Y%m%d')}.{export_suffix}",
+                    mime="text/csv" if export_format == "CSV" else "application/octet-stream",
+                    on_click="ignore"
+                )
                     
             except Exception as e:
                 st.error(f"データベースの読み込みに失敗しました: {str(e)}")
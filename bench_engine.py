@@ -0,0 +1,180 @@
+"""DiagnosisEngine のベンチマーク
+
+synthetic.py で生成した回答を使い、以下の経路ごとにスループット（診断/秒）、
+1回あたりのレイテンシ（p50 / p99）、1回あたりのメモリ確保量（tracemalloc）を計測する。
+
+    scalar  diagnose()（キャッシュ・スコアテーブルなし）
+    table   diagnose()（事前計算スコアテーブルあり、キャッシュなし）
+    cached  diagnose()（キャッシュ済みの回答を再診断）
+    batch   diagnose_batch()（--batch-size 件ずつ）
+
+結果は JSON ファイルに保存し、--compare で以前の結果（別コミットでの計測）と比較できる。
+
+使い方:
+    python bench_engine.py [--count 2000] [--output bench.json] [--compare bench_main.json]
+"""
+import argparse
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+
+from diagnosis_engine import DiagnosisEngine, JITTER_MODES
+from score_table import DEFAULT_TABLE_DIR
+from synthetic import add_generation_arguments, generate_corpus, generation_options
+
+PATHS = ("scalar", "table", "cached", "batch")
+ALLOCATION_SAMPLES = 200
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _measure(call, items, batch_size=1):
+    """items を batch_size 件ずつ call に渡し、呼び出しごとの所要時間（秒）を返す"""
+    timings = []
+    for start in range(0, len(items), batch_size):
+        chunk = items[start] if batch_size == 1 else items[start:start + batch_size]
+        began = time.perf_counter()
+        call(chunk)
+        timings.append(time.perf_counter() - began)
+    return timings
+
+
+def _allocations(call, items, batch_size=1, samples=ALLOCATION_SAMPLES):
+    """1件あたりのメモリ確保量（ピーク増分の平均バイト数）を tracemalloc で計測"""
+    tracemalloc.start()
+    try:
+        total = 0
+        count = 0
+        for start in range(0, min(len(items), samples * batch_size), batch_size):
+            chunk = items[start] if batch_size == 1 else items[start:start + batch_size]
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            call(chunk)
+            total += tracemalloc.get_traced_memory()[1] - before
+            count += 1 if batch_size == 1 else len(chunk)
+        return total / count if count else 0.0
+    finally:
+        tracemalloc.stop()
+
+
+def run_path(name, corpus, jitter="random", batch_size=256, table_dir=DEFAULT_TABLE_DIR, repeat=3):
+    """1つの経路を計測して結果の辞書を返す（repeat 回計測し最も速かった回を採用）"""
+    if name == "scalar":
+        engine = DiagnosisEngine(jitter=jitter, cache_size=0)
+    elif name == "table":
+        engine = DiagnosisEngine(jitter=jitter, cache_size=0, score_table_dir=table_dir)
+    elif name == "cached":
+        engine = DiagnosisEngine(jitter=jitter, cache_size=len(corpus), score_table_dir=table_dir)
+        for responses in corpus:
+            engine.diagnose(responses)
+    elif name == "batch":
+        engine = DiagnosisEngine(jitter=jitter, cache_size=0)
+    else:
+        raise ValueError(f"Unknown path: {name}")
+
+    if name == "batch":
+        call, size = engine.diagnose_batch, batch_size
+    else:
+        call, size = engine.diagnose, 1
+
+    # 最初の数回は暖機運転として計測から除く
+    _measure(call, corpus[:size * 10], size)
+    timings = min((_measure(call, corpus, size) for _ in range(max(1, repeat))), key=sum)
+    elapsed = sum(timings)
+    latencies_ms = np.array(timings) * 1000
+    result = {
+        "diagnoses": len(corpus),
+        "calls": len(timings),
+        "seconds": elapsed,
+        "diagnoses_per_second": len(corpus) / elapsed if elapsed else 0.0,
+        "latency_p50_ms": float(np.percentile(latencies_ms, 50)),
+        "latency_p99_ms": float(np.percentile(latencies_ms, 99)),
+        "alloc_bytes_per_diagnosis": _allocations(call, corpus, size),
+    }
+    if name == "cached":
+        result["cache"] = engine.score_cache.stats()
+    return result
+
+
+def compare(results, baseline):
+    """以前の結果に対する変化率を表示"""
+    print(f"\ncompared with {baseline['meta'].get('commit') or 'baseline'}:")
+    for name, result in results.items():
+        before = baseline["results"].get(name)
+        if not before:
+            continue
+        changes = []
+        for key in ("diagnoses_per_second", "latency_p50_ms", "latency_p99_ms", "alloc_bytes_per_diagnosis"):
+            if before.get(key):
+                changes.append(f"{key} {(result[key] / before[key] - 1) * 100:+.1f}%")
+        print(f"  {name:7s} " + ", ".join(changes))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="DiagnosisEngine のスループット・レイテンシを計測")
+    parser.add_argument("--count", type=int, default=2000, help="計測に使う回答の件数")
+    parser.add_argument("--paths", default=",".join(PATHS), help=f"計測する経路（{','.join(PATHS)}）")
+    parser.add_argument("--batch-size", type=int, default=256, help="batch 経路の1回あたりの件数")
+    parser.add_argument("--repeat", type=int, default=3, help="計測の繰り返し回数（最速の回を採用）")
+    parser.add_argument("--jitter", choices=JITTER_MODES, default="random")
+    parser.add_argument("--table-dir", default=DEFAULT_TABLE_DIR, help="スコアテーブルの保存先")
+    parser.add_argument("--output", help="結果を書き出す JSON ファイル")
+    parser.add_argument("--compare", help="比較対象の以前の結果 JSON")
+    add_generation_arguments(parser)
+    args = parser.parse_args(argv)
+
+    paths = [p.strip() for p in args.paths.split(",") if p.strip()]
+    unknown = set(paths) - set(PATHS)
+    if unknown:
+        parser.error(f"unknown paths: {', '.join(sorted(unknown))}")
+
+    corpus = list(generate_corpus(args.count, seed=args.seed, **generation_options(args)))
+    results = {}
+    for name in paths:
+        result = run_path(name, corpus, jitter=args.jitter, batch_size=args.batch_size,
+                          table_dir=args.table_dir, repeat=args.repeat)
+        results[name] = result
+        print(
+            f"{name:7s} {result['diagnoses_per_second']:10.0f} diagnoses/s  "
+            f"p50 {result['latency_p50_ms']:.3f} ms  p99 {result['latency_p99_ms']:.3f} ms  "
+            f"{result['alloc_bytes_per_diagnosis']:.0f} B/diagnosis"
+        )
+
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "count": args.count,
+            "batch_size": args.batch_size,
+            "repeat": args.repeat,
+            "jitter": args.jitter,
+            "seed": args.seed,
+            **generation_options(args),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
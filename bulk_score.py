@@ -0,0 +1,162 @@
+"""回答ファイルの並列一括スコアリング
+
+JSON Lines または Parquet の回答ファイルを逐次読み込み、チャンクに分けて
+ProcessPoolExecutor のワーカーで診断する。各ワーカーは起動時に一度だけ
+（候補の重みセットを反映した）DiagnosisEngine を構築する。結果は入力と同じ順序で
+JSON Lines に書き出す。処理中のチャンク数に上限を設けるため、入力全体を
+メモリに載せることはない。
+
+入力の各レコードは回答の辞書そのもの、または export.py の出力のように
+"responses" 列（辞書または JSON 文字列）を持つ行のどちらでもよい。"id" 列があれば出力に含める。
+回答は従来形式の辞書と response_codec のコンパクト形式のどちらも受け付ける。
+
+使い方:
+    python bulk_score.py responses.jsonl --output scores.jsonl [--rules weights.json] [--workers 4]
+    python bulk_score.py history.parquet --output scores.jsonl --chunk-size 5000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from diagnosis_engine import DiagnosisEngine, JITTER_MODES
+from response_codec import decode_responses
+
+DEFAULT_CHUNK_SIZE = 2000
+PROGRESS_INTERVAL = 5.0
+
+_worker_engine = None
+
+
+def _init_worker(rules, jitter):
+    """ワーカープロセスの初期化（診断ルールのコンパイルはここで一度だけ行う）"""
+    global _worker_engine
+    _worker_engine = DiagnosisEngine(jitter=jitter, rules=rules)
+
+
+def parse_chunk(chunk):
+    """iter_chunks() のチャンクを (レコードのリスト, 回答の辞書のリスト) に変換"""
+    if isinstance(chunk, list):
+        records = [json.loads(line) for line in chunk]
+    else:
+        records = chunk.to_pylist()
+    responses_list = []
+    for record in records:
+        responses = record.get("responses", record)
+        if isinstance(responses, str):
+            responses = json.loads(responses)
+        responses_list.append(decode_responses(responses) or {})
+    return records, responses_list
+
+
+def _score_chunk(chunk):
+    """チャンクを診断し、出力する JSON Lines の文字列を返す（受け渡しのコストを抑えるため文字列で返す）
+
+    JSON の解析・Parquet の行変換もワーカー側で行い、親プロセスは読み込みと書き出しだけを担う。
+    """
+    records, responses_list = parse_chunk(chunk)
+    lines = []
+    for record, result in zip(records, _worker_engine.diagnose_batch(responses_list)):
+        if "id" in record:
+            result = {"id": record["id"], **result}
+        lines.append(json.dumps(result, ensure_ascii=False) + "\n")
+    return "".join(lines)
+
+
+def iter_chunks(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """入力ファイルを chunk_size 件ずつ順に読み込む（JSON Lines は行のリスト、Parquet は RecordBatch）"""
+    if path.endswith(".parquet"):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise RuntimeError("Parquet input requires the pyarrow package") from e
+        parquet_file = pq.ParquetFile(path)
+        columns = [name for name in ("id", "responses") if name in parquet_file.schema_arrow.names]
+        for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns or None):
+            yield batch
+        return
+
+    f = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    try:
+        chunk = []
+        for line in f:
+            if not line.strip():
+                continue
+            chunk.append(line)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def bulk_score(path, out, rules=None, jitter="off", workers=None, chunk_size=DEFAULT_CHUNK_SIZE,
+               max_in_flight=None, log=sys.stderr):
+    """入力ファイルを並列に診断して out に書き出し、処理件数を返す"""
+    workers = workers or os.cpu_count() or 1
+    # 全ワーカーが常に次のチャンクを持てる程度に先読みする
+    max_in_flight = max_in_flight or workers * 2
+    total = 0
+    started = last_report = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(rules, jitter)) as executor:
+        pending = deque()
+
+        def drain(limit):
+            nonlocal total, last_report
+            while len(pending) > limit:
+                count, future = pending.popleft()
+                out.write(future.result())
+                total += count
+                now = time.perf_counter()
+                if log and now - last_report >= PROGRESS_INTERVAL:
+                    print(f"{total} rows scored ({total / (now - started):.0f} rows/s)", file=log)
+                    last_report = now
+
+        for chunk in iter_chunks(path, chunk_size):
+            pending.append((len(chunk), executor.submit(_score_chunk, chunk)))
+            drain(max_in_flight)
+        drain(0)
+
+    if log:
+        elapsed = time.perf_counter() - started
+        print(f"done: {total} rows in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.0f} rows/s, "
+              f"{workers} workers)", file=log)
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="回答ファイルを複数プロセスで一括スコアリング")
+    parser.add_argument("input", help="入力ファイル（.jsonl / .parquet、- で標準入力の JSON Lines）")
+    parser.add_argument("--output", default="-", help="出力ファイル（JSON Lines、- で標準出力）")
+    parser.add_argument("--rules", help="diagnosis_rules の重みを上書きする JSON ファイル")
+    parser.add_argument("--workers", type=int, help="ワーカープロセス数（既定は CPU 数）")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="1チャンクの件数")
+    parser.add_argument("--jitter", choices=JITTER_MODES, default="off",
+                        help="信頼度の微調整（一括処理では既定で無効）")
+    args = parser.parse_args(argv)
+
+    rules = None
+    if args.rules:
+        with open(args.rules, encoding="utf-8") as f:
+            rules = json.load(f)
+        # 不正な重みファイルはワーカーを起動する前に検出する
+        DiagnosisEngine(jitter=args.jitter, cache_size=0, rules=rules)
+
+    out = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    try:
+        bulk_score(args.input, out, rules=rules, jitter=args.jitter, workers=args.workers,
+                   chunk_size=args.chunk_size)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""アプリ起動時のモジュール読み込み時間の予算チェック
+
+`python -X importtime` で app.py が起動時に読み込むモジュールの読み込み時間を計測し、
+予算を超えた場合や、起動時に読み込むべきでない重いモジュール（pandas, SQLAlchemy など）が
+読み込まれた場合に終了コード 1 を返す。計測対象は app.py のモジュール直下の import 文のうち
+このリポジトリのモジュール（関数内で遅延読み込みするものは含まない）。
+streamlit 本体はサーバー側で読み込み済みのため対象外。
+
+使い方:
+    python check_import_time.py [--budget-ms 200] [--repeat 3] [--top 10]
+"""
+import argparse
+import ast
+import os
+import re
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def startup_modules(path=os.path.join(ROOT, "app.py")):
+    """app.py のモジュール直下で import している自前のモジュール（記述順）"""
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), filename=path)
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            names = [node.module]
+        else:
+            continue
+        for name in names:
+            name = name.split(".")[0]
+            if name not in modules and os.path.exists(os.path.join(ROOT, f"{name}.py")):
+                modules.append(name)
+    return modules
+
+
+# app.py が起動時に読み込む自前のモジュール
+STARTUP_MODULES = startup_modules()
+# 管理画面・保存時まで遅延させるモジュール
+DEFERRED_MODULES = ["pandas", "sqlalchemy", "pyarrow", "database", "export"]
+DEFAULT_BUDGET_MS = float(os.getenv("IMPORT_BUDGET_MS", "200"))
+
+_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$")
+
+
+def measure(modules):
+    """別プロセスでモジュールを読み込み、[(モジュール名, 自身の μs, 累積 μs, 深さ)] を返す"""
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    env.pop("PYTHONPROFILEIMPORTTIME", None)
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + ", ".join(modules)],
+        capture_output=True, text=True, env=env, cwd=ROOT
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr else "import failed")
+    entries = []
+    for line in proc.stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            entries.append((name, int(self_us), int(cumulative_us), (len(indent) - 1) // 2))
+    return entries
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="アプリ起動時のモジュール読み込み時間をチェック")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS, help="読み込み時間の上限（ミリ秒）")
+    parser.add_argument("--repeat", type=int, default=3, help="計測回数（最小値で判定）")
+    parser.add_argument("--top", type=int, default=10, help="表示する上位モジュール数")
+    args = parser.parse_args(argv)
+
+    best_total, best_entries = None, None
+    for _ in range(max(1, args.repeat)):
+        entries = measure(STARTUP_MODULES)
+        # 対象モジュールの累積時間（依存モジュールを含む）の合計。インタプリタ自体の起動分は除く
+        total = sum(
+            cumulative for name, _, cumulative, depth in entries if depth == 0 and name in STARTUP_MODULES
+        ) / 1000
+        if best_total is None or total < best_total:
+            best_total, best_entries = total, entries
+
+    # importtime の出力は子モジュールが親より先に並ぶため、深さ1の行を直後の最上位モジュールに帰属させる
+    children, pending = [], []
+    for entry in best_entries:
+        if entry[3] == 1:
+            pending.append(entry)
+        elif entry[3] == 0:
+            if entry[0] in STARTUP_MODULES:
+                children.extend(pending)
+            pending = []
+
+    loaded = {name for name, _, _, _ in best_entries}
+    print(f"startup imports: {best_total:.1f} ms (budget {args.budget_ms:.0f} ms)")
+    for name, _, cumulative, _ in sorted(children, key=lambda e: e[2], reverse=True)[:args.top]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    failed = False
+    deferred = [name for name in DEFERRED_MODULES if name in loaded]
+    if deferred:
+        print(f"deferred modules loaded at startup: {', '.join(deferred)}", file=sys.stderr)
+        failed = True
+    if best_total > args.budget_ms:
+        print(f"import time {best_total:.1f} ms exceeds the budget of {args.budget_ms:.0f} ms", file=sys.stderr)
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,20 +1,162 @@
 import os
 import json
-from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, Float
+import logging
+import threading
+import time
+from collections import Counter, namedtuple
+from datetime import datetime, timedelta
+from sqlalchemy import exc, create_engine, inspect, insert, select, delete, func, case, literal, null, tuple_, union_all, Column, Index, Integer, String, DateTime, Date, Text, Float, JSON
+from sqlalchemy.pool import QueuePool, StaticPool
+from sqlalchemy.schema import CreateIndex
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import JSONB, insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from instrumentation import span
+from response_codec import pack_responses
+
+logger = logging.getLogger(__name__)
+
+def _env_bool(name, default):
+    """環境変数を真偽値として読み込む"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
 
 # Database configuration
+# DATABASE_URL が未設定の場合はローカル実行用の SQLite ファイルを使う。
+# デプロイ環境（REPLIT_DEPLOYMENT が設定されている場合）や DB_REQUIRE_DATABASE_URL=1 では、
+# 設定漏れのまま SQLite に保存し続けないよう起動時にエラーにする
+DEFAULT_SQLITE_PATH = os.path.join('data', 'tcm_diagnosis.db')
+REQUIRE_DATABASE_URL = _env_bool('DB_REQUIRE_DATABASE_URL', bool(os.getenv('REPLIT_DEPLOYMENT')))
 DATABASE_URL = os.getenv('DATABASE_URL')
 if not DATABASE_URL:
-    raise ValueError("DATABASE_URL environment variable is not set")
+    if REQUIRE_DATABASE_URL:
+        raise RuntimeError("DATABASE_URL is not set (required in deployments; set DB_REQUIRE_DATABASE_URL=0 to allow SQLite)")
+    DATABASE_URL = f'sqlite:///{DEFAULT_SQLITE_PATH}'
+    logger.warning("DATABASE_URL is not set; falling back to local SQLite database %s", DEFAULT_SQLITE_PATH)
+
+# 接続プールの設定（オートスケール環境向けに環境変数で調整可能）
+POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+POOL_MAX_OVERFLOW = int(os.getenv('DB_POOL_MAX_OVERFLOW', '10'))
+POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))  # 秒。アイドル切断された接続の再利用を防ぐ
+POOL_PRE_PING = _env_bool('DB_POOL_PRE_PING', True)  # チェックアウト時に接続の生存確認を行う
+POOL_USE_LIFO = _env_bool('DB_POOL_USE_LIFO', True)  # 余剰接続をアイドルのまま期限切れにさせる
+STATEMENT_TIMEOUT_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', '15000'))  # 0 で無制限
+
+# 初回接続時にテーブル・インデックスを作成する（既定では SQLite のみ。本番は `python database.py migrate`）
+AUTO_MIGRATE = _env_bool('DB_AUTO_MIGRATE', DATABASE_URL.startswith('sqlite'))
+
+# 集計用ロールアップテーブルを保存時に更新し、統計をロールアップから取得する
+ROLLUPS_ENABLED = _env_bool('DIAGNOSIS_ROLLUPS', False)
+
+class InstrumentedQueuePool(QueuePool):
+    """接続の取得待ち時間を計測する QueuePool
+    
+    取得待ち時間（wait_*）はプールに空きが出るまでの時間で、新しい接続を開く時間（connect_*）は
+    別に集計する。timeouts は pool_timeout を超えて取得できなかった回数のみで、接続エラーは含まない。
+    """
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self._checkout = threading.local()
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+        self.connect_count = 0
+        self.connect_total = 0.0
+    
+    def _do_get(self):
+        checkout = self._checkout
+        if getattr(checkout, 'active', False):
+            # QueuePool._do_get 内部の再試行（外側の呼び出しでまとめて計測する）
+            return super()._do_get()
+        checkout.active = True
+        checkout.connect_seconds = 0.0
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            checkout.active = False
+            waited = time.perf_counter() - started - checkout.connect_seconds
+            with self._stats_lock:
+                self.wait_count += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+    
+    def _create_connection(self):
+        started = time.perf_counter()
+        try:
+            return super()._create_connection()
+        finally:
+            elapsed = time.perf_counter() - started
+            if getattr(self._checkout, 'active', False):
+                self._checkout.connect_seconds += elapsed
+            with self._stats_lock:
+                self.connect_count += 1
+                self.connect_total += elapsed
+
+def _engine_options(url):
+    """接続先に応じた create_engine の引数"""
+    if url.startswith('sqlite'):
+        if url in ('sqlite://', 'sqlite:///:memory:'):
+            # インメモリ DB は接続ごとに別の DB になるため1接続を共有する
+            return {'poolclass': StaticPool, 'connect_args': {'check_same_thread': False}}
+        connect_args = {'check_same_thread': False}  # 書き込みキューのワーカースレッドからも使う
+    else:
+        connect_args = {}
+        if STATEMENT_TIMEOUT_MS > 0 and url.startswith('postgresql'):
+            connect_args['options'] = f'-c statement_timeout={STATEMENT_TIMEOUT_MS}'
+    return {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': POOL_SIZE,
+        'max_overflow': POOL_MAX_OVERFLOW,
+        'pool_timeout': POOL_TIMEOUT,
+        'pool_recycle': POOL_RECYCLE,
+        'pool_pre_ping': POOL_PRE_PING,
+        'pool_use_lifo': POOL_USE_LIFO,
+        'connect_args': connect_args
+    }
 
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
 Base = declarative_base()
 
+# JSONB は PostgreSQL のみ。SQLite では JSON 文字列として保存する
+JSONType = JSON().with_variant(JSONB(), 'postgresql')
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_db_engine():
+    """データベースエンジンを取得（初回呼び出し時に作成し、AUTO_MIGRATE ならスキーマも作成）"""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                if DATABASE_URL.startswith('sqlite:///') and DATABASE_URL != 'sqlite:///:memory:':
+                    directory = os.path.dirname(DATABASE_URL[len('sqlite:///'):])
+                    if directory:
+                        os.makedirs(directory, exist_ok=True)
+                engine = create_engine(DATABASE_URL, **_engine_options(DATABASE_URL))
+                if AUTO_MIGRATE:
+                    create_tables(engine)
+                SessionLocal.configure(bind=engine)
+                _engine = engine
+    return _engine
+
+def open_session():
+    """データベースセッションを作成（呼び出し側で close する）"""
+    get_db_engine()
+    return SessionLocal()
+
 class DiagnosisResult(Base):
     """診断結果テーブル"""
     __tablename__ = "diagnosis_results"
@@ -26,9 +168,32 @@ class DiagnosisResult(Base):
     constitution_type = Column(String(50))
     score = Column(Float)
     confidence = Column(Float)
-    responses = Column(JSONB)  # JSON形式で全回答を保存
+    responses = Column(JSONType)  # 全回答（response_codec のコンパクト形式、移行前の行は従来の辞書）
     free_text_concern = Column(Text)  # 自由記述の悩み
-    all_scores = Column(JSONB)  # 全体質タイプのスコア
+    all_scores = Column(JSONType)  # 全体質タイプのスコア
+    rule_version = Column(String(64))  # 診断に使ったルールファイルのバージョン（導入前の行は NULL）
+    
+    __table_args__ = (
+        # 新しい順の履歴表示・キーセットページング用
+        Index('ix_diagnosis_results_timestamp_id', 'timestamp', 'id'),
+        # 体質タイプ・年齢・性別で絞り込んだ履歴表示用
+        Index('ix_diagnosis_results_constitution_timestamp', 'constitution_type', 'timestamp', 'id'),
+        Index('ix_diagnosis_results_age_timestamp', 'age', 'timestamp', 'id'),
+        Index('ix_diagnosis_results_gender_timestamp', 'gender', 'timestamp', 'id'),
+        # 回答内容・スコアの JSONB 検索用（PostgreSQL のみ）
+        Index('ix_diagnosis_results_responses', 'responses', postgresql_using='gin').ddl_if(dialect='postgresql'),
+        Index('ix_diagnosis_results_all_scores', 'all_scores', postgresql_using='gin').ddl_if(dialect='postgresql'),
+    )
+
+class DiagnosisRollup(Base):
+    """体質タイプ x 年齢 x 性別 x 日ごとの診断件数（管理画面の集計用）"""
+    __tablename__ = "diagnosis_rollups"
+    
+    day = Column(Date, primary_key=True)
+    constitution_type = Column(String(50), primary_key=True)
+    age = Column(String(50), primary_key=True)
+    gender = Column(String(20), primary_key=True)
+    diagnosis_count = Column(Integer, nullable=False, default=0)
 
 class User(Base):
     """ユーザーテーブル（将来の拡張用）"""
@@ -39,43 +204,123 @@ class User(Base):
     last_diagnosis = Column(DateTime)
     total_diagnoses = Column(Integer, default=0)
 
-def create_tables():
-    """データベーステーブルを作成"""
-    Base.metadata.create_all(bind=engine)
+def create_tables(bind=None):
+    """データベーステーブルを作成（`python database.py migrate` から実行）"""
+    bind = bind or get_db_engine()
+    Base.metadata.create_all(bind=bind)
+    ensure_columns(bind)
+    ensure_indexes(bind)
+
+def ensure_columns(bind=None):
+    """既存テーブルに後から追加した列を ALTER TABLE で追加（NULL 許容の列のみ）"""
+    bind = bind or get_db_engine()
+    inspector = inspect(bind)
+    with bind.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=bind.dialect)
+                    conn.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}')
+
+def ensure_indexes(bind=None):
+    """既存テーブルに不足しているインデックスを作成（create_all は新規テーブルにしか作成しない）
+    
+    PostgreSQL では稼働中のテーブルへの書き込みを止めないよう CREATE INDEX CONCURRENTLY で作成する
+    （トランザクション内では実行できないため AUTOCOMMIT の接続を使う）。中断された作成で残った
+    無効なインデックス（indisvalid = false）は削除してから作り直す。
+    """
+    bind = bind or get_db_engine()
+    if bind.dialect.name != 'postgresql':
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=bind, checkfirst=True)
+        return
+    with bind.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        invalid = set(conn.exec_driver_sql(
+            "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE NOT i.indisvalid AND pg_catalog.pg_table_is_visible(c.oid)"
+        ).scalars())
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name in invalid:
+                    conn.exec_driver_sql(f'DROP INDEX CONCURRENTLY IF EXISTS {index.name}')
+                ddl = str(CreateIndex(index, if_not_exists=True).compile(dialect=bind.dialect))
+                conn.exec_driver_sql(ddl.replace(' INDEX ', ' INDEX CONCURRENTLY ', 1))
 
 def get_db():
     """データベースセッションを取得"""
-    db = SessionLocal()
+    db = open_session()
     try:
         yield db
     finally:
         db.close()
 
+def get_pool_status():
+    """接続プールの利用状況を取得（管理画面・プールサイズ調整用）"""
+    pool = get_db_engine().pool
+    if not isinstance(pool, QueuePool):
+        # インメモリ SQLite など、プールを使わない接続
+        return {'pool_size': 1, 'checked_out': 0, 'checked_in': 0, 'overflow': 0, 'max_overflow': 0}
+    status = {
+        'pool_size': pool.size(),
+        'checked_out': pool.checkedout(),
+        'checked_in': pool.checkedin(),
+        'overflow': max(0, pool.overflow()),
+        'max_overflow': POOL_MAX_OVERFLOW,
+    }
+    if isinstance(pool, InstrumentedQueuePool):
+        with pool._stats_lock:
+            status.update({
+                'wait_count': pool.wait_count,
+                'wait_avg_ms': pool.wait_total / pool.wait_count * 1000 if pool.wait_count else 0.0,
+                'wait_max_ms': pool.wait_max * 1000,
+                'timeouts': pool.timeouts,
+                'connect_count': pool.connect_count,
+                'connect_avg_ms': pool.connect_total / pool.connect_count * 1000 if pool.connect_count else 0.0,
+            })
+    return status
+
+def build_diagnosis_row(user_data, diagnosis_result, responses, timestamp=None):
+    """診断結果を diagnosis_results テーブルの1行分の辞書に変換"""
+    # 自由記述の回答を抽出
+    free_text_concern = ""
+    for key, value in responses.items():
+        if "question_10" in key and not "_question" in key:  # 最後の自由記述質問
+            free_text_concern = value
+            break
+    
+    return {
+        'timestamp': timestamp or datetime.utcnow(),
+        'age': user_data.get('age', ''),
+        'gender': user_data.get('gender', ''),
+        'constitution_type': diagnosis_result['constitution_type'],
+        'score': diagnosis_result['score'],
+        'confidence': diagnosis_result['confidence'],
+        'responses': pack_responses(responses),  # 質問票のバージョンと選択肢番号のコンパクト形式
+        'free_text_concern': free_text_concern,
+        'all_scores': diagnosis_result['all_scores'],
+        'rule_version': diagnosis_result.get('rule_version')
+    }
+
 def save_diagnosis_result(user_data, diagnosis_result, responses):
     """診断結果をデータベースに保存"""
-    db = SessionLocal()
+    db = open_session()
     try:
-        # 自由記述の回答を抽出
-        free_text_concern = ""
-        for key, value in responses.items():
-            if "question_10" in key and not "_question" in key:  # 最後の自由記述質問
-                free_text_concern = value
-                break
-        
-        db_result = DiagnosisResult(
-            age=user_data.get('age', ''),
-            gender=user_data.get('gender', ''),
-            constitution_type=diagnosis_result['constitution_type'],
-            score=diagnosis_result['score'],
-            confidence=diagnosis_result['confidence'],
-            responses=responses,
-            free_text_concern=free_text_concern,
-            all_scores=diagnosis_result['all_scores']
-        )
+        row = build_diagnosis_row(user_data, diagnosis_result, responses)
+        db_result = DiagnosisResult(**row)
         
-        db.add(db_result)
-        db.commit()
-        db.refresh(db_result)
+        with span("db.connect"):
+            db.connection()
+        with span("db.insert"):
+            db.add(db_result)
+            if ROLLUPS_ENABLED:
+                _update_rollups(db, [row])
+            db.flush()
+        with span("db.commit"):
+            db.commit()
+        with span("db.refresh"):
+            db.refresh(db_result)
         return db_result
     except Exception as e:
         db.rollback()
@@ -83,38 +328,210 @@ def save_diagnosis_result(user_data, diagnosis_result, responses):
     finally:
         db.close()
 
+def save_diagnosis_rows(rows):
+    """build_diagnosis_row() で作成した複数行を1回のコミットでまとめて保存"""
+    if not rows:
+        return 0
+    db = open_session()
+    try:
+        with span("db.connect"):
+            db.connection()
+        with span("db.insert", rows=len(rows)):
+            db.execute(insert(DiagnosisResult), rows)
+            if ROLLUPS_ENABLED:
+                _update_rollups(db, rows)
+        with span("db.commit"):
+            db.commit()
+        return len(rows)
+    except Exception as e:
+        db.rollback()
+        raise e
+    finally:
+        db.close()
+
 def get_diagnosis_history(limit=100):
     """診断履歴を取得"""
-    db = SessionLocal()
+    db = open_session()
     try:
         results = db.query(DiagnosisResult).order_by(DiagnosisResult.timestamp.desc()).limit(limit).all()
         return results
     finally:
         db.close()
 
-def get_diagnosis_stats():
-    """診断統計を取得"""
-    db = SessionLocal()
+# 管理画面の履歴表示用の軽量レコード（JSONB 列を含まない）
+HistoryRow = namedtuple('HistoryRow', ['id', 'timestamp', 'age', 'gender', 'constitution_type', 'free_text_concern'])
+HISTORY_CONCERN_LENGTH = 50
+
+def get_diagnosis_history_page(limit=50, cursor=None, constitution_type=None, age=None, gender=None):
+    """診断履歴を新しい順にキーセット方式でページ取得
+    
+    cursor には前ページの戻り値の next_cursor（timestamp, id）を渡す。
+    OFFSET を使わないため、深いページでもインデックスの範囲走査だけで取得できる。
+    表示に必要な列だけを取得し、自由記述は SQL 側で50文字に切り詰める。
+    
+    Returns:
+        tuple: (HistoryRow のリスト, 次ページのカーソル（最終ページなら None）)
+    """
+    concern = DiagnosisResult.free_text_concern
+    truncated_concern = case(
+        (func.length(concern) > HISTORY_CONCERN_LENGTH,
+         func.substr(concern, 1, HISTORY_CONCERN_LENGTH).concat("...")),
+        else_=concern
+    )
+    
+    db = open_session()
     try:
-        total_diagnoses = db.query(DiagnosisResult).count()
-        
-        # 体質タイプ別の統計
-        constitution_stats = db.query(
+        query = select(
+            DiagnosisResult.id,
+            DiagnosisResult.timestamp,
+            DiagnosisResult.age,
+            DiagnosisResult.gender,
             DiagnosisResult.constitution_type,
-            db.func.count(DiagnosisResult.constitution_type).label('count')
-        ).group_by(DiagnosisResult.constitution_type).all()
+            truncated_concern
+        )
+        if constitution_type:
+            query = query.where(DiagnosisResult.constitution_type == constitution_type)
+        if age:
+            query = query.where(DiagnosisResult.age == age)
+        if gender:
+            query = query.where(DiagnosisResult.gender == gender)
+        if cursor is not None:
+            query = query.where(tuple_(DiagnosisResult.timestamp, DiagnosisResult.id) < tuple_(*cursor))
+        query = query.order_by(DiagnosisResult.timestamp.desc(), DiagnosisResult.id.desc()).limit(limit + 1)
         
-        # 年齢別の統計
-        age_stats = db.query(
-            DiagnosisResult.age,
-            db.func.count(DiagnosisResult.age).label('count')
-        ).group_by(DiagnosisResult.age).all()
+        results = [HistoryRow(*row) for row in db.execute(query)]
+        next_cursor = None
+        if len(results) > limit:
+            results = results[:limit]
+            next_cursor = (results[-1].timestamp, results[-1].id)
+        return results, next_cursor
+    finally:
+        db.close()
+
+def iter_diagnosis_chunks(columns, start_date=None, end_date=None, constitution_type=None, chunk_size=1000):
+    """診断結果を指定列だけサーバーサイドカーソルでチャンク単位に取得（エクスポート用）
+    
+    全件をメモリに載せずに chunk_size 行ずつのリストを順に返す。
+    start_date / end_date は日付（両端を含む）で指定する。
+    """
+    query = select(*[getattr(DiagnosisResult, name) for name in columns])
+    if start_date:
+        query = query.where(DiagnosisResult.timestamp >= datetime.combine(start_date, datetime.min.time()))
+    if end_date:
+        query = query.where(DiagnosisResult.timestamp < datetime.combine(end_date + timedelta(days=1), datetime.min.time()))
+    if constitution_type:
+        query = query.where(DiagnosisResult.constitution_type == constitution_type)
+    query = query.order_by(DiagnosisResult.timestamp, DiagnosisResult.id)
+    
+    db = open_session()
+    try:
+        result = db.execute(query.execution_options(yield_per=chunk_size))
+        for partition in result.partitions():
+            yield partition
+    finally:
+        db.close()
+
+def _update_rollups(db, rows):
+    """保存する行の件数をロールアップテーブルに加算（同じトランザクション内で実行）"""
+    counts = Counter(
+        (row['timestamp'].date(), row['constitution_type'] or '', row['age'] or '', row['gender'] or '')
+        for row in rows
+    )
+    # キー順に更新してトランザクション間のデッドロックを避ける
+    values = [
+        {'day': day, 'constitution_type': constitution_type, 'age': age, 'gender': gender, 'diagnosis_count': count}
+        for (day, constitution_type, age, gender), count in sorted(counts.items())
+    ]
+    dialect_insert = sqlite_insert if db.get_bind().dialect.name == 'sqlite' else pg_insert
+    stmt = dialect_insert(DiagnosisRollup).values(values)
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=['day', 'constitution_type', 'age', 'gender'],
+        set_={'diagnosis_count': DiagnosisRollup.diagnosis_count + stmt.excluded.diagnosis_count}
+    ))
+
+def rebuild_rollups():
+    """diagnosis_results 全体からロールアップテーブルを作り直す"""
+    db = open_session()
+    try:
+        day = func.date(DiagnosisResult.timestamp)
+        db.execute(delete(DiagnosisRollup))
+        db.execute(insert(DiagnosisRollup).from_select(
+            ['day', 'constitution_type', 'age', 'gender', 'diagnosis_count'],
+            select(
+                day,
+                func.coalesce(DiagnosisResult.constitution_type, ''),
+                func.coalesce(DiagnosisResult.age, ''),
+                func.coalesce(DiagnosisResult.gender, ''),
+                func.count()
+            ).group_by(
+                day,
+                func.coalesce(DiagnosisResult.constitution_type, ''),
+                func.coalesce(DiagnosisResult.age, ''),
+                func.coalesce(DiagnosisResult.gender, '')
+            )
+        ))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise e
+    finally:
+        db.close()
+
+ConstitutionCount = namedtuple('ConstitutionCount', ['constitution_type', 'count'])
+AgeCount = namedtuple('AgeCount', ['age', 'count'])
+GenderCount = namedtuple('GenderCount', ['gender', 'count'])
+
+def get_diagnosis_stats():
+    """診断統計を取得（GROUPING SETS による1回のクエリで全集計を取得）"""
+    db = open_session()
+    try:
+        if ROLLUPS_ENABLED:
+            # ロールアップテーブルはバケット数に比例したコストで集計できる
+            source = DiagnosisRollup
+            count = func.sum(DiagnosisRollup.diagnosis_count)
+        else:
+            source = DiagnosisResult
+            count = func.count()
         
-        # 性別統計
-        gender_stats = db.query(
-            DiagnosisResult.gender,
-            db.func.count(DiagnosisResult.gender).label('count')
-        ).group_by(DiagnosisResult.gender).all()
+        # ロールアップの主キーは NULL を持てず '' で保存するため、集計元によらず NULL は '' として数える
+        constitution_type, age, gender = (
+            func.coalesce(column, '') for column in (source.constitution_type, source.age, source.gender)
+        )
+        # GROUPING() のビット: 体質タイプ=4, 年齢=2, 性別=1（集約された列のビットが立つ）
+        if db.get_bind().dialect.name == 'sqlite':
+            # SQLite は GROUPING SETS 非対応のため、同じ形の結果を UNION ALL で組み立てる
+            columns = {'constitution_type': constitution_type, 'age': age, 'gender': gender}
+            def grouped(grouping_id, name=None):
+                return select(
+                    literal(grouping_id).label('grouping_id'),
+                    *[(column if key == name else null()).label(key) for key, column in columns.items()],
+                    count.label('count')
+                ).select_from(source).group_by(*([columns[name]] if name else []))
+            query = union_all(
+                grouped(0b011, 'constitution_type'), grouped(0b101, 'age'),
+                grouped(0b110, 'gender'), grouped(0b111)
+            )
+        else:
+            query = select(
+                func.grouping(constitution_type, age, gender).label('grouping_id'),
+                constitution_type.label('constitution_type'), age.label('age'), gender.label('gender'),
+                count.label('count')
+            ).group_by(func.grouping_sets(
+                tuple_(constitution_type), tuple_(age), tuple_(gender), tuple_()
+            ))
+        rows = db.execute(query).all()
+        
+        total_diagnoses = 0
+        constitution_stats, age_stats, gender_stats = [], [], []
+        for row in rows:
+            if row.grouping_id == 0b011:
+                constitution_stats.append(ConstitutionCount(row.constitution_type, row.count))
+            elif row.grouping_id == 0b101:
+                age_stats.append(AgeCount(row.age, row.count))
+            elif row.grouping_id == 0b110:
+                gender_stats.append(GenderCount(row.gender, row.count))
+            elif row.grouping_id == 0b111:
+                total_diagnoses = row.count or 0
         
         return {
             'total_diagnoses': total_diagnoses,
@@ -125,5 +542,16 @@ def get_diagnosis_stats():
     finally:
         db.close()
 
-# データベーステーブルを初期化
-create_tables()
\ No newline at end of file
+if __name__ == "__main__":
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="データベースの管理コマンド")
+    parser.add_argument("command", choices=["migrate", "rebuild-rollups"])
+    args = parser.parse_args()
+    
+    if args.command == "migrate":
+        create_tables()
+        print("schema is up to date")
+    elif args.command == "rebuild-rollups":
+        rebuild_rollups()
+        print("diagnosis_rollups rebuilt")
@@ -1,91 +1,126 @@
+import copy
+import hashlib
+import json
+import os
 import random
-from tcm_data import CONSTITUTION_TYPES
+import threading
+from types import MappingProxyType
+import numpy as np
+from tcm_data import CONSTITUTION_TYPES, TCM_QUESTIONS
+from scoring_index import ScoringIndex
+from keyword_matcher import KeywordMatcher
+from score_cache import ScoreCache
+from score_table import load_or_build
+from instrumentation import span
+from rule_sets import RULES_FILE, RELOAD_SECONDS, RuleWatcher, RuleSetError, default_rule_set, load_rule_set, rule_set_digest
+
+# 信頼度の微調整モード
+#   random:      毎回ランダムに ±3 の範囲で調整（従来の動作）
+#   fingerprint: 正規化した回答のハッシュから ±3 の調整値を決定（同じ回答なら同じ結果）
+#   off:         調整しない
+JITTER_MODES = ("random", "fingerprint", "off")
+
+
+def _freeze(value):
+    """ネストした dict/list を読み取り専用の構造に変換"""
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def normalize_responses(responses):
+    """回答を比較・ハッシュ用に正規化（前後の空白除去、フォローアップ選択肢の並び替え）"""
+    normalized = {}
+    for key, value in responses.items():
+        if isinstance(value, str):
+            value = value.strip()
+            if "follow_up" in key:
+                value = ", ".join(sorted(item.strip() for item in value.split(',')))
+        normalized[str(key)] = value
+    return normalized
+
+
+def responses_digest(responses, seed=None):
+    """正規化した回答の 64bit ダイジェスト（seed を指定すると鍵付きハッシュ）"""
+    payload = json.dumps(
+        normalize_responses(responses), ensure_ascii=False, sort_keys=True, separators=(",", ":")
+    ).encode("utf-8")
+    key = str(seed).encode("utf-8") if seed is not None else b""
+    return hashlib.blake2b(payload, digest_size=8, key=key).digest()
+
 
 class DiagnosisEngine:
     """東洋医学体質診断エンジン（新しい問診フォーマット対応）"""
     
-    def __init__(self):
-        # 各体質タイプに対する診断ロジック（TCM専門文書に基づく）
-        self.diagnosis_rules = {
-            "気虚": {
-                "primary_questions": {
-                    "疲れやすいと感じますか？": 4,  # 主症状
-                    "食欲がない、軟便になりやすいですか？": 3,  # 脾胃気虚
-                    "風邪をひきやすい、肌が乾燥しやすいですか？": 3,  # 肺気虚
-                    "下半身が冷えやすい、足腰がだるくなることがありますか？": 3  # 腎陽虚
-                },
-                "follow_up_symptoms": {
-                    # 質問1のフォローアップ
-                    "朝から": 2, "食後に": 3, "夕方以降": 2,
-                    "息切れしやすい": 3, "声に力がない": 3, "食後に眠くなる": 3,
-                    # 質問7のフォローアップ
-                    "動悸がする": 2,
-                    # 質問8のフォローアップ  
-                    "食欲がない、または食べたくないことがよくある": 3,
-                    "下痢・軟便になりやすい": 2, "食後すぐにお腹がもたれる": 2,
-                    # 質問9のフォローアップ
-                    "鼻水や鼻づまり": 2,
-                    # 質問10のフォローアップ
-                    "頻尿・夜間尿がある": 3, "足腰のだるさがある": 3, "耳鳴り・聴力低下がある": 2
-                }
-            },
-            "気滞": {
-                "primary_questions": {
-                    "イライラしやすい、胸やお腹がつかえる感じはありますか？": 4,  # 主症状
-                    "感情の波が激しい、目の疲れやすさはありますか？": 3,  # 肝気鬱結
-                    "不安感が強い、睡眠の不調を感じますか？": 2  # 肝鬱による
-                },
-                "follow_up_symptoms": {
-                    # 質問2のフォローアップ
-                    "ため息をよくつく": 3, "月経前に不調がある": 3, "胸や喉に違和感": 3,
-                    # 質問6のフォローアップ
-                    "怒りっぽい": 4, "月経不順": 3
-                }
-            },
-            "水滞": {
-                "primary_questions": {
-                    "むくみやすい、胃がぽちゃぽちゃすることはありますか？": 4,  # 主症状
-                    "食欲がない、軟便になりやすいですか？": 2  # 脾虚湿盛
-                },
-                "follow_up_symptoms": {
-                    # 質問5のフォローアップ
-                    "雨の日に体調が悪い": 3, "下痢や軟便になりやすい": 3, "舌に歯型がある": 3,
-                    # 質問8のフォローアップ
-                    "下痢・軟便になりやすい": 2,
-                    # 質問9のフォローアップ
-                    "鼻水や鼻づまり": 2
-                }
-            },
-            "血虚": {
-                "primary_questions": {
-                    "顔色が青白い、めまいがしやすいですか？": 4,  # 主症状
-                    "不安感が強い、睡眠の不調を感じますか？": 3,  # 心血虚
-                    "感情の波が激しい、目の疲れやすさはありますか？": 2,  # 肝血虚
-                    "風邪をひきやすい、肌が乾燥しやすいですか？": 2  # 血燥
-                },
-                "follow_up_symptoms": {
-                    # 質問3のフォローアップ
-                    "爪が割れやすい": 3, "動悸がある": 3, "夢をよく見る": 3,
-                    # 質問6のフォローアップ
-                    "目が乾く、かすむ": 3,
-                    # 質問7のフォローアップ
-                    "動悸がする": 2, "眠りが浅い": 3, "多夢": 3,
-                    # 質問9のフォローアップ
-                    "肌が乾燥する": 3, "空咳": 2,
-                    # 質問10のフォローアップ
-                    "耳鳴り・聴力低下がある": 2
-                }
-            },
-            "瘀血": {
-                "primary_questions": {
-                    "肩こりや生理痛がひどいなど、血の巡りが悪いと感じることはありますか？": 4  # 主症状
-                },
-                "follow_up_symptoms": {
-                    # 質問4のフォローアップ
-                    "刺すような痛み": 4, "経血に血塊が多い": 4, "シミやくすみが目立つ": 3
-                }
-            }
-        }
+    def __init__(self, jitter="random", seed=None, cache_size=4096, score_table_dir=None, rules=None,
+                 rule_set=None, reuse=None):
+        """
+        Args:
+            rules: rule_set の重みを部分的に上書きする辞書（重みの候補の評価用）
+            rule_set: rule_sets.load_rule_set() で読み込んだルール（省略時は既定のルールファイル）
+            reuse: 以前のエンジン。ルールが同じ部分のコンパイル結果とキャッシュを引き継ぐ
+        """
+        if jitter not in JITTER_MODES:
+            raise ValueError(f"Unknown jitter mode: {jitter}")
+        self.jitter = jitter
+        self.seed = seed
+        # 構造化回答のフィンガープリント -> 基本スコア（自由記述分を除く）
+        self.score_cache = ScoreCache(cache_size)
+        
+        # 各体質タイプに対する診断ロジック（TCM専門文書に基づく）と自由記述のキーワード表
+        # ルールファイル（rules/*.json）から読み込む。省略時は DIAGNOSIS_RULES_FILE の既定ルール
+        rule_set = copy.deepcopy(rule_set) if rule_set is not None else default_rule_set()
+        self.rule_version = rule_set["version"]
+        self.diagnosis_rules = rule_set["diagnosis_rules"]
+        self.free_text_keywords = rule_set["free_text_keywords"]
+        
+        self.rule_digest = rule_set_digest(rule_set)
+        
+        # 候補の重みセットで上書き（体質タイプ -> {"primary_questions" / "follow_up_symptoms": {テキスト: 重み}}）
+        if rules:
+            self.apply_rule_overrides(rules)
+            self.rule_digest = rule_set_digest(rule_set)
+            self.rule_version = f"{self.rule_version}+{self.rule_digest[:8]}"
+        
+        # 複数スレッド・セッションで共有するため、構築後は読み取り専用にする
+        self.diagnosis_rules = _freeze(self.diagnosis_rules)
+        self.free_text_keywords = _freeze(self.free_text_keywords)
+        
+        # キーワード表から Aho–Corasick オートマトンを事前構築（キーワード表が同じなら以前のものを使う）
+        if reuse is not None and list(reuse.free_text_keywords.items()) == list(self.free_text_keywords.items()):
+            self.keyword_matcher = reuse.keyword_matcher
+        else:
+            self.keyword_matcher = KeywordMatcher(self.free_text_keywords)
+        
+        # 診断ルールを質問・選択肢ごとの重みベクトルへ事前コンパイル
+        self.scoring_index = ScoringIndex(self.diagnosis_rules, TCM_QUESTIONS)
+        self._score_weights, self._max_weights, self._primary_max = self.scoring_index.weight_matrices()
+        self._fingerprint_features = self.scoring_index.fingerprint_feature_matrix()
+        
+        if (reuse is not None and reuse.scoring_index.digest == self.scoring_index.digest
+                and reuse.scoring_index.constitution_types == self.scoring_index.constitution_types):
+            # 重み・質問票・体質タイプの並びが同じなら基本スコア（体質タイプ順のタプル）は変わらないため、
+            # キャッシュとスコアテーブルを引き継ぐ
+            self.score_cache = reuse.score_cache
+            self.score_table = reuse.score_table
+        else:
+            # 構造化回答の事前計算スコアテーブル（保存先を指定した場合のみ読み込み・構築）
+            self.score_table = load_or_build(self, score_table_dir) if score_table_dir else None
+    
+    def apply_rule_overrides(self, rules):
+        """diagnosis_rules の重みを部分的に上書き（構築中のみ使用。未知の体質タイプ・区分は ValueError）"""
+        for constitution_type, sections in rules.items():
+            if constitution_type not in self.diagnosis_rules:
+                raise ValueError(f"Unknown constitution type in rules: {constitution_type}")
+            for section, weights in sections.items():
+                if section not in self.diagnosis_rules[constitution_type]:
+                    raise ValueError(f"Unknown rule section for {constitution_type}: {section}")
+                for text, weight in weights.items():
+                    if not isinstance(weight, int) or isinstance(weight, bool):
+                        raise ValueError(f"Rule weight must be an integer: {constitution_type}/{text}")
+                self.diagnosis_rules[constitution_type][section].update(weights)
     
     def calculate_constitution_score(self, responses, constitution_type):
         """特定の体質タイプのスコアを計算（TCM専門文書に基づく）"""
@@ -125,21 +160,39 @@ class DiagnosisEngine:
             return (score / max_score) * 100
         return 0
     
+    def base_scores(self, responses):
+        """自由記述を除いた体質別スコアを計算（フィンガープリント単位でキャッシュ）"""
+        index = self.scoring_index
+        fingerprint = index.fingerprint(responses)
+        if fingerprint is None:
+            # 想定外の回答形式はキャッシュせずに直接計算
+            return index.scores(responses)
+        
+        scores = self.score_cache.get(fingerprint)
+        if scores is None:
+            if self.score_table is not None:
+                scores = self.score_table.scores(fingerprint)
+            else:
+                scores = index.fingerprint_scores(fingerprint)
+            self.score_cache.put(fingerprint, scores)
+        return dict(zip(index.constitution_types, scores))
+    
     def diagnose(self, responses):
         """体質診断を実行"""
-        constitution_scores = {}
-        
-        # 各体質タイプのスコアを計算
-        for constitution_type in self.diagnosis_rules.keys():
-            score = self.calculate_constitution_score(responses, constitution_type)
-            constitution_scores[constitution_type] = score
+        # 各体質タイプのスコアを計算（コンパイル済みインデックス・キャッシュを使用）
+        constitution_scores = self.base_scores(responses)
         
         # 自由記述質問の分析（簡易版）
-        free_text_analysis = self.analyze_free_text(responses)
+        with span("engine.analyze_free_text"):
+            free_text_analysis = self.analyze_free_text(responses)
         for constitution_type, additional_score in free_text_analysis.items():
             if constitution_type in constitution_scores:
                 constitution_scores[constitution_type] += additional_score
         
+        return self.result_from_scores(constitution_scores, responses)
+    
+    def result_from_scores(self, constitution_scores, responses):
+        """体質別スコア（自由記述の加点込み）から診断結果（最高スコアの体質・信頼度）を作成"""
         # 最高スコアの体質タイプを特定
         if constitution_scores:
             best_constitution = max(constitution_scores, key=constitution_scores.get)
@@ -157,42 +210,220 @@ class DiagnosisEngine:
             confidence = 75
         
         # AI風のランダム要素を少し追加（信頼度の微調整）
-        confidence += random.uniform(-3, 3)
-        confidence = max(65, min(95, confidence))
+        confidence += self.confidence_jitter(responses)
+        confidence = float(max(65, min(95, confidence)))
         
         return {
             "constitution_type": best_constitution,
             "score": best_score,
             "confidence": confidence,
-            "all_scores": constitution_scores
+            "all_scores": constitution_scores,
+            "rule_version": self.rule_version
         }
     
-    def analyze_free_text(self, responses):
-        """自由記述質問の分析"""
-        analysis_result = {"気虚": 0, "気滞": 0, "水滞": 0, "血虚": 0, "瘀血": 0}
+    def confidence_jitter(self, responses):
+        """信頼度の微調整値（-3 〜 +3）を jitter モードに従って求める"""
+        if self.jitter == "random":
+            return random.uniform(-3, 3)
+        if self.jitter == "fingerprint":
+            unit = int.from_bytes(responses_digest(responses, self.seed), "big") / 2 ** 64
+            return -3 + 6 * unit
+        return 0.0
+    
+    def score_batch(self, responses_list):
+        """複数の回答をまとめてスコアリング（numpy によるベクトル化）
         
-        # 質問11の自由記述を取得
-        free_text = ""
+        回答を特徴量行列へ変換し、重み行列との行列積で全体質のスコアを一度に計算する。
+        jitter が "fingerprint" または "off" の場合、結果は diagnose() と完全に一致する。
+        
+        Returns:
+            dict: best_index（最高スコアの体質番号）、score、confidence、
+                  all_scores（行 x 体質タイプ）の numpy 配列
+        """
+        count = len(responses_list)
+        answers, free_text_scores = self.encode_batch(responses_list)
+        
+        # 全体質のスコアを行列積で計算して正規化（0-100）
+        score = answers @ self._score_weights
+        max_score = self._primary_max + answers @ self._max_weights
+        normalized = np.zeros_like(score)
+        np.divide(score, max_score, out=normalized, where=max_score > 0)
+        all_scores = normalized * 100 + free_text_scores
+        
+        best_index = np.argmax(all_scores, axis=1)
+        best_score = all_scores[np.arange(count), best_index]
+        
+        # 信頼度（最高スコアと2番目のスコアの差）
+        sorted_scores = np.sort(all_scores, axis=1)
+        top, second = sorted_scores[:, -1], sorted_scores[:, -2]
+        confidence = np.where(top > 0, np.minimum(95, 60 + (top - second) * 0.5), 75.0)
+        if self.jitter == "random":
+            confidence = confidence + np.random.uniform(-3, 3, size=count)
+        elif self.jitter == "fingerprint":
+            confidence = confidence + np.array(
+                [self.confidence_jitter(responses) for responses in responses_list], dtype=np.float64
+            )
+        confidence = np.maximum(65, np.minimum(95, confidence))
+        
+        return {
+            "best_index": best_index,
+            "score": best_score,
+            "confidence": confidence,
+            "all_scores": all_scores
+        }
+    
+    def encode_batch(self, responses_list):
+        """回答を (特徴量の出現回数行列, 自由記述の加点行列) へエンコード
+        
+        いずれも float64 で、形状はそれぞれ (件数, 特徴量数)、(件数, 体質タイプ数)。
+        重みを変えて何度もスコアリングする場合（重みの感度分析など）は一度だけエンコードすればよい。
+        
+        構造化回答は1件ずつフィンガープリント（整数）にするだけで、特徴量への展開は変換行列との行列積で
+        まとめて行う（フィンガープリントを持たない回答のみ features() で個別に展開する）。
+        自由記述は同じテキストを1回だけ、キーワードごとに全テキストをまとめて照合する。
+        """
+        index = self.scoring_index
+        types = index.constitution_types
+        count = len(responses_list)
+        feature_count = index.feature_count
+        
+        fingerprints = [index.fingerprint(responses) for responses in responses_list]
+        rows = [row for row, fingerprint in enumerate(fingerprints) if fingerprint is not None]
+        answers = np.zeros((count, feature_count), dtype=np.float64)
+        if rows:
+            bits = index.fingerprint_bits([fingerprints[row] for row in rows])
+            answers[rows] = bits @ self._fingerprint_features
+        for row in (row for row, fingerprint in enumerate(fingerprints) if fingerprint is None):
+            answers[row] = np.bincount(
+                np.asarray(index.features(responses_list[row]), dtype=np.int64), minlength=feature_count
+            )
+        
+        # 自由記述の加点（analyze_free_text() と同じく、出現したキーワードの種類数 x 2、最大10点）
+        text_ids = {}
+        text_rows = np.fromiter(
+            (text_ids.setdefault(self.extract_free_text(responses), len(text_ids)) for responses in responses_list),
+            dtype=np.intp, count=count
+        )
+        counts = self.keyword_matcher.count_matrix(list(text_ids), types)
+        free_text_scores = np.minimum(counts * 2, 10)[text_rows]
+        return answers, free_text_scores
+    
+    def diagnose_batch(self, responses_list):
+        """複数の回答をまとめて診断し、diagnose() と同じ形式の結果リストを返す"""
+        types = self.scoring_index.constitution_types
+        batch = self.score_batch(responses_list)
+        return [
+            {
+                "constitution_type": types[best_index],
+                "score": score,
+                "confidence": confidence,
+                "all_scores": dict(zip(types, all_scores)),
+                "rule_version": self.rule_version
+            }
+            for best_index, score, confidence, all_scores in zip(
+                batch["best_index"].tolist(),
+                batch["score"].tolist(),
+                batch["confidence"].tolist(),
+                batch["all_scores"].tolist()
+            )
+        ]
+    
+    def extract_free_text(self, responses):
+        """質問11の自由記述を取得（小文字化済み）"""
         for key, value in responses.items():
             if "question_10" in key and not "_question" in key and value:
-                free_text = value.lower()
-                break
+                return value.lower()
+        return ""
+    
+    def free_text_hits(self, responses):
+        """自由記述中のキーワードを体質タイプ別に検出（件数と出現位置）"""
+        return self.keyword_matcher.match(self.extract_free_text(responses))
+    
+    def analyze_free_text(self, responses):
+        """自由記述質問の分析"""
+        analysis_result = dict.fromkeys(self.diagnosis_rules, 0)
         
+        # 質問11の自由記述を取得
+        free_text = self.extract_free_text(responses)
         if not free_text:
             return analysis_result
         
-        # キーワードベースの簡易分析
-        keywords = {
-            "気虚": ["疲れ", "だるい", "疲労", "息切れ", "食欲", "下痢", "軟便", "冷え"],
-            "気滞": ["イライラ", "ストレス", "憂鬱", "胸", "つかえ", "ため息", "生理前"],
-            "水滞": ["むくみ", "浮腫", "重い", "だるい", "雨", "湿気", "胃", "ぽちゃぽちゃ"],
-            "血虚": ["めまい", "立ちくらみ", "動悸", "不眠", "爪", "肌", "乾燥", "白い"],
-            "瘀血": ["痛み", "こり", "生理痛", "血塊", "しみ", "あざ", "刺す", "固定"]
-        }
-        
-        for constitution_type, keyword_list in keywords.items():
-            matches = sum(1 for keyword in keyword_list if keyword in free_text)
+        # キーワードベースの簡易分析（1回の走査で全キーワードを検出）
+        for constitution_type, hits in self.keyword_matcher.match(free_text).items():
+            matches = hits["count"]
             if matches > 0:
                 analysis_result[constitution_type] = min(matches * 2, 10)  # 最大10点
         
-        return analysis_result
\ No newline at end of file
+        return analysis_result
+
+_default_engine = None
+_default_engine_lock = threading.Lock()
+_rule_watcher = None
+_reload_lock = threading.Lock()
+
+
+def _build_default_engine(rule_set=None, reuse=None):
+    return DiagnosisEngine(
+        jitter=os.getenv("DIAGNOSIS_JITTER", "random"),
+        seed=os.getenv("DIAGNOSIS_JITTER_SEED"),
+        score_table_dir=os.getenv("DIAGNOSIS_SCORE_TABLE_DIR", "data"),
+        rule_set=rule_set,
+        reuse=reuse
+    )
+
+
+def get_engine():
+    """プロセス全体で共有する読み取り専用の診断エンジンを取得（初回のみ構築）
+    
+    信頼度の微調整モードは環境変数 DIAGNOSIS_JITTER（random / fingerprint / off）、
+    fingerprint モードの鍵は DIAGNOSIS_JITTER_SEED、事前計算スコアテーブルの保存先は
+    DIAGNOSIS_SCORE_TABLE_DIR で指定できる。
+    
+    ルールファイル（DIAGNOSIS_RULES_FILE）の更新は DIAGNOSIS_RULES_RELOAD_SECONDS ごとに確認し、
+    reload_engine() で新しいエンジンに差し替える。呼び出し側は1回のリクエストの間は
+    同じエンジンを使うこと（処理中のリクエストは差し替え前のエンジンで完了する）。
+    """
+    global _default_engine, _rule_watcher
+    if _default_engine is None:
+        with _default_engine_lock:
+            if _default_engine is None:
+                _default_engine = _build_default_engine()
+                _rule_watcher = RuleWatcher(reload_engine, RULES_FILE, RELOAD_SECONDS).start()
+    return _default_engine
+
+
+def reload_engine(path=None):
+    """ルールファイルを読み込み直し、構築した新しいエンジンに差し替える
+    
+    検証・コンパイル（スコアテーブルの構築を含む）は呼び出したスレッドで行い、完了してから
+    参照を入れ替える。ルールが変わらない部分のコンパイル結果とキャッシュは引き継ぐ。
+    
+    Returns:
+        DiagnosisEngine: 差し替え後のエンジン（内容が同じ場合は現在のエンジン）
+    """
+    global _default_engine
+    with _reload_lock:
+        current = get_engine()
+        rule_set = load_rule_set(path or RULES_FILE)
+        if rule_set_digest(rule_set) == current.rule_digest:
+            return current
+        if rule_set["version"] == current.rule_version:
+            raise RuleSetError(f"Rules changed but the version is still {rule_set['version']}")
+        
+        engine = _build_default_engine(rule_set, reuse=current)
+        with _default_engine_lock:
+            _default_engine = engine
+        if _rule_watcher:
+            _rule_watcher.last_error = None
+        return engine
+
+
+def rule_status():
+    """現在のルールのバージョンと、直近の再読み込みのエラー（管理画面用）"""
+    engine = get_engine()
+    return {
+        "rule_version": engine.rule_version,
+        "rule_digest": engine.rule_digest[:16],
+        "rules_file": RULES_FILE,
+        "last_reload_error": _rule_watcher.last_error if _rule_watcher else None,
+    }
@@ -0,0 +1,128 @@
+"""診断履歴のストリーミングエクスポート（CSV / Parquet）
+
+サーバーサイドカーソルでチャンクごとに読み込み、そのまま書き出すため、
+行数に関係なくメモリ使用量は一定に保たれる。
+responses 列は保存形式（response_codec のコンパクト形式）のまま出力する。
+従来形式の辞書へは response_codec.decode_responses() で戻せる（bulk_score.py は両方を受け付ける）。
+
+使い方:
+    python export.py --format csv --output history.csv [--start 2025-01-01] [--end 2025-12-31] [--constitution 気虚]
+    python export.py --format parquet --output history.parquet
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import tempfile
+from datetime import date
+
+from database import iter_diagnosis_chunks
+
+EXPORT_COLUMNS = [
+    "id", "timestamp", "age", "gender", "constitution_type", "score", "confidence",
+    "free_text_concern", "all_scores", "responses", "rule_version"
+]
+JSON_COLUMNS = {"all_scores", "responses"}
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def _to_json(value):
+    return json.dumps(value, ensure_ascii=False) if value is not None else None
+
+
+def export_csv(out, chunk_size=DEFAULT_CHUNK_SIZE, **filters):
+    """CSV をファイルオブジェクト（テキストモード）に書き出し、行数を返す"""
+    writer = csv.writer(out)
+    writer.writerow(EXPORT_COLUMNS)
+    json_positions = [i for i, name in enumerate(EXPORT_COLUMNS) if name in JSON_COLUMNS]
+    timestamp_position = EXPORT_COLUMNS.index("timestamp")
+    count = 0
+    for chunk in iter_diagnosis_chunks(EXPORT_COLUMNS, chunk_size=chunk_size, **filters):
+        rows = []
+        for row in chunk:
+            values = list(row)
+            timestamp = values[timestamp_position]
+            values[timestamp_position] = timestamp.isoformat(sep=" ") if timestamp else ""
+            for i in json_positions:
+                values[i] = _to_json(values[i])
+            rows.append(values)
+        writer.writerows(rows)
+        count += len(rows)
+    return count
+
+
+def export_parquet(out, chunk_size=DEFAULT_CHUNK_SIZE, **filters):
+    """Parquet をパスまたはバイナリファイルに書き出し、行数を返す（チャンクごとに1行グループ）"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise RuntimeError("Parquet export requires the pyarrow package") from e
+
+    schema = pa.schema([
+        ("id", pa.int64()),
+        ("timestamp", pa.timestamp("us")),
+        ("age", pa.string()),
+        ("gender", pa.string()),
+        ("constitution_type", pa.string()),
+        ("score", pa.float64()),
+        ("confidence", pa.float64()),
+        ("free_text_concern", pa.string()),
+        ("all_scores", pa.string()),
+        ("responses", pa.string()),
+        ("rule_version", pa.string()),
+    ])
+    count = 0
+    with pq.ParquetWriter(out, schema) as writer:
+        for chunk in iter_diagnosis_chunks(EXPORT_COLUMNS, chunk_size=chunk_size, **filters):
+            columns = list(zip(*chunk))
+            arrays = [
+                [_to_json(v) for v in values] if name in JSON_COLUMNS else list(values)
+                for name, values in zip(EXPORT_COLUMNS, columns)
+            ]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            count += len(chunk)
+    return count
+
+
+def export_data(export_format, chunk_size=DEFAULT_CHUNK_SIZE, **filters):
+    """一時ファイルに書き出して内容を返す（管理画面のダウンロード用。一時ファイルは必ず削除する）"""
+    fd, path = tempfile.mkstemp(suffix=f".{export_format}")
+    try:
+        if export_format == "csv":
+            with open(fd, "w", encoding="utf-8", newline="") as f:
+                export_csv(f, chunk_size=chunk_size, **filters)
+        else:
+            os.close(fd)
+            export_parquet(path, chunk_size=chunk_size, **filters)
+        with open(path, "rb") as f:
+            return f.read()
+    finally:
+        os.remove(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="診断履歴をストリーミングでエクスポート")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--output", required=True, help="出力ファイル（CSV は - で標準出力）")
+    parser.add_argument("--start", type=date.fromisoformat, help="開始日（YYYY-MM-DD、当日を含む）")
+    parser.add_argument("--end", type=date.fromisoformat, help="終了日（YYYY-MM-DD、当日を含む）")
+    parser.add_argument("--constitution", help="体質タイプで絞り込み")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    filters = {"start_date": args.start, "end_date": args.end, "constitution_type": args.constitution}
+    if args.format == "csv":
+        if args.output == "-":
+            count = export_csv(sys.stdout, chunk_size=args.chunk_size, **filters)
+        else:
+            with open(args.output, "w", encoding="utf-8", newline="") as f:
+                count = export_csv(f, chunk_size=args.chunk_size, **filters)
+    else:
+        count = export_parquet(args.output, chunk_size=args.chunk_size, **filters)
+    print(f"{count} rows exported", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""回答の変更に合わせた逐次スコアリング
+
+質問票への回答を1項目ずつ反映しながら、体質別の (得点, 満点) を差分で更新する。
+ScoringIndex の質問ごとの重みベクトル（question_weights）とフォローアップ選択肢ごとの
+重みベクトル（option_weights）を加減算するだけなので、1回の更新は回答全体の大きさに依存しない。
+回答の途中経過（ライブプレビュー）の表示に使う。
+
+最終結果は result() で求める。得点・満点は整数の重みの和で保持しているため、
+DiagnosisEngine.diagnose(scorer.responses()) と完全に一致する（jitter が "random" の場合の信頼度を除く）。
+"""
+from scoring_index import NONE_OPTION, YES_ANSWER
+
+
+class IncrementalScorer:
+    """回答の状態と体質別の (得点, 満点) を保持し、回答の変更を差分で反映する
+
+    初期状態は app.py の入力欄と同じ（各質問は最初の選択肢、フォローアップは未選択、自由記述は空）。
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.index = engine.scoring_index
+        self.questions = self.index.questions
+        size = len(self.index.constitution_types)
+        self._score = [0] * size
+        self._max_score = list(self.index.primary_max)
+
+        self._answers = []
+        self._selected = []  # 質問 i -> フォローアップ j ごとの選択済み選択肢番号の集合
+        self._follow_up_weights = []  # 質問 i -> フォローアップ j ごとの選択済み選択肢の重みの和
+        self._free_text = {}
+        self._free_text_scores = {}
+        for i, question_data in enumerate(self.questions):
+            follow_ups = question_data.get("follow_up_questions", [])
+            self._selected.append([set() for _ in follow_ups])
+            self._follow_up_weights.append([[0] * size for _ in follow_ups])
+            self._answers.append(None)
+            if question_data.get("type") == "free_text":
+                self._free_text[i] = ""
+            else:
+                self.set_answer(i, question_data["options"][0])
+
+    @classmethod
+    def from_responses(cls, engine, responses):
+        """app.py 形式の回答の辞書から状態を作成
+
+        「はい」以外の質問のフォローアップは app.py と同様に回答に含まれない前提で扱う。
+        """
+        scorer = cls(engine)
+        for i, question_data in enumerate(scorer.questions):
+            answer = responses.get(f"question_{i}")
+            if question_data.get("type") == "free_text":
+                scorer.set_free_text(i, answer or "")
+                continue
+            if answer is not None:
+                scorer.set_answer(i, answer)
+            for j, follow_up in enumerate(question_data.get("follow_up_questions", [])):
+                value = responses.get(f"question_{i}_follow_up_{j}")
+                items = {item.strip() for item in value.split(",")} if value else set()
+                for k, option in enumerate(follow_up["options"]):
+                    scorer.set_option(i, j, k, option in items)
+        return scorer
+
+    def _add(self, weights, sign, to_max=False):
+        self._score = [a + sign * b for a, b in zip(self._score, weights)]
+        if to_max:
+            self._max_score = [a + sign * b for a, b in zip(self._max_score, weights)]
+
+    def _follow_up_active(self, i, j):
+        """フォローアップの重みがスコアに含まれるか（「どれも当てはまらない」のみの場合は含まれない）"""
+        selected = self._selected[i][j]
+        if not selected:
+            return False
+        options = self.questions[i]["follow_up_questions"][j]["options"]
+        return not (len(selected) == 1 and options[next(iter(selected))] == NONE_OPTION)
+
+    def set_answer(self, i, answer):
+        """質問 i の回答を変更（「はい」以外ではフォローアップの選択は保持したままスコアから除く）"""
+        previous = self._answers[i]
+        if previous == answer:
+            return
+        was_yes, is_yes = previous == YES_ANSWER, answer == YES_ANSWER
+        self._answers[i] = answer
+        if was_yes == is_yes:
+            return
+        sign = 1 if is_yes else -1
+        self._add(self.index.question_weights[i], sign)
+        for j, weights in enumerate(self._follow_up_weights[i]):
+            if self._follow_up_active(i, j):
+                self._add(weights, sign, to_max=True)
+
+    def set_option(self, i, j, k, checked):
+        """質問 i のフォローアップ j の選択肢 k のチェックを変更"""
+        selected = self._selected[i][j]
+        if (k in selected) == checked:
+            return
+        counted = self._answers[i] == YES_ANSWER
+        if counted and self._follow_up_active(i, j):
+            self._add(self._follow_up_weights[i][j], -1, to_max=True)
+
+        option_weights = self.index.option_weights[i][j][k]
+        sign = 1 if checked else -1
+        self._follow_up_weights[i][j] = [a + sign * b for a, b in zip(self._follow_up_weights[i][j], option_weights)]
+        if checked:
+            selected.add(k)
+        else:
+            selected.discard(k)
+
+        if counted and self._follow_up_active(i, j):
+            self._add(self._follow_up_weights[i][j], 1, to_max=True)
+
+    def set_free_text(self, i, text):
+        """自由記述の質問 i の回答を変更（キーワードの加点は文字数に比例した時間で再計算）"""
+        if self._free_text.get(i) == text:
+            return
+        self._free_text[i] = text
+        self._free_text_scores = self.engine.analyze_free_text(
+            {f"question_{n}": value for n, value in self._free_text.items()}
+        )
+
+    def base_scores(self):
+        """自由記述を除いた体質別の正規化スコア（DiagnosisEngine.base_scores と同じ値）"""
+        return dict(zip(self.index.constitution_types, self.index.normalize(self._score, self._max_score)))
+
+    def scores(self):
+        """自由記述の加点を含む体質別スコア（diagnose() の all_scores と同じ値）"""
+        constitution_scores = self.base_scores()
+        for constitution_type, additional_score in self._free_text_scores.items():
+            if constitution_type in constitution_scores:
+                constitution_scores[constitution_type] += additional_score
+        return constitution_scores
+
+    def responses(self):
+        """現在の状態を app.py 形式の回答の辞書に変換（collect_responses() と同じ内容）"""
+        responses = {}
+        for i, question_data in enumerate(self.questions):
+            if question_data.get("type") == "free_text":
+                responses[f"question_{i}"] = self._free_text[i]
+                responses[f"question_{i}_question"] = question_data["question"]
+                continue
+            responses[f"question_{i}"] = self._answers[i]
+            responses[f"question_{i}_question"] = question_data["question"]
+            if self._answers[i] == YES_ANSWER:
+                for j, follow_up in enumerate(question_data.get("follow_up_questions", [])):
+                    selected = [option for k, option in enumerate(follow_up["options"]) if k in self._selected[i][j]]
+                    responses[f"question_{i}_follow_up_{j}"] = ", ".join(selected) if selected else NONE_OPTION
+        return responses
+
+    def result(self):
+        """現在の回答での診断結果（diagnose() と同じ形式）"""
+        return self.engine.result_from_scores(self.scores(), self.responses())
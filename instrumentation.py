@@ -0,0 +1,185 @@
+"""診断リクエストの処理段階ごとの計測
+
+処理段階（回答の収集、診断、自由記述の分析、保存など）を span() で囲むと、所要時間が
+段階別のヒストグラムに記録される。集計結果は Prometheus のテキスト形式
+（prometheus_text()）または辞書（snapshot()）で取り出せる。
+
+環境変数:
+    DIAGNOSIS_SPAN_LOG=1                 span ごとに JSON 形式のログを出力する
+    DIAGNOSIS_PROFILE_SAMPLE_RATE=0.01   profiled() で囲んだ処理をこの割合で cProfile にかける
+    DIAGNOSIS_PROFILE_DIR=data/profiles  プロファイル（pstats 形式）の保存先
+
+プロファイルの設定は呼び出しのたびに読み込むため、再デプロイせずに切り替えられる。
+"""
+import bisect
+import cProfile
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# ヒストグラムのバケット上限（ミリ秒）
+BUCKETS_MS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+SPAN_LOG = os.getenv('DIAGNOSIS_SPAN_LOG', '').strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+class Histogram:
+    """固定バケットのヒストグラム（スレッドセーフ）"""
+
+    def __init__(self, buckets=BUCKETS_MS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # 最後は上限なし（+Inf）
+        self.count = 0
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value_ms):
+        position = bisect.bisect_left(self.buckets, value_ms)
+        with self._lock:
+            self.counts[position] += 1
+            self.count += 1
+            self.total += value_ms
+
+    def quantile(self, q):
+        """バケット上限による分位点の推定値（ミリ秒）"""
+        with self._lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return 0.0
+        rank = q * count
+        cumulative = 0
+        for position, bucket_count in enumerate(counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return self.buckets[position] if position < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def snapshot(self):
+        with self._lock:
+            count, total = self.count, self.total
+        return {
+            'count': count,
+            'sum_ms': total,
+            'avg_ms': total / count if count else 0.0,
+            'p50_ms': self.quantile(0.5),
+            'p99_ms': self.quantile(0.99),
+        }
+
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+
+def histogram(stage):
+    """処理段階のヒストグラムを取得（無ければ作成）"""
+    entry = _histograms.get(stage)
+    if entry is None:
+        with _histograms_lock:
+            entry = _histograms.setdefault(stage, Histogram())
+    return entry
+
+
+class span:
+    """with ブロックの所要時間を stage のヒストグラムに記録（例外時も記録）
+
+    呼び出し頻度の高い診断処理でも使えるよう、ジェネレーターではなくクラスで実装している。
+    """
+
+    __slots__ = ('stage', 'fields', 'started')
+
+    def __init__(self, stage, **fields):
+        self.stage = stage
+        self.fields = fields
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        elapsed_ms = (time.perf_counter() - self.started) * 1000
+        histogram(self.stage).observe(elapsed_ms)
+        if SPAN_LOG:
+            logger.info(json.dumps(
+                {'event': 'span', 'stage': self.stage, 'ms': round(elapsed_ms, 3),
+                 'error': exc_type.__name__ if exc_type else None, **self.fields},
+                ensure_ascii=False
+            ))
+        return False
+
+
+def snapshot():
+    """処理段階ごとの件数・合計・平均・p50・p99（ミリ秒）"""
+    return {stage: entry.snapshot() for stage, entry in sorted(_histograms.items())}
+
+
+def reset():
+    """集計をすべて消去"""
+    with _histograms_lock:
+        _histograms.clear()
+
+
+def prometheus_text(metric='diagnosis_stage_seconds'):
+    """Prometheus のテキスト形式で出力（単位は秒）"""
+    lines = [
+        f"# HELP {metric} Time spent in each stage of the diagnosis request path.",
+        f"# TYPE {metric} histogram",
+    ]
+    for stage, entry in sorted(_histograms.items()):
+        with entry._lock:
+            counts, count, total = list(entry.counts), entry.count, entry.total
+        label = stage.replace('\\', '\\\\').replace('"', '\\"')
+        cumulative = 0
+        for bucket, bucket_count in zip(entry.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f'{metric}_bucket{{stage="{label}",le="{bucket / 1000:g}"}} {cumulative}')
+        lines.append(f'{metric}_bucket{{stage="{label}",le="+Inf"}} {count}')
+        lines.append(f'{metric}_sum{{stage="{label}"}} {total / 1000:.6f}')
+        lines.append(f'{metric}_count{{stage="{label}"}} {count}')
+    return "\n".join(lines) + "\n"
+
+
+_profile_lock = threading.Lock()
+
+
+def _profile_sample_rate():
+    try:
+        return float(os.getenv('DIAGNOSIS_PROFILE_SAMPLE_RATE', '0'))
+    except ValueError:
+        return 0.0
+
+
+@contextmanager
+def profiled(name):
+    """DIAGNOSIS_PROFILE_SAMPLE_RATE の割合で with ブロックを cProfile にかけ、pstats 形式で保存
+
+    同時に実行するプロファイルは1つまで（実行中の場合はプロファイルせずに処理する）。
+    保存したファイルは snakeviz や flameprof などでフレームグラフとして表示できる。
+    """
+    rate = _profile_sample_rate()
+    if rate <= 0 or random.random() >= rate or not _profile_lock.acquire(blocking=False):
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+        directory = os.getenv('DIAGNOSIS_PROFILE_DIR', os.path.join('data', 'profiles'))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"{name}_{datetime.now():%Y%m%d_%H%M%S_%f}_{os.getpid()}.prof")
+            profiler.dump_stats(path)
+            logger.info(json.dumps({'event': 'profile', 'name': name, 'path': path}, ensure_ascii=False))
+        except OSError:
+            logger.exception("Failed to save profile for %s", name)
+    finally:
+        _profile_lock.release()
@@ -0,0 +1,118 @@
+"""自由記述用のキーワードマッチャー（Aho–Corasick 法）
+
+キーワード表から一度だけオートマトンを構築し、テキストを1回走査するだけで
+すべてのキーワードの出現位置を求める。キーワード数が増えても走査コストは
+テキスト長に比例したままになる。
+"""
+from collections import deque
+
+import numpy as np
+
+
+class KeywordMatcher:
+    """体質タイプ別キーワード表から構築する複数パターンマッチャー"""
+
+    def __init__(self, keyword_table):
+        self.constitution_types = tuple(keyword_table.keys())
+        self.keywords = []
+        # キーワード番号 -> そのキーワードを含む体質タイプ
+        self.keyword_types = []
+        keyword_ids = {}
+        for constitution_type, keyword_list in keyword_table.items():
+            for keyword in keyword_list:
+                if not keyword:
+                    continue
+                if keyword not in keyword_ids:
+                    keyword_ids[keyword] = len(self.keywords)
+                    self.keywords.append(keyword)
+                    self.keyword_types.append([])
+                types = self.keyword_types[keyword_ids[keyword]]
+                if constitution_type not in types:
+                    types.append(constitution_type)
+
+        # トライ木の構築: 遷移表、失敗リンク、各状態で確定するキーワード番号
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [()]
+        for keyword_id, keyword in enumerate(self.keywords):
+            state = 0
+            for char in keyword:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(())
+                state = next_state
+            self._output[state] += (keyword_id,)
+
+        # 幅優先で失敗リンクを張り、失敗遷移を畳み込んだ決定性オートマトンにする
+        # （走査時は1文字につき辞書参照1回のみ）
+        self._delta = [dict(self._goto[0])] + [None] * (len(self._goto) - 1)
+        queue = deque(self._goto[0].values())
+        for state in queue:
+            self._fail[state] = 0
+        while queue:
+            state = queue.popleft()
+            fail_state = self._fail[state]
+            self._output[state] += self._output[fail_state]
+            delta = dict(self._delta[fail_state])
+            delta.update(self._goto[state])
+            self._delta[state] = delta
+            for char, next_state in self._goto[state].items():
+                self._fail[next_state] = self._delta[fail_state].get(char, 0)
+                queue.append(next_state)
+        self._lengths = tuple(len(keyword) for keyword in self.keywords)
+
+    def find_all(self, text):
+        """テキスト中のキーワード出現を (開始位置, キーワード番号) のリストで返す"""
+        delta = self._delta
+        output = self._output
+        lengths = self._lengths
+        hits = []
+        state = 0
+        for position, char in enumerate(text):
+            state = delta[state].get(char, 0)
+            if output[state]:
+                for keyword_id in output[state]:
+                    hits.append((position - lengths[keyword_id] + 1, keyword_id))
+        return hits
+
+    def count_matrix(self, texts, constitution_types):
+        """複数のテキストについて、体質タイプ別の出現したキーワードの種類数を行列で返す
+
+        match() の "count" と同じ値を (テキスト数, 体質タイプ数) の float64 行列で求める。
+        キーワードごとに全テキストを numpy の文字列検索でまとめて調べるため、件数が多い場合に速い。
+        """
+        columns = {c: n for n, c in enumerate(constitution_types)}
+        incidence = np.zeros((len(self.keywords), len(columns)), dtype=np.float64)
+        for keyword_id, types in enumerate(self.keyword_types):
+            for constitution_type in types:
+                if constitution_type in columns:
+                    incidence[keyword_id, columns[constitution_type]] = 1
+        if not texts or not self.keywords:
+            return np.zeros((len(texts), len(columns)), dtype=np.float64)
+        text_array = np.array(texts, dtype=str)
+        present = np.stack([np.char.find(text_array, keyword) >= 0 for keyword in self.keywords], axis=1)
+        return present @ incidence
+
+    def match(self, text):
+        """体質タイプ別のヒット情報を返す
+
+        Returns:
+            dict: 体質タイプ -> {"count": 出現したキーワードの種類数,
+                                 "hits": [(開始位置, キーワード), ...]}
+        """
+        result = {c: {"count": 0, "hits": []} for c in self.constitution_types}
+        seen = set()
+        for position, keyword_id in self.find_all(text):
+            keyword = self.keywords[keyword_id]
+            first = keyword_id not in seen
+            seen.add(keyword_id)
+            for constitution_type in self.keyword_types[keyword_id]:
+                entry = result[constitution_type]
+                entry["hits"].append((position, keyword))
+                if first:
+                    entry["count"] += 1
+        return result
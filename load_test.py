@@ -0,0 +1,289 @@
+"""診断・保存経路の負荷試験
+
+synthetic.py の合成回答を使い、回答の生成 → DiagnosisEngine.diagnose() → 保存 の一連の処理を
+同時実行数を段階的に上げながら実行し、段階ごとにスループット、レイテンシ（p50 / p95 / p99）、
+接続プールの取得待ち時間、エラー率を集計する。
+
+実行方式:
+    thread   同時実行数と同じ数のスレッドがそれぞれ処理を繰り返す（Streamlit のセッションに相当）
+    asyncio  イベントループ上のタスクで診断し、保存はスレッドプールで実行する（scoring_service.py に相当）
+
+保存方式:
+    sync     save_diagnosis_result() で1件ずつ保存してから次へ進む（レイテンシに保存時間を含む）
+    writer   write_behind の書き込みキューに登録する（段階の終了時にキューが空になるまでの時間も計測）
+    none     保存しない（診断のみ）
+
+保存先は DATABASE_URL（または --database-url）の データベース。試験用の行が追加されるため、
+ローカルの SQLite や試験用の PostgreSQL を指定すること。
+
+使い方:
+    python load_test.py --mode thread --concurrency 1,2,4,8,16,32 --duration 10
+    python load_test.py --mode asyncio --persist writer --database-url postgresql://localhost/loadtest --output load.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime
+
+import numpy as np
+
+from synthetic import add_generation_arguments, generate_responses, generate_user, generation_options
+
+MODES = ("thread", "asyncio")
+PERSIST_MODES = ("sync", "writer", "none")
+POOL_SAMPLE_INTERVAL = 0.05
+
+
+class StepResult:
+    """1段階分の計測結果（複数のワーカーから記録される）"""
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = Counter()
+        self.error_samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, latencies, errors, error_samples):
+        with self._lock:
+            self.latencies.extend(latencies)
+            self.errors.update(errors)
+            for name, message in error_samples.items():
+                self.error_samples.setdefault(name, message)
+
+
+class PoolMonitor:
+    """接続プールの使用状況を定期的に記録するスレッド"""
+
+    def __init__(self, get_status):
+        self.get_status = get_status
+        self.max_checked_out = 0
+        self.max_overflow = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="pool-monitor", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+    def _run(self):
+        while not self._stop.wait(POOL_SAMPLE_INTERVAL):
+            status = self.get_status()
+            self.max_checked_out = max(self.max_checked_out, status['checked_out'])
+            self.max_overflow = max(self.max_overflow, status['overflow'])
+
+
+def _pool_status():
+    from database import get_pool_status
+    return get_pool_status()
+
+
+def _make_persist(persist):
+    """保存方式に応じた (利用者情報, 診断結果, 回答) を受け取る関数"""
+    if persist == "sync":
+        from database import save_diagnosis_result
+        return save_diagnosis_result
+    if persist == "writer":
+        from write_behind import get_writer
+        return get_writer().submit
+    return None
+
+
+def _thread_step(engine, persist, concurrency, duration, seed, options):
+    result = StepResult()
+    stop = threading.Event()
+
+    def worker(index):
+        rng = random.Random(seed * 100003 + index)
+        latencies, errors, samples = [], Counter(), {}
+        while not stop.is_set():
+            user_data = generate_user(rng)
+            responses = generate_responses(rng, **options)
+            started = time.perf_counter()
+            try:
+                diagnosis_result = engine.diagnose(responses)
+                if persist:
+                    persist(user_data, diagnosis_result, responses)
+            except Exception as e:
+                errors[type(e).__name__] += 1
+                samples.setdefault(type(e).__name__, str(e).splitlines()[0] if str(e) else "")
+                continue
+            latencies.append(time.perf_counter() - started)
+        result.record(latencies, errors, samples)
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return result
+
+
+async def _asyncio_step(engine, persist, concurrency, duration, seed, options):
+    result = StepResult()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + duration
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="load-persist") as executor:
+        async def worker(index):
+            rng = random.Random(seed * 100003 + index)
+            latencies, errors, samples = [], Counter(), {}
+            while loop.time() < deadline:
+                user_data = generate_user(rng)
+                responses = generate_responses(rng, **options)
+                started = time.perf_counter()
+                try:
+                    diagnosis_result = engine.diagnose(responses)
+                    if persist:
+                        await loop.run_in_executor(executor, persist, user_data, diagnosis_result, responses)
+                    else:
+                        await asyncio.sleep(0)
+                except Exception as e:
+                    errors[type(e).__name__] += 1
+                    samples.setdefault(type(e).__name__, str(e).splitlines()[0] if str(e) else "")
+                    continue
+                latencies.append(time.perf_counter() - started)
+            result.record(latencies, errors, samples)
+
+        await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    return result
+
+
+def run_step(engine, mode, persist, concurrency, duration, seed=0, options=None):
+    """1段階（同時実行数 concurrency で duration 秒）を実行して集計結果の辞書を返す"""
+    options = options or {}
+    persist_call = _make_persist(persist)
+    before = _pool_status() if persist != "none" else None
+
+    started = time.perf_counter()
+    with PoolMonitor(_pool_status) if persist != "none" else nullcontext() as monitor:
+        if mode == "thread":
+            result = _thread_step(engine, persist_call, concurrency, duration, seed, options)
+        else:
+            result = asyncio.run(_asyncio_step(engine, persist_call, concurrency, duration, seed, options))
+        elapsed = time.perf_counter() - started
+
+        drain_seconds = None
+        if persist == "writer":
+            from write_behind import get_writer
+            drain_started = time.perf_counter()
+            get_writer().flush()
+            drain_seconds = time.perf_counter() - drain_started
+
+    completed = len(result.latencies)
+    failed = sum(result.errors.values())
+    latencies_ms = np.array(result.latencies) * 1000 if completed else np.zeros(1)
+    summary = {
+        "concurrency": concurrency,
+        "completed": completed,
+        "errors": failed,
+        "error_rate": failed / (completed + failed) if completed + failed else 0.0,
+        "error_types": dict(result.errors),
+        "error_samples": result.error_samples,
+        "throughput": completed / elapsed if elapsed else 0.0,
+        "latency_p50_ms": float(np.percentile(latencies_ms, 50)),
+        "latency_p95_ms": float(np.percentile(latencies_ms, 95)),
+        "latency_p99_ms": float(np.percentile(latencies_ms, 99)),
+        "latency_max_ms": float(latencies_ms.max()),
+    }
+    if drain_seconds is not None:
+        summary["writer_drain_seconds"] = drain_seconds
+    if before is not None:
+        after = _pool_status()
+        waits = after.get('wait_count', 0) - before.get('wait_count', 0)
+        wait_total_ms = (after.get('wait_avg_ms', 0.0) * after.get('wait_count', 0)
+                         - before.get('wait_avg_ms', 0.0) * before.get('wait_count', 0))
+        summary.update({
+            "pool_size": after['pool_size'],
+            "pool_max_checked_out": monitor.max_checked_out,
+            "pool_max_overflow": monitor.max_overflow,
+            "pool_checkouts": waits,
+            "pool_wait_avg_ms": wait_total_ms / waits if waits else 0.0,
+            "pool_timeouts": after.get('timeouts', 0) - before.get('timeouts', 0),
+        })
+    return summary
+
+
+def _format_step(step):
+    line = (
+        f"c={step['concurrency']:<4} {step['throughput']:9.0f} ops/s  "
+        f"p50 {step['latency_p50_ms']:7.2f}  p95 {step['latency_p95_ms']:7.2f}  "
+        f"p99 {step['latency_p99_ms']:7.2f} ms  errors {step['error_rate']:6.2%}"
+    )
+    if "pool_checkouts" in step:
+        line += (f"  pool wait {step['pool_wait_avg_ms']:.2f} ms, "
+                 f"max out {step['pool_max_checked_out']}/{step['pool_size']}+{step['pool_max_overflow']}")
+    if "writer_drain_seconds" in step:
+        line += f"  drain {step['writer_drain_seconds']:.2f}s"
+    return line
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="診断・保存経路の負荷試験（同時実行数を段階的に上げる）")
+    parser.add_argument("--mode", choices=MODES, default="thread")
+    parser.add_argument("--persist", choices=PERSIST_MODES, default="sync", help="保存方式")
+    parser.add_argument("--concurrency", default="1,2,4,8,16,32", help="同時実行数の段階（カンマ区切り）")
+    parser.add_argument("--duration", type=float, default=10.0, help="1段階あたりの秒数")
+    parser.add_argument("--database-url", help="保存先（省略時は DATABASE_URL、未設定なら SQLite）")
+    parser.add_argument("--output", help="結果を書き出す JSON ファイル")
+    add_generation_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.database_url:
+        # database モジュールは最初の保存時に読み込まれ、その時点の DATABASE_URL を使う
+        os.environ["DATABASE_URL"] = args.database_url
+    levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+
+    from diagnosis_engine import get_engine
+    engine = get_engine()
+    if args.persist != "none":
+        from database import get_db_engine
+        get_db_engine()
+        print(f"database: {get_db_engine().url.render_as_string(hide_password=True)}")
+
+    steps = []
+    for level in levels:
+        step = run_step(engine, args.mode, args.persist, level, args.duration,
+                        seed=args.seed + level, options=generation_options(args))
+        steps.append(step)
+        print(_format_step(step), flush=True)
+        for name, message in step["error_samples"].items():
+            print(f"       {name} x{step['error_types'][name]}: {message}")
+
+    if args.persist == "writer":
+        from write_behind import get_writer
+        print(f"writer: {get_writer().stats()}")
+
+    if args.output:
+        report = {
+            "meta": {
+                "timestamp": datetime.now().isoformat(timespec="seconds"),
+                "mode": args.mode,
+                "persist": args.persist,
+                "duration": args.duration,
+                "database": get_db_engine().url.render_as_string(hide_password=True)
+                if args.persist != "none" else None,
+                "seed": args.seed,
+                **generation_options(args),
+            },
+            "steps": steps,
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""保存済み回答のコンパクト形式への移行
+
+diagnosis_results の responses 列のうち従来形式（質問文・選択肢の文字列を含む辞書）の行を
+response_codec のコンパクト形式に書き換える。デコードして元の辞書に戻らない行は変更しない。
+--decode を指定すると逆にコンパクト形式の行を従来形式へ戻す（切り戻し用）。
+
+PostgreSQL では書き換え後に VACUUM FULL diagnosis_results（または pg_repack）を実行すると
+テーブルとインデックスの領域が解放される。
+
+使い方:
+    python reencode_responses.py [--chunk-size 5000] [--dry-run]
+    python reencode_responses.py --decode
+"""
+import argparse
+import json
+import sys
+import time
+
+from sqlalchemy import select, update
+
+from database import DiagnosisResult, open_session
+from response_codec import decode_responses, encode_responses, is_compact
+
+
+def _size(value):
+    return len(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+
+
+def reencode_all(chunk_size=5000, decode=False, dry_run=False, log=sys.stderr):
+    """diagnosis_results の全行を id 順にチャンク単位で変換"""
+    total = 0
+    converted = 0
+    skipped = 0
+    bytes_before = 0
+    bytes_after = 0
+    last_id = 0
+    started = time.perf_counter()
+
+    db = open_session()
+    try:
+        while True:
+            rows = db.execute(
+                select(DiagnosisResult.id, DiagnosisResult.responses)
+                .where(DiagnosisResult.id > last_id)
+                .order_by(DiagnosisResult.id)
+                .limit(chunk_size)
+            ).all()
+            if not rows:
+                break
+
+            updates = []
+            for row in rows:
+                if not row.responses or is_compact(row.responses) != decode:
+                    continue
+                value = decode_responses(row.responses) if decode else encode_responses(row.responses)
+                if value is None:
+                    skipped += 1
+                    continue
+                bytes_before += _size(row.responses)
+                bytes_after += _size(value)
+                updates.append({"id": row.id, "responses": value})
+
+            if updates and not dry_run:
+                db.execute(update(DiagnosisResult), updates)
+                db.commit()
+
+            total += len(rows)
+            converted += len(updates)
+            last_id = rows[-1].id
+            elapsed = time.perf_counter() - started
+            print(f"{total} rows scanned ({total / elapsed:.0f} rows/s), "
+                  f"{converted} converted, {skipped} skipped", file=log)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+    return {"total": total, "converted": converted, "skipped": skipped,
+            "bytes_before": bytes_before, "bytes_after": bytes_after}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="保存済みの回答をコンパクト形式に変換")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="1回のクエリで処理する行数")
+    parser.add_argument("--decode", action="store_true", help="コンパクト形式の行を従来形式に戻す")
+    parser.add_argument("--dry-run", action="store_true", help="更新せずに変換件数とサイズのみ集計")
+    args = parser.parse_args(argv)
+
+    summary = reencode_all(chunk_size=args.chunk_size, decode=args.decode, dry_run=args.dry_run)
+    print(f"done: {summary['total']} rows, {summary['converted']} converted, {summary['skipped']} skipped "
+          f"(not encodable); responses JSON {summary['bytes_before']:,} -> {summary['bytes_after']:,} bytes")
+
+
+if __name__ == "__main__":
+    main()
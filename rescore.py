@@ -0,0 +1,94 @@
+"""保存済み診断結果の一括再スコアリング
+
+ルールファイル（rules/*.json）の重みを変更した後、diagnosis_results テーブルの全行を
+DiagnosisEngine.diagnose_batch() で再計算して更新する（rule_version も更新する）。
+DIAGNOSIS_ROLLUPS が有効な場合は、体質タイプ別の件数が変わるため最後に diagnosis_rollups を作り直す。
+
+使い方:
+    python rescore.py [--chunk-size 5000] [--jitter off] [--dry-run] [--rules-file rules/default.json]
+"""
+import argparse
+import sys
+import time
+
+from sqlalchemy import select, update
+
+import database
+from database import DiagnosisResult, open_session
+from diagnosis_engine import DiagnosisEngine, JITTER_MODES
+from response_codec import decode_responses
+from rule_sets import load_rule_set
+
+
+def rescore_all(engine, chunk_size=5000, dry_run=False, log=sys.stderr):
+    """diagnosis_results の全行を id 順にチャンク単位で再スコアリング"""
+    total = 0
+    changed = 0
+    last_id = 0
+    started = time.perf_counter()
+
+    db = open_session()
+    try:
+        while True:
+            rows = db.execute(
+                select(DiagnosisResult.id, DiagnosisResult.constitution_type, DiagnosisResult.responses)
+                .where(DiagnosisResult.id > last_id)
+                .order_by(DiagnosisResult.id)
+                .limit(chunk_size)
+            ).all()
+            if not rows:
+                break
+
+            results = engine.diagnose_batch([decode_responses(row.responses) or {} for row in rows])
+            changed += sum(
+                1 for row, result in zip(rows, results)
+                if row.constitution_type != result["constitution_type"]
+            )
+
+            if not dry_run:
+                db.execute(update(DiagnosisResult), [
+                    {
+                        "id": row.id,
+                        "constitution_type": result["constitution_type"],
+                        "score": result["score"],
+                        "confidence": result["confidence"],
+                        "all_scores": result["all_scores"],
+                        "rule_version": result["rule_version"]
+                    }
+                    for row, result in zip(rows, results)
+                ])
+                db.commit()
+
+            total += len(rows)
+            last_id = rows[-1].id
+            elapsed = time.perf_counter() - started
+            print(f"{total} rows rescored ({total / elapsed:.0f} rows/s), "
+                  f"{changed} constitution changes", file=log)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+    if not dry_run and database.ROLLUPS_ENABLED:
+        database.rebuild_rollups()
+        print("diagnosis_rollups rebuilt", file=log)
+    return {"total": total, "changed": changed}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="診断結果を現在の diagnosis_rules で再スコアリング")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="1回のクエリで処理する行数")
+    parser.add_argument("--jitter", choices=JITTER_MODES, default="off", help="信頼度の微調整モード")
+    parser.add_argument("--dry-run", action="store_true", help="更新せずに変化件数のみ集計")
+    parser.add_argument("--rules-file", help="使用するルールファイル（省略時は DIAGNOSIS_RULES_FILE）")
+    args = parser.parse_args(argv)
+
+    rule_set = load_rule_set(args.rules_file) if args.rules_file else None
+    engine = DiagnosisEngine(jitter=args.jitter, rule_set=rule_set)
+    summary = rescore_all(engine, chunk_size=args.chunk_size, dry_run=args.dry_run)
+    print(f"done: {summary['total']} rows, {summary['changed']} constitution changes")
+
+
+if __name__ == "__main__":
+    main()
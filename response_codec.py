@@ -0,0 +1,156 @@
+"""回答のコンパクトな保存形式（エンコード・デコード）
+
+app.py の回答の辞書は質問文（question_{i}_question）とフォローアップの選択肢の文字列を
+そのまま含むため、1件ごとに数 KB の重複したテキストになる。保存時は次の形式に変換する。
+
+    {"v": 質問票のバージョン, "a": [質問ごとの整数, ...], "t": [自由記述, ...]}
+
+"a" は自由記述以外の質問ごとに 選択肢の番号 + 選択肢の数 x フォローアップのビットマスク
+（フォローアップの全選択肢を質問内で通し番号にしたビット）を並べたもの。
+"t" は自由記述の質問ごとの回答（すべて空なら省略）。
+
+質問票のバージョンは質問票の内容から求めたハッシュで、QUESTIONNAIRES に登録された
+質問票からのみデコードできる。TCM_QUESTIONS を変更する場合は、変更前の質問票を
+register_questionnaire() で登録しておけば、既存の行も引き続きデコードできる。
+
+decode_responses() は従来形式の辞書をそのまま返すため、読み込み側は移行前後の行を区別せずに扱える。
+"""
+import hashlib
+import json
+
+from tcm_data import TCM_QUESTIONS
+
+YES_ANSWER = "はい"
+NONE_OPTION = "どれも当てはまらない"
+
+# バージョン -> 質問票
+QUESTIONNAIRES = {}
+_layouts = {}
+
+
+def questionnaire_version(questions):
+    """質問票の内容から求めたバージョン ID"""
+    digest = hashlib.sha256(
+        json.dumps(questions, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+    return "q" + digest[:12]
+
+
+def register_questionnaire(questions):
+    """質問票を登録してバージョン ID を返す"""
+    version = questionnaire_version(questions)
+    if version not in QUESTIONNAIRES:
+        QUESTIONNAIRES[version] = questions
+        _layouts[version] = _compile_layout(questions)
+    return version
+
+
+def _compile_layout(questions):
+    """質問票を質問ごとの (質問番号, 質問文, 選択肢, フォローアップ) のタプルに変換
+
+    自由記述の質問は選択肢が None。フォローアップは (キー, ビット位置の開始, 選択肢) のタプル。
+    """
+    layout = []
+    for i, question_data in enumerate(questions):
+        if question_data.get("type") == "free_text":
+            layout.append((i, question_data["question"], None, ()))
+            continue
+        follow_ups = []
+        offset = 0
+        for j, follow_up in enumerate(question_data.get("follow_up_questions", [])):
+            follow_ups.append((f"question_{i}_follow_up_{j}", offset, tuple(follow_up["options"])))
+            offset += len(follow_up["options"])
+        layout.append((i, question_data["question"], tuple(question_data["options"]), tuple(follow_ups)))
+    return tuple(layout)
+
+
+CURRENT_VERSION = register_questionnaire(TCM_QUESTIONS)
+
+
+def is_compact(value):
+    """コンパクト形式で保存された回答かどうか"""
+    return isinstance(value, dict) and "v" in value and "a" in value
+
+
+def _encode(responses, version):
+    codes = []
+    texts = []
+    for i, _, options, follow_ups in _layouts[version]:
+        answer = responses.get(f"question_{i}")
+        if options is None:
+            texts.append(answer or "")
+            continue
+        if answer not in options:
+            return None
+        mask = 0
+        for key, offset, follow_up_options in follow_ups:
+            value = responses.get(key)
+            if value is None:
+                continue
+            for item in value.split(","):
+                item = item.strip()
+                if item not in follow_up_options:
+                    return None
+                mask |= 1 << (offset + follow_up_options.index(item))
+        codes.append(options.index(answer) + len(options) * mask)
+
+    encoded = {"v": version, "a": codes}
+    if any(texts):
+        encoded["t"] = texts
+    return encoded
+
+
+def encode_responses(responses, version=CURRENT_VERSION):
+    """回答の辞書をコンパクト形式に変換（デコードして元の辞書に戻らない場合は None）
+
+    app.py が作成しない形の回答（キーの過不足、質問票にない選択肢など）は変換しない。
+    """
+    if version not in _layouts:
+        raise ValueError(f"Unknown questionnaire version: {version}")
+    try:
+        encoded = _encode(responses, version)
+    except (AttributeError, TypeError):
+        return None
+    if encoded is None or decode_responses(encoded) != responses:
+        return None
+    return encoded
+
+
+def pack_responses(responses):
+    """保存用の値（コンパクト形式に変換できない回答は従来形式のまま）"""
+    if not responses or is_compact(responses):
+        return responses
+    return encode_responses(responses) or responses
+
+
+def decode_responses(stored):
+    """保存された回答を app.py と同じ形式の辞書に戻す（従来形式の辞書はそのまま返す）"""
+    if not is_compact(stored):
+        return stored
+    layout = _layouts.get(stored["v"])
+    if layout is None:
+        raise ValueError(f"Unknown questionnaire version: {stored['v']}")
+    codes = iter(stored["a"])
+    texts = iter(stored.get("t") or ())
+
+    responses = {}
+    try:
+        for i, question, options, follow_ups in layout:
+            if options is None:
+                responses[f"question_{i}"] = next(texts, "")
+                responses[f"question_{i}_question"] = question
+                continue
+            code = next(codes)
+            answer = options[code % len(options)]
+            responses[f"question_{i}"] = answer
+            responses[f"question_{i}_question"] = question
+            if answer == YES_ANSWER:
+                mask = code // len(options)
+                for key, offset, follow_up_options in follow_ups:
+                    selected = [
+                        option for k, option in enumerate(follow_up_options) if mask >> (offset + k) & 1
+                    ]
+                    responses[key] = ", ".join(selected) if selected else NONE_OPTION
+    except StopIteration:
+        raise ValueError(f"Malformed responses for questionnaire version {stored['v']}") from None
+    return responses
@@ -0,0 +1,207 @@
+"""バージョン付きの診断ルールファイル（rules/*.json）の読み込みと検証
+
+診断ルールの重み（diagnosis_rules）と自由記述のキーワード表（free_text_keywords）は
+JSON ファイルで管理する。
+
+    {
+      "version": "2025.1",
+      "description": "...",
+      "diagnosis_rules": {"気虚": {"primary_questions": {...}, "follow_up_symptoms": {...}}, ...},
+      "free_text_keywords": {"気虚": ["疲れ", ...], ...}
+    }
+
+version は診断結果（diagnosis_results.rule_version）に記録される。内容を変更した場合は
+version も変更すること（同じ version で内容が異なるファイルは再読み込み時に拒否する）。
+
+RuleWatcher はルールファイルの更新を定期的に確認し、変更があればコールバック
+（diagnosis_engine.reload_engine）を呼び出す。新しいエンジンの構築は監視スレッドで行うため、
+診断リクエストの処理を待たせない。
+
+環境変数:
+    DIAGNOSIS_RULES_FILE=rules/default.json  読み込むルールファイル
+    DIAGNOSIS_RULES_RELOAD_SECONDS=30        更新を確認する間隔（秒）。0 で確認しない
+
+使い方:
+    python rule_sets.py validate rules/candidate.json [--table-dir data]
+"""
+import argparse
+import copy
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+
+from tcm_data import HEALTH_ADVICE, TCM_QUESTIONS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules", "default.json")
+RULES_FILE = os.getenv("DIAGNOSIS_RULES_FILE") or DEFAULT_RULES_FILE
+RELOAD_SECONDS = float(os.getenv("DIAGNOSIS_RULES_RELOAD_SECONDS", "30"))
+
+RULE_SECTIONS = ("primary_questions", "follow_up_symptoms")
+TOP_LEVEL_KEYS = {"version", "description", "diagnosis_rules", "free_text_keywords"}
+
+
+class RuleSetError(ValueError):
+    """ルールファイルの内容が不正"""
+
+
+def rule_set_digest(rule_set):
+    """ルールの内容（version・description を除く）のハッシュ
+
+    体質タイプの並び順は同点時の判定やスコアの列の順序に影響するため、記述順のまま含める。
+    """
+    return hashlib.sha256(json.dumps(
+        {"diagnosis_rules": rule_set["diagnosis_rules"], "free_text_keywords": rule_set["free_text_keywords"]},
+        ensure_ascii=False
+    ).encode("utf-8")).hexdigest()
+
+
+def validate_rule_set(rule_set, questions=TCM_QUESTIONS):
+    """ルールの内容を検証（不正な場合は RuleSetError）
+
+    質問票のどの質問文にも含まれないプライマリ質問、どの選択肢とも一致しない
+    フォローアップ症状は、スコアに反映されない書き間違いとして扱う。
+    """
+    if not isinstance(rule_set, dict):
+        raise RuleSetError("Rule set must be a JSON object")
+    unknown = set(rule_set) - TOP_LEVEL_KEYS
+    if unknown:
+        raise RuleSetError(f"Unknown keys in rule set: {', '.join(sorted(unknown))}")
+    version = rule_set.get("version")
+    if not isinstance(version, str) or not version.strip() or len(version) > 64:
+        raise RuleSetError("Rule set needs a \"version\" string (at most 64 characters)")
+
+    rules = rule_set.get("diagnosis_rules")
+    if not isinstance(rules, dict) or not rules:
+        raise RuleSetError("\"diagnosis_rules\" must be a non-empty object")
+    question_texts = [q["question"] for q in questions]
+    options = {o for q in questions for f in q.get("follow_up_questions", []) for o in f["options"]}
+    for constitution_type, sections in rules.items():
+        if constitution_type not in HEALTH_ADVICE:
+            raise RuleSetError(f"Unknown constitution type: {constitution_type}")
+        if not isinstance(sections, dict) or set(sections) != set(RULE_SECTIONS):
+            raise RuleSetError(f"{constitution_type} needs exactly {' and '.join(RULE_SECTIONS)}")
+        for section, weights in sections.items():
+            if not isinstance(weights, dict):
+                raise RuleSetError(f"{constitution_type}/{section} must be an object")
+            for text, weight in weights.items():
+                if not isinstance(weight, int) or isinstance(weight, bool) or weight < 0:
+                    raise RuleSetError(f"Rule weight must be a non-negative integer: {constitution_type}/{text}")
+                if section == "primary_questions" and not any(text in q for q in question_texts):
+                    raise RuleSetError(f"Primary question matches no question: {constitution_type}/{text}")
+                if section == "follow_up_symptoms" and text not in options:
+                    raise RuleSetError(f"Follow-up symptom matches no option: {constitution_type}/{text}")
+
+    keywords = rule_set.get("free_text_keywords")
+    if not isinstance(keywords, dict):
+        raise RuleSetError("\"free_text_keywords\" must be an object")
+    for constitution_type, words in keywords.items():
+        if constitution_type not in rules:
+            raise RuleSetError(f"Keywords for a constitution type without rules: {constitution_type}")
+        if not isinstance(words, list) or not all(isinstance(w, str) and w for w in words):
+            raise RuleSetError(f"Keywords for {constitution_type} must be a list of non-empty strings")
+    return rule_set
+
+
+def load_rule_set(path=None):
+    """ルールファイルを読み込んで検証（戻り値は呼び出し側で変更してよい新しい辞書）"""
+    path = path or RULES_FILE
+    try:
+        with open(path, encoding="utf-8") as f:
+            rule_set = json.load(f)
+    except json.JSONDecodeError as e:
+        raise RuleSetError(f"{path}: {e}") from e
+    return validate_rule_set(rule_set)
+
+
+_default_rule_set = None
+_default_rule_set_lock = threading.Lock()
+
+
+def default_rule_set():
+    """DIAGNOSIS_RULES_FILE のルール（プロセス内で一度だけ読み込み、呼び出しごとに複製を返す）"""
+    global _default_rule_set
+    if _default_rule_set is None:
+        with _default_rule_set_lock:
+            if _default_rule_set is None:
+                _default_rule_set = load_rule_set(RULES_FILE)
+    return copy.deepcopy(_default_rule_set)
+
+
+def _file_stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class RuleWatcher:
+    """ルールファイルの更新を監視し、変更時に reload(path) を呼び出すスレッド"""
+
+    def __init__(self, reload, path=None, interval=RELOAD_SECONDS):
+        self.reload = reload
+        self.path = path or RULES_FILE
+        self.interval = interval
+        self.last_error = None
+        self._stamp = _file_stamp(self.path)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.interval > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="rule-watcher", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def check(self):
+        """ファイルが更新されていれば再読み込み（失敗した場合は現在のルールを使い続ける）"""
+        stamp = _file_stamp(self.path)
+        if stamp is None or stamp == self._stamp:
+            return False
+        self._stamp = stamp
+        try:
+            self.reload(self.path)
+            self.last_error = None
+            return True
+        except Exception as e:
+            self.last_error = str(e)
+            logger.exception("Failed to reload rules from %s", self.path)
+            return False
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.check()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="診断ルールファイルの管理コマンド")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    validate = subparsers.add_parser("validate", help="ルールファイルを検証・コンパイル")
+    validate.add_argument("path", nargs="?", default=RULES_FILE)
+    validate.add_argument("--table-dir", help="スコアテーブルも構築して保存する（デプロイ前の事前計算）")
+    args = parser.parse_args(argv)
+
+    from diagnosis_engine import DiagnosisEngine
+
+    try:
+        rule_set = load_rule_set(args.path)
+        engine = DiagnosisEngine(jitter="off", cache_size=0, score_table_dir=args.table_dir, rule_set=rule_set)
+    except (OSError, RuleSetError) as e:
+        print(f"invalid: {e}", file=sys.stderr)
+        sys.exit(1)
+    rule_count = sum(len(w) for sections in rule_set["diagnosis_rules"].values() for w in sections.values())
+    print(f"version {engine.rule_version}: {len(rule_set['diagnosis_rules'])} constitution types, "
+          f"{rule_count} weights, {sum(map(len, rule_set['free_text_keywords'].values()))} keywords")
+    print(f"rules digest {rule_set_digest(rule_set)[:16]}, scoring index digest {engine.scoring_index.digest[:16]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""回答フィンガープリント -> 基本スコアの LRU キャッシュ"""
+import threading
+from collections import OrderedDict
+
+
+class ScoreCache:
+    """上限件数付きの LRU キャッシュ（スレッドセーフ、ヒット・ミス数を集計）"""
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """キャッシュ済みの値を返す（無ければ None）"""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """値を登録し、上限を超えた場合は最も古いエントリを削除"""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """エントリと集計値をすべて消去"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """ヒット数・ミス数・ヒット率・現在の件数"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self._entries),
+                "maxsize": self.maxsize
+            }
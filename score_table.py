@@ -0,0 +1,208 @@
+"""構造化回答の事前計算スコアテーブル
+
+フィンガープリントの全ビットパターン（2^43 通り）をそのまま列挙するのは現実的でないため、
+質問単位でビット幅が BLOCK_BITS 以下になるようブロックに分割し、ブロックごとに全パターンの
+(得点, 満点への加算) ベクトルを事前計算する。スコアはブロック数ぶんの行を足し合わせるだけで求まる。
+
+テーブルはルールのハッシュ付きのファイル名で保存し、起動時にメモリマップで読み込む。
+ルールが変わるとファイル名が変わるため、自動的に再構築される。列の体質タイプの並びは
+同名の .json（サイドカー）に保存し、読み込み時にルールの並びと一致するか確認する。
+
+使い方:
+    python score_table.py build [--dir data] [--verify full|sample]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+
+import numpy as np
+
+BLOCK_BITS = 16
+DEFAULT_TABLE_DIR = "data"
+VERIFY_SAMPLES = 2000
+
+
+class ScoreTable:
+    """ブロック分割したフィンガープリント -> (得点, 満点加算) の事前計算テーブル"""
+
+    def __init__(self, index, table, constitution_types=None):
+        self.index = index
+        self.table = table
+        self.blocks = self.block_layout(index)
+        if table.shape != (self.row_count(self.blocks), 2 * len(index.constitution_types)):
+            raise ValueError(f"Score table shape {table.shape} does not match the rules")
+        if constitution_types is not None and tuple(constitution_types) != index.constitution_types:
+            raise ValueError(f"Score table columns {constitution_types} do not match the rules")
+
+    @staticmethod
+    def block_layout(index):
+        """質問の境界でビット列をブロックに分割し、(開始ビット, ビット幅, 行オフセット) を返す"""
+        widths = []
+        for i, offset in enumerate(index.question_offsets):
+            if offset is not None:
+                widths.append((offset, 1 + len(index.question_options[i])))
+
+        blocks = []
+        start, width = None, 0
+        for offset, question_width in widths:
+            if start is not None and width + question_width > BLOCK_BITS:
+                blocks.append((start, width))
+                start, width = None, 0
+            if start is None:
+                start = offset
+            width += question_width
+        if start is not None:
+            blocks.append((start, width))
+
+        layout = []
+        row_offset = 0
+        for start, width in blocks:
+            layout.append((start, width, row_offset))
+            row_offset += 1 << width
+        return tuple(layout)
+
+    @staticmethod
+    def row_count(blocks):
+        return sum(1 << width for _, width, _ in blocks)
+
+    @classmethod
+    def build(cls, index):
+        """ScoringIndex のビット重みから全ブロックのテーブルを計算"""
+        blocks = cls.block_layout(index)
+        size = len(index.constitution_types)
+        table = np.zeros((cls.row_count(blocks), 2 * size), dtype=np.int32)
+        for start, width, row_offset in blocks:
+            patterns = np.arange(1 << width, dtype=np.int64)
+            bits = ((patterns[:, None] >> np.arange(width)) & 1).astype(np.int32)
+            weights = np.array(index.bit_weights[start:start + width], dtype=np.int32)
+            table[row_offset:row_offset + (1 << width), :size] = bits @ weights[:, 0, :]
+            table[row_offset:row_offset + (1 << width), size:] = bits @ weights[:, 1, :]
+        return cls(index, table)
+
+    @classmethod
+    def load(cls, index, path):
+        """保存済みテーブルをメモリマップで読み込む（列の並びを記録したサイドカーが必要）"""
+        try:
+            with open(sidecar_path(path), encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            raise ValueError(f"Score table metadata is missing or unreadable: {e}") from e
+        if meta.get("digest") != index.digest:
+            raise ValueError("Score table metadata does not match the rules")
+        return cls(index, np.load(path, mmap_mode="r"), constitution_types=meta.get("constitution_types"))
+
+    def save(self, path):
+        """一時ファイルに書き込んでから置き換える（読み込み中のプロセスに影響しない）
+
+        サイドカーを先に置き換えるため、テーブル本体が古いまま新しいサイドカーと組になることはない
+        （本体のファイル名はルールのハッシュで決まる）。
+        """
+        meta = {"digest": self.index.digest, "constitution_types": list(self.index.constitution_types)}
+        tmp_meta = f"{sidecar_path(path)}.{os.getpid()}.tmp"
+        with open(tmp_meta, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_meta, sidecar_path(path))
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.ascontiguousarray(self.table))
+        os.replace(tmp_path, path)
+
+    def raw_scores(self, fingerprint):
+        """フィンガープリントから体質別の (得点, 満点) ベクトルを計算"""
+        rows = [
+            row_offset + (fingerprint >> start & ((1 << width) - 1))
+            for start, width, row_offset in self.blocks
+        ]
+        total = self.table[rows].sum(axis=0).tolist()
+        size = len(self.index.constitution_types)
+        score = total[:size]
+        max_score = [a + b for a, b in zip(self.index.primary_max, total[size:])]
+        return score, max_score
+
+    def scores(self, fingerprint):
+        """フィンガープリントから体質別の正規化スコア（0-100）をタプルで計算"""
+        return self.index.normalize(*self.raw_scores(fingerprint))
+
+    def verify(self, engine, mode="sample", samples=VERIFY_SAMPLES, seed=0):
+        """テーブルの内容を DiagnosisEngine.calculate_constitution_score と照合
+
+        mode="full" では各ブロックの全パターンを、"sample" ではランダムに選んだ
+        パターンを検証する。いずれの場合もブロックをまたぐランダムな組み合わせも検証する。
+        不一致があれば ValueError を送出する。
+        """
+        index = self.index
+        rng = random.Random(seed)
+        fingerprints = []
+        for start, width, _ in self.blocks:
+            if mode == "full":
+                patterns = range(1 << width)
+            else:
+                patterns = (rng.getrandbits(width) for _ in range(samples // len(self.blocks)))
+            fingerprints.extend(pattern << start for pattern in patterns)
+        fingerprints.extend(rng.getrandbits(index.fingerprint_width) for _ in range(samples))
+
+        for fingerprint in fingerprints:
+            responses = index.decode_fingerprint(fingerprint)
+            expected = tuple(
+                engine.calculate_constitution_score(responses, constitution_type)
+                for constitution_type in index.constitution_types
+            )
+            if self.scores(fingerprint) != expected:
+                raise ValueError(f"Score table mismatch for fingerprint {fingerprint:#x}")
+        return len(fingerprints)
+
+
+def table_path(index, directory=DEFAULT_TABLE_DIR):
+    """ルールのハッシュを含むテーブルファイルのパス"""
+    return os.path.join(directory, f"score_table_{index.digest[:16]}.npy")
+
+
+def sidecar_path(path):
+    """テーブルの列の並び（体質タイプ）とハッシュを記録するファイルのパス"""
+    return os.path.splitext(path)[0] + ".json"
+
+
+def load_or_build(engine, directory=DEFAULT_TABLE_DIR, verify="sample"):
+    """ルールに対応するテーブルを読み込み、無ければ構築・検証して保存"""
+    index = engine.scoring_index
+    path = table_path(index, directory)
+    if os.path.exists(path):
+        try:
+            return ScoreTable.load(index, path)
+        except (OSError, ValueError):
+            pass
+
+    table = ScoreTable.build(index)
+    table.verify(engine, mode=verify)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        table.save(path)
+        return ScoreTable.load(index, path)
+    except OSError:
+        # 書き込めない環境ではメモリ上のテーブルをそのまま使う
+        return table
+
+
+def main(argv=None):
+    from diagnosis_engine import DiagnosisEngine
+
+    parser = argparse.ArgumentParser(description="構造化回答の事前計算スコアテーブルを構築")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("--dir", default=DEFAULT_TABLE_DIR, help="テーブルの保存先ディレクトリ")
+    parser.add_argument("--verify", choices=["full", "sample"], default="full", help="検証の範囲")
+    args = parser.parse_args(argv)
+
+    engine = DiagnosisEngine()
+    table = ScoreTable.build(engine.scoring_index)
+    checked = table.verify(engine, mode=args.verify)
+    os.makedirs(args.dir, exist_ok=True)
+    path = table_path(engine.scoring_index, args.dir)
+    table.save(path)
+    print(f"{path}: {table.table.shape[0]} rows, {checked} patterns verified", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+"""診断ルールのコンパイル済みインデックス
+
+diagnosis_rules と TCM_QUESTIONS を一度だけ走査し、質問・フォローアップ選択肢ごとの
+体質別重みベクトルに変換する。診断時は回答項目ごとのベクトル加算のみで済み、
+質問文の部分一致検索は行わない。
+"""
+import hashlib
+import json
+
+import numpy as np
+
+YES_ANSWER = "はい"
+NONE_OPTION = "どれも当てはまらない"
+
+
+class ScoringIndex:
+    """diagnosis_rules を体質別の重みベクトルへコンパイルしたインデックス
+
+    スコアの意味は DiagnosisEngine.calculate_constitution_score と同一:
+    プライマリ質問の重みは常に分母へ、「はい」の場合のみ分子へ加算し、
+    フォローアップ症状の重みは分子・分母の両方へ加算する。
+    """
+
+    def __init__(self, diagnosis_rules, questions):
+        self.constitution_types = tuple(diagnosis_rules.keys())
+        self.questions = tuple(questions)
+        # ルールと質問票の内容から求めたハッシュ（事前計算テーブル・キャッシュの識別に使用）
+        # 体質タイプとプライマリ質問の並び順はベクトルの列・スロットの順序を決めるため、
+        # ルールは記述順のまま（sort_keys なしで）ハッシュに含める
+        self.digest = hashlib.sha256(json.dumps(
+            {
+                "constitution_types": self.constitution_types,
+                "rules": json.dumps(diagnosis_rules, ensure_ascii=False, default=dict),
+                "questions": questions,
+            },
+            ensure_ascii=False, sort_keys=True, default=dict
+        ).encode("utf-8")).hexdigest()
+        size = len(self.constitution_types)
+
+        # ルール上のプライマリ質問文ごとにスロットを割り当てる
+        slot_texts = []
+        slot_weights = []
+        slot_of = {}
+        for c_idx, constitution_type in enumerate(self.constitution_types):
+            for text, weight in diagnosis_rules[constitution_type]["primary_questions"].items():
+                if text not in slot_of:
+                    slot_of[text] = len(slot_texts)
+                    slot_texts.append(text)
+                    slot_weights.append([0] * size)
+                slot_weights[slot_of[text]][c_idx] += weight
+        self.slot_texts = tuple(slot_texts)
+        self.slot_weights = tuple(tuple(w) for w in slot_weights)
+
+        # 分母に常に加算されるプライマリ質問の重み合計
+        self.primary_max = tuple(
+            sum(w[c_idx] for w in self.slot_weights) for c_idx in range(size)
+        )
+
+        # フォローアップ症状（選択肢の文言） -> 重みベクトル
+        symptom_weights = {}
+        for c_idx, constitution_type in enumerate(self.constitution_types):
+            for symptom, weight in diagnosis_rules[constitution_type]["follow_up_symptoms"].items():
+                symptom_weights.setdefault(symptom, [0] * size)[c_idx] += weight
+        self.symptom_weights = {s: tuple(w) for s, w in symptom_weights.items()}
+
+        # 一括診断用の特徴量番号: [スロット..., フォローアップ症状...]
+        self.symptom_texts = tuple(self.symptom_weights)
+        self._symptom_feature = {
+            symptom: len(self.slot_texts) + n for n, symptom in enumerate(self.symptom_texts)
+        }
+        self.feature_count = len(self.slot_texts) + len(self.symptom_texts)
+
+        # ルールの各重み -> (体質タイプ, 区分, 文言, 重み, 特徴量番号)（重みの感度分析用）
+        # 重み行列はこれらの重みの線形和になっている
+        self.rule_entries = tuple(
+            (constitution_type, section, text, weight,
+             slot_of[text] if section == "primary_questions" else self._symptom_feature[text])
+            for constitution_type in self.constitution_types
+            for section in ("primary_questions", "follow_up_symptoms")
+            for text, weight in diagnosis_rules[constitution_type][section].items()
+        )
+
+        # 質問文 -> (該当スロットのビットマスク, 重みベクトル, スロット番号)
+        self._question_entries = {}
+        for question_data in questions:
+            text = question_data["question"]
+            if text not in self._question_entries:
+                self._question_entries[text] = self._match_question(text)
+
+        # 質問番号 -> 重みベクトル、フォローアップ選択肢 -> 重みベクトル
+        question_weights = []
+        option_weights = []
+        claimed = 0
+        for question_data in questions:
+            mask = self._question_entries[question_data["question"]][0]
+            # 同じルール質問に複数の質問文が該当する場合は最初の質問のみ有効
+            question_weights.append(self._mask_weights(mask & ~claimed))
+            claimed |= mask
+            option_weights.append(tuple(
+                tuple(self.symptom_weights.get(option, (0,) * size) for option in follow_up["options"])
+                for follow_up in question_data.get("follow_up_questions", [])
+            ))
+        self.question_weights = tuple(question_weights)
+        self.option_weights = tuple(option_weights)
+
+        # 各ルール質問に該当する質問文が1つだけなら、スコアは回答順序に依存しない
+        covered = [0] * len(self.slot_texts)
+        for question_data in questions:
+            for slot in self._question_entries[question_data["question"]][2]:
+                covered[slot] += 1
+        self.exclusive = all(n <= 1 for n in covered)
+
+        # 構造化回答のビットセット表現（フィンガープリント）のレイアウト
+        # 質問 i ごとに [はい, 選択肢 (j, k)...] のビットを連続して割り当てる
+        # （「どれも当てはまらない」と自由記述質問にはビットを割り当てない）
+        self.question_offsets = []
+        self.question_options = []
+        self._fingerprint_keys = {}
+        bit_weights = []
+        zero = (0,) * size
+        for i, question_data in enumerate(questions):
+            if question_data.get("type") == "free_text":
+                self.question_offsets.append(None)
+                self.question_options.append(())
+                self._fingerprint_keys[f"question_{i}_question"] = (question_data["question"], None, None)
+                continue
+            offset = len(bit_weights)
+            self.question_offsets.append(offset)
+            bit_weights.append((question_weights[i], zero))
+            self._fingerprint_keys[f"question_{i}_question"] = (
+                question_data["question"], 1 << offset, f"question_{i}"
+            )
+            options = []
+            for j, follow_up in enumerate(question_data.get("follow_up_questions", [])):
+                option_bits = {}
+                for k, option in enumerate(follow_up["options"]):
+                    if option == NONE_OPTION:
+                        continue
+                    option_bits[option] = 1 << len(bit_weights)
+                    weights = self.symptom_weights.get(option, zero)
+                    bit_weights.append((weights, weights))
+                    options.append((j, k, option))
+                self._fingerprint_keys[f"question_{i}_follow_up_{j}"] = option_bits
+            self.question_options.append(tuple(options))
+        self.question_offsets = tuple(self.question_offsets)
+        self.question_options = tuple(self.question_options)
+        self.fingerprint_width = len(bit_weights)
+        self.bit_weights = tuple(bit_weights)
+
+    def _mask_weights(self, mask):
+        """スロットのビットマスクに対応する重みベクトルの合計"""
+        total = [0] * len(self.constitution_types)
+        slot = 0
+        while mask:
+            if mask & 1:
+                total = [a + b for a, b in zip(total, self.slot_weights[slot])]
+            mask >>= 1
+            slot += 1
+        return tuple(total)
+
+    def _mask_slots(self, mask):
+        """スロットのビットマスクをスロット番号のタプルへ変換"""
+        return tuple(slot for slot in range(len(self.slot_texts)) if mask >> slot & 1)
+
+    def _match_question(self, text):
+        """質問文に含まれるルール質問を部分一致で求める（コンパイル時のみ）"""
+        mask = 0
+        for slot, rule_text in enumerate(self.slot_texts):
+            if rule_text in text:
+                mask |= 1 << slot
+        return mask, self._mask_weights(mask), self._mask_slots(mask)
+
+    def raw_scores(self, responses):
+        """回答から体質別の (得点, 満点) ベクトルを計算"""
+        score = [0] * len(self.constitution_types)
+        max_score = list(self.primary_max)
+        claimed = 0
+
+        for key, value in responses.items():
+            if "_question" in key:
+                entry = self._question_entries.get(value)
+                if entry is None:
+                    # 既知の質問文でない場合のみ部分一致で判定
+                    entry = self._match_question(value)
+                mask, weights, _ = entry
+                new_slots = mask & ~claimed
+                if new_slots:
+                    claimed |= new_slots
+                    if responses.get(key.replace("_question", "")) == YES_ANSWER:
+                        if new_slots != mask:
+                            weights = self._mask_weights(new_slots)
+                        score = [a + b for a, b in zip(score, weights)]
+
+            if "follow_up" in key and value != NONE_OPTION:
+                # 複数選択の場合（カンマ区切り）
+                for item in value.split(','):
+                    weights = self.symptom_weights.get(item.strip())
+                    if weights is not None:
+                        score = [a + b for a, b in zip(score, weights)]
+                        max_score = [a + b for a, b in zip(max_score, weights)]
+
+        return score, max_score
+
+    def features(self, responses):
+        """回答を特徴量番号のリストへ変換（一括診断用）
+
+        同じ症状が複数回選択された場合は、その回数だけ特徴量番号を含む。
+        """
+        features = []
+        claimed = 0
+
+        for key, value in responses.items():
+            if "_question" in key:
+                entry = self._question_entries.get(value)
+                if entry is None:
+                    entry = self._match_question(value)
+                mask, _, slots = entry
+                new_slots = mask & ~claimed
+                if new_slots:
+                    claimed |= new_slots
+                    if responses.get(key.replace("_question", "")) == YES_ANSWER:
+                        if new_slots != mask:
+                            slots = self._mask_slots(new_slots)
+                        features.extend(slots)
+
+            if "follow_up" in key and value != NONE_OPTION:
+                for item in value.split(','):
+                    feature = self._symptom_feature.get(item.strip())
+                    if feature is not None:
+                        features.append(feature)
+
+        return features
+
+    def weight_matrices(self):
+        """一括診断用の (得点の重み行列, 満点の重み行列, プライマリ満点ベクトル)
+
+        重み行列の形状は (特徴量数, 体質タイプ数)。
+        """
+        symptom_rows = [self.symptom_weights[s] for s in self.symptom_texts]
+        zero_rows = [(0,) * len(self.constitution_types)] * len(self.slot_texts)
+        score_weights = np.array(list(self.slot_weights) + symptom_rows, dtype=np.float64)
+        max_weights = np.array(zero_rows + symptom_rows, dtype=np.float64)
+        return score_weights, max_weights, np.array(self.primary_max, dtype=np.float64)
+
+    def fingerprint(self, responses):
+        """構造化回答のフィンガープリント（ビットセット整数）を求める
+
+        app.py の回答形式（question_{i}, question_{i}_question,
+        question_{i}_follow_up_{j}）に沿った回答のみが対象で、それ以外の形式
+        （質問文の不一致、同じ選択肢の重複など）の場合は None を返す。
+        自由記述の内容はフィンガープリントに含まれない。
+        """
+        if not self.exclusive:
+            return None
+
+        bits = 0
+        for key, value in responses.items():
+            entry = self._fingerprint_keys.get(key)
+            if entry is None:
+                if "_question" in key or "follow_up" in key:
+                    return None
+                continue
+
+            if isinstance(entry, tuple):
+                text, yes_bit, answer_key = entry
+                if value != text:
+                    return None
+                if yes_bit is not None and responses.get(answer_key) == YES_ANSWER:
+                    bits |= yes_bit
+            elif value != NONE_OPTION:
+                for item in value.split(','):
+                    item = item.strip()
+                    bit = entry.get(item)
+                    if bit is None:
+                        if item in self.symptom_weights:
+                            return None
+                        continue
+                    if bits & bit:
+                        return None
+                    bits |= bit
+
+        return bits
+
+    def fingerprint_bits(self, fingerprints):
+        """フィンガープリントのリストを (件数, fingerprint_width) の 0/1 行列（uint8）へ展開"""
+        width = self.fingerprint_width
+        byte_count = (width + 7) // 8 or 1
+        buffer = b"".join(fingerprint.to_bytes(byte_count, "little") for fingerprint in fingerprints)
+        packed = np.frombuffer(buffer, dtype=np.uint8).reshape(len(fingerprints), byte_count)
+        return np.unpackbits(packed, axis=1, bitorder="little")[:, :width]
+
+    def fingerprint_feature_matrix(self):
+        """フィンガープリントのビット -> 特徴量の出現回数の変換行列（形状は (fingerprint_width, 特徴量数)）
+
+        fingerprint_bits() の結果との行列積が features() の出現回数と一致する
+        （フィンガープリントを持つ回答は質問文の重複も選択肢の重複もないため）。
+        """
+        matrix = np.zeros((self.fingerprint_width, self.feature_count), dtype=np.float64)
+        for i, question_data in enumerate(self.questions):
+            offset = self.question_offsets[i]
+            if offset is None:
+                continue
+            matrix[offset, list(self._question_entries[question_data["question"]][2])] = 1
+            for n, (_, _, option) in enumerate(self.question_options[i]):
+                feature = self._symptom_feature.get(option)
+                if feature is not None:
+                    matrix[offset + 1 + n, feature] = 1
+        return matrix
+
+    def decode_fingerprint(self, fingerprint):
+        """フィンガープリントを app.py 形式の回答辞書に戻す（自由記述は空）"""
+        responses = {}
+        for i, question_data in enumerate(self.questions):
+            offset = self.question_offsets[i]
+            if offset is None:
+                responses[f"question_{i}"] = ""
+                responses[f"question_{i}_question"] = question_data["question"]
+                continue
+            answered_yes = fingerprint >> offset & 1
+            responses[f"question_{i}"] = YES_ANSWER if answered_yes else question_data["options"][-1]
+            responses[f"question_{i}_question"] = question_data["question"]
+
+            selected = {}
+            for n, (j, _, option) in enumerate(self.question_options[i]):
+                if fingerprint >> (offset + 1 + n) & 1:
+                    selected.setdefault(j, []).append(option)
+            if answered_yes or selected:
+                for j in range(len(question_data.get("follow_up_questions", []))):
+                    options = selected.get(j)
+                    responses[f"question_{i}_follow_up_{j}"] = ", ".join(options) if options else NONE_OPTION
+        return responses
+
+    def fingerprint_raw_scores(self, fingerprint):
+        """フィンガープリントから体質別の (得点, 満点) ベクトルを計算"""
+        score = [0] * len(self.constitution_types)
+        max_score = list(self.primary_max)
+        while fingerprint:
+            low_bit = fingerprint & -fingerprint
+            score_weights, max_weights = self.bit_weights[low_bit.bit_length() - 1]
+            score = [a + b for a, b in zip(score, score_weights)]
+            max_score = [a + b for a, b in zip(max_score, max_weights)]
+            fingerprint ^= low_bit
+        return score, max_score
+
+    def fingerprint_scores(self, fingerprint):
+        """フィンガープリントから体質別の正規化スコア（0-100）をタプルで計算"""
+        return self.normalize(*self.fingerprint_raw_scores(fingerprint))
+
+    def normalize(self, score, max_score):
+        """(得点, 満点) ベクトルを体質タイプ順の正規化スコア（0-100）のタプルに変換"""
+        return tuple((s / m) * 100 if m > 0 else 0 for s, m in zip(score, max_score))
+
+    def scores(self, responses):
+        """体質別の正規化スコア（0-100）を計算"""
+        return dict(zip(self.constitution_types, self.normalize(*self.raw_scores(responses))))
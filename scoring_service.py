@@ -0,0 +1,282 @@
+"""診断エンジンの JSON API サーバー（aiohttp）
+
+Streamlit の画面を経由せずに、提携先のシステムから回答を送って診断結果を受け取るための
+HTTP サービス。診断エンジンはプロセスごとに一度だけ構築し、各リクエストはメモリ上の
+インデックスとキャッシュだけで処理する。保存を指定した結果は write_behind の書き込みキューに
+登録するため、レスポンスはデータベースへの書き込みを待たない。
+
+エンドポイント:
+    POST /v1/diagnose        {"responses": 回答, "user": {"age": ..., "gender": ...}, "persist": true}
+    POST /v1/diagnose/batch  {"items": [{"responses": 回答, "user": {...}}, ...], "persist": true}
+    GET  /v1/questionnaire   現在の質問票とバージョン（コンパクト形式の作成用）
+    GET  /healthz            稼働確認（使用中のルールの version を含む）
+    GET  /metrics            処理段階ごとの所要時間（Prometheus のテキスト形式）
+
+回答は response_codec のコンパクト形式（{"v": ..., "a": [...], "t": [...]}）または
+app.py と同じ形式の辞書のどちらでもよい。デコード後の辞書は現在の質問票のキーと文字列の値のみ
+受け付け、それ以外は 400 を返す。user の age / gender は画面と同じ選択肢（tcm_data の AGE_OPTIONS /
+GENDER_OPTIONS）のいずれかか空文字列のみ受け付ける。
+
+環境変数:
+    SCORING_MAX_CONCURRENCY=64      同時に処理するリクエスト数の上限
+    SCORING_QUEUE_TIMEOUT=1.0       上限に達したときに待つ秒数（超えたら 503 を返す）
+    SCORING_MAX_BATCH=1000          バッチ1回あたりの最大件数
+    SCORING_MAX_BODY_BYTES=8388608  リクエスト本文の最大バイト数
+    SCORING_KEEPALIVE_SECONDS=75    Keep-Alive 接続を維持する秒数
+    SCORING_PERSIST=0               persist を省略したリクエストの結果を保存するか
+
+使い方:
+    python scoring_service.py [--host 0.0.0.0] [--port 8080] [--workers 4]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+from functools import partial
+
+from aiohttp import web
+
+from diagnosis_engine import get_engine
+from instrumentation import prometheus_text, span
+from response_codec import CURRENT_VERSION, QUESTIONNAIRES, decode_responses
+from tcm_data import AGE_OPTIONS, GENDER_OPTIONS
+from write_behind import get_writer
+
+
+def _env_bool(name, default):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+MAX_CONCURRENCY = int(os.getenv('SCORING_MAX_CONCURRENCY', '64'))
+QUEUE_TIMEOUT = float(os.getenv('SCORING_QUEUE_TIMEOUT', '1.0'))
+MAX_BATCH = int(os.getenv('SCORING_MAX_BATCH', '1000'))
+MAX_BODY_BYTES = int(os.getenv('SCORING_MAX_BODY_BYTES', str(8 * 1024 * 1024)))
+KEEPALIVE_SECONDS = float(os.getenv('SCORING_KEEPALIVE_SECONDS', '75'))
+PERSIST_DEFAULT = _env_bool('SCORING_PERSIST', False)
+
+ENGINE = web.AppKey("engine", object)
+WRITER = web.AppKey("writer", object)
+SEMAPHORE = web.AppKey("semaphore", asyncio.Semaphore)
+SETTINGS = web.AppKey("settings", dict)
+
+_dumps = partial(json.dumps, ensure_ascii=False)
+
+
+def _json(data, status=200):
+    return web.json_response(data, status=status, dumps=_dumps)
+
+
+class RequestError(ValueError):
+    """リクエストの内容が不正（400 を返す）"""
+
+
+def _response_keys(questions):
+    """回答の辞書で受け付けるキー（app.py の collect_responses() と同じ形）"""
+    keys = set()
+    for i, question_data in enumerate(questions):
+        keys.update((f"question_{i}", f"question_{i}_question"))
+        keys.update(f"question_{i}_follow_up_{j}" for j in range(len(question_data.get("follow_up_questions", []))))
+    return frozenset(keys)
+
+
+RESPONSE_KEYS = _response_keys(QUESTIONNAIRES[CURRENT_VERSION])
+# 利用者情報として受け付ける値（空文字列は未回答）
+USER_OPTIONS = {"age": AGE_OPTIONS, "gender": GENDER_OPTIONS}
+
+
+@web.middleware
+async def concurrency_limit(request, handler):
+    """同時に処理するリクエスト数を制限（待ち時間が QUEUE_TIMEOUT を超えたら 503）"""
+    if request.method != "POST":
+        return await handler(request)
+    semaphore = request.app[SEMAPHORE]
+    try:
+        await asyncio.wait_for(semaphore.acquire(), request.app[SETTINGS]["queue_timeout"])
+    except asyncio.TimeoutError:
+        return web.json_response(
+            {"error": "too many concurrent requests"}, status=503, headers={"Retry-After": "1"}
+        )
+    try:
+        return await handler(request)
+    finally:
+        semaphore.release()
+
+
+@web.middleware
+async def request_errors(request, handler):
+    """RequestError を 400 のエラーレスポンスに変換"""
+    try:
+        return await handler(request)
+    except RequestError as e:
+        return _json({"error": str(e)}, status=400)
+
+
+async def _read_json(request):
+    try:
+        body = await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        raise RequestError("request body must be JSON") from None
+    if not isinstance(body, dict):
+        raise RequestError("request body must be a JSON object")
+    return body
+
+
+def _parse_item(item):
+    """1件分の {"responses": ..., "user": ...} を (回答の辞書, 利用者情報) に変換"""
+    if not isinstance(item, dict) or not isinstance(item.get("responses"), dict):
+        raise RequestError("each item needs a \"responses\" object")
+    user = item.get("user") or {}
+    if not isinstance(user, dict):
+        raise RequestError("\"user\" must be an object")
+    try:
+        responses = decode_responses(item["responses"])
+    except (ValueError, TypeError, IndexError) as e:
+        raise RequestError(f"invalid responses: {e}") from None
+    # 診断エンジンは文字列の回答のみを想定しているため、型の誤りはここで 400 にする
+    for key, value in responses.items():
+        if key not in RESPONSE_KEYS:
+            raise RequestError(f"unknown response key: {key}")
+        if not isinstance(value, str):
+            raise RequestError(f"response {key} must be a string")
+    # 集計の区分と列の長さに収まるよう、画面の選択肢以外の値は 400 にする
+    user_data = {}
+    for field, options in USER_OPTIONS.items():
+        value = user.get(field, "")
+        if value != "" and value not in options:
+            raise RequestError(f"user.{field} must be one of: {', '.join(options)}")
+        user_data[field] = value
+    return responses, user_data
+
+
+def _persist(request, body):
+    persist = body.get("persist", request.app[SETTINGS]["persist"])
+    if not isinstance(persist, bool):
+        raise RequestError("\"persist\" must be a boolean")
+    return persist
+
+
+async def diagnose(request):
+    body = await _read_json(request)
+    responses, user_data = _parse_item(body)
+    persist = _persist(request, body)
+    with span("service.diagnose"):
+        result = request.app[ENGINE]().diagnose(responses)
+    if persist:
+        request.app[WRITER].submit(user_data, result, responses)
+    return _json(result)
+
+
+async def diagnose_batch(request):
+    body = await _read_json(request)
+    items = body.get("items")
+    if not isinstance(items, list):
+        raise RequestError("\"items\" must be a list")
+    if len(items) > request.app[SETTINGS]["max_batch"]:
+        raise RequestError(f"at most {request.app[SETTINGS]['max_batch']} items per batch")
+    parsed = []
+    for n, item in enumerate(items):
+        try:
+            parsed.append(_parse_item(item))
+        except RequestError as e:
+            raise RequestError(f"items[{n}]: {e}") from None
+    persist = _persist(request, body)
+    engine = request.app[ENGINE]()
+
+    # 大きなバッチでもイベントループを止めないよう、診断はスレッドで実行する
+    def score():
+        with span("service.diagnose_batch", rows=len(parsed)):
+            return engine.diagnose_batch([responses for responses, _ in parsed])
+
+    results = await asyncio.to_thread(score) if parsed else []
+    if persist:
+        writer = request.app[WRITER]
+        for (responses, user_data), result in zip(parsed, results):
+            writer.submit(user_data, result, responses)
+    return _json({"results": results})
+
+
+async def questionnaire(request):
+    return _json({"version": CURRENT_VERSION, "questions": QUESTIONNAIRES[CURRENT_VERSION]})
+
+
+async def healthz(request):
+    return _json({"status": "ok", "rule_version": request.app[ENGINE]().rule_version})
+
+
+async def metrics(request):
+    return web.Response(text=prometheus_text(), content_type="text/plain", charset="utf-8")
+
+
+def create_app(engine=None, writer=None, max_concurrency=MAX_CONCURRENCY, queue_timeout=QUEUE_TIMEOUT,
+               max_batch=MAX_BATCH, persist=PERSIST_DEFAULT, client_max_size=MAX_BODY_BYTES):
+    """API サーバーの Application を作成（engine / writer 省略時はプロセス共有のものを使う）"""
+    app = web.Application(middlewares=[concurrency_limit, request_errors], client_max_size=client_max_size)
+    # ルールファイルの再読み込みでエンジンが差し替わるため、リクエストごとに取得する
+    app[ENGINE] = (lambda: engine) if engine is not None else get_engine
+    app[ENGINE]()  # 最初のリクエストより前にエンジンを構築しておく
+    app[WRITER] = writer or get_writer()
+    app[SEMAPHORE] = asyncio.Semaphore(max_concurrency)
+    app[SETTINGS] = {"queue_timeout": queue_timeout, "max_batch": max_batch, "persist": persist}
+    app.router.add_post("/v1/diagnose", diagnose)
+    app.router.add_post("/v1/diagnose/batch", diagnose_batch)
+    app.router.add_get("/v1/questionnaire", questionnaire)
+    app.router.add_get("/healthz", healthz)
+    app.router.add_get("/metrics", metrics)
+
+    async def start_writer(app):
+        # 保存する場合に備えて、接続の準備を最初のリクエストより前に済ませる
+        app[WRITER].start()
+
+    async def close_writer(app):
+        # キューに残った結果を書き出す（サーバープロセスでは atexit が呼ばれないため）
+        await asyncio.to_thread(app[WRITER].close)
+
+    app.on_startup.append(start_writer)
+    app.on_cleanup.append(close_writer)
+    return app
+
+
+def serve(host, port, reuse_port=False):
+    web.run_app(
+        create_app(), host=host, port=port, keepalive_timeout=KEEPALIVE_SECONDS,
+        reuse_port=reuse_port, access_log=None, print=None
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="診断エンジンの JSON API サーバー")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8080")))
+    parser.add_argument("--workers", type=int, default=1,
+                        help="サーバープロセス数（2以上では SO_REUSEPORT で同じポートを共有する）")
+    args = parser.parse_args(argv)
+
+    print(f"serving on http://{args.host}:{args.port} ({args.workers} workers)", flush=True)
+    if args.workers <= 1:
+        serve(args.host, args.port)
+        return
+    import database
+    if database.AUTO_MIGRATE:
+        # 各プロセスが同時にテーブルを作成しないよう、起動前に一度だけ作成しておく
+        database.get_db_engine().dispose()
+    processes = [
+        multiprocessing.Process(target=serve, args=(args.host, args.port, True))
+        for _ in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # 各プロセスは SIGINT を受けて書き込みキューを書き出してから終了する
+        for process in processes:
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
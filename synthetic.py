@@ -0,0 +1,123 @@
+"""ベンチマーク・負荷試験用の合成回答データ
+
+app.py と同じキー体系（question_{i}, question_{i}_question, question_{i}_follow_up_{j}）で
+TCM_QUESTIONS から回答の辞書を生成する。「はい」の割合、フォローアップの選択率、
+自由記述の長さを指定できる。
+
+使い方:
+    python synthetic.py --count 10000 --output corpus.jsonl [--seed 0] [--yes-rate 0.4]
+"""
+import argparse
+import json
+import random
+import sys
+
+from tcm_data import TCM_QUESTIONS, AGE_OPTIONS, GENDER_OPTIONS
+
+YES_ANSWER = "はい"
+NONE_OPTION = "どれも当てはまらない"
+
+# 自由記述の材料（診断エンジンのキーワードを含む症状表現と、含まないつなぎの表現）
+SYMPTOM_PHRASES = [
+    "疲れが取れない", "体がだるい", "食欲がない", "軟便気味", "手足の冷え",
+    "イライラする", "ストレスが多い", "ため息が出る", "生理前に不調",
+    "むくみやすい", "体が重い", "雨の日に頭痛", "胃がぽちゃぽちゃする",
+    "めまいがする", "立ちくらみ", "動悸がある", "不眠気味", "肌の乾燥",
+    "肩こり", "生理痛がひどい", "しみが増えた", "あざができやすい",
+]
+FILLER_PHRASES = ["最近", "仕事が忙しく", "朝起きると", "季節の変わり目に", "なんとなく", "夜になると"]
+
+
+def generate_free_text(rng, length):
+    """おおよそ length 文字の自由記述を生成（0 なら空文字列）"""
+    if length <= 0:
+        return ""
+    parts = []
+    size = 0
+    while size < length:
+        phrase = rng.choice(SYMPTOM_PHRASES if rng.random() < 0.6 else FILLER_PHRASES)
+        parts.append(phrase)
+        size += len(phrase) + 1
+    return "、".join(parts)[:length]
+
+
+def generate_responses(rng, yes_rate=0.5, option_rate=0.3, free_text_length=30, questions=TCM_QUESTIONS):
+    """app.py の質問票と同じ形式の回答を1件生成
+
+    Args:
+        rng: random.Random
+        yes_rate: 各質問に「はい」と答える確率
+        option_rate: フォローアップの各選択肢にチェックを入れる確率
+        free_text_length: 自由記述のおおよその文字数（0 で未記入）
+    """
+    responses = {}
+    for i, question_data in enumerate(questions):
+        if question_data.get('type') == 'free_text':
+            responses[f"question_{i}"] = generate_free_text(rng, free_text_length)
+            responses[f"question_{i}_question"] = question_data['question']
+            continue
+
+        options = question_data['options']
+        response = YES_ANSWER if rng.random() < yes_rate else next(o for o in options if o != YES_ANSWER)
+        responses[f"question_{i}"] = response
+        responses[f"question_{i}_question"] = question_data['question']
+
+        if response == YES_ANSWER and 'follow_up_questions' in question_data:
+            for j, follow_up in enumerate(question_data['follow_up_questions']):
+                selected_options = [
+                    option for option in follow_up['options']
+                    if option != NONE_OPTION and rng.random() < option_rate
+                ]
+                if selected_options:
+                    responses[f"question_{i}_follow_up_{j}"] = ", ".join(selected_options)
+                else:
+                    responses[f"question_{i}_follow_up_{j}"] = NONE_OPTION
+    return responses
+
+
+def generate_user(rng):
+    """基本情報（年齢・性別）を1件生成"""
+    return {'age': rng.choice(AGE_OPTIONS), 'gender': rng.choice(GENDER_OPTIONS)}
+
+
+def generate_corpus(count, seed=0, **kwargs):
+    """回答を count 件生成するジェネレーター（同じ seed なら同じ内容）"""
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield generate_responses(rng, **kwargs)
+
+
+def add_generation_arguments(parser):
+    """生成条件のコマンドライン引数を追加（ベンチマーク・負荷試験と共通）"""
+    parser.add_argument("--seed", type=int, default=0, help="乱数シード")
+    parser.add_argument("--yes-rate", type=float, default=0.5, help="「はい」と答える確率")
+    parser.add_argument("--option-rate", type=float, default=0.3, help="フォローアップの選択肢を選ぶ確率")
+    parser.add_argument("--free-text-length", type=int, default=30, help="自由記述のおおよその文字数")
+
+
+def generation_options(args):
+    return {
+        "yes_rate": args.yes_rate,
+        "option_rate": args.option_rate,
+        "free_text_length": args.free_text_length,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="合成回答データを JSON Lines で出力")
+    parser.add_argument("--count", type=int, default=1000, help="生成件数")
+    parser.add_argument("--output", default="-", help="出力ファイル（- で標準出力）")
+    add_generation_arguments(parser)
+    args = parser.parse_args(argv)
+
+    out = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    try:
+        for responses in generate_corpus(args.count, seed=args.seed, **generation_options(args)):
+            out.write(json.dumps(responses, ensure_ascii=False) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
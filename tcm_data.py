@@ -113,6 +113,10 @@ TCM_QUESTIONS = [
     }
 ]
 
+# 基本情報の選択肢
+AGE_OPTIONS = ["20歳未満", "20-29歳", "30-39歳", "40-49歳", "50-59歳", "60歳以上"]
+GENDER_OPTIONS = ["男性", "女性", "その他"]
+
 # 体質タイプの定義（5つのタイプ）
 CONSTITUTION_TYPES = {
     "気虚": {
@@ -0,0 +1,18 @@
+"""テスト共通の設定
+
+リポジトリ直下のモジュールを読み込めるようにし、データベースは一時ディレクトリの SQLite を使う
+（DATABASE_URL を指定した場合はそのデータベース。テスト用の行が追加・削除される）。
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_tmp_dir = tempfile.mkdtemp(prefix="tcm_tests_")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(_tmp_dir, 'test.db')}")
+os.environ.setdefault("DIAGNOSIS_JITTER", "off")
+os.environ.setdefault("DIAGNOSIS_SPILL_PATH", os.path.join(_tmp_dir, "pending_diagnoses.jsonl"))
+os.environ.setdefault("DIAGNOSIS_SCORE_TABLE_DIR", os.path.join(_tmp_dir, "score_tables"))
+os.environ.setdefault("DIAGNOSIS_RULES_RELOAD_SECONDS", "0")
@@ -0,0 +1,19 @@
+"""diagnose_batch() が diagnose() と同じ結果を返すこと（jitter="off"）"""
+import random
+
+from diagnosis_engine import DiagnosisEngine
+from synthetic import generate_responses
+
+
+def test_batch_matches_scalar_including_irregular_responses():
+    engine = DiagnosisEngine(jitter="off")
+    responses_list = [generate_responses(random.Random(seed)) for seed in range(500)]
+    # フィンガープリントを持たない回答（未知の質問文、重複した選択肢）と空の回答
+    irregular = dict(responses_list[0], question_0_question="未知の質問")
+    follow_up_key = next(key for key in responses_list[1] if "follow_up" in key)
+    duplicated = dict(responses_list[1], **{follow_up_key: "疲れやすい, 疲れやすい"})
+    responses_list += [irregular, duplicated, {}, dict(responses_list[2])]
+
+    batch = engine.diagnose_batch(responses_list)
+
+    assert batch == [engine.diagnose(responses) for responses in responses_list]
@@ -0,0 +1,63 @@
+"""get_diagnosis_stats() の集計元（diagnosis_results / diagnosis_rollups）による差がないことの確認"""
+from datetime import datetime
+
+import pytest
+from sqlalchemy import delete
+
+import database
+from database import DiagnosisResult, DiagnosisRollup, open_session
+
+
+@pytest.fixture
+def empty_tables():
+    database.create_tables()
+    db = open_session()
+    try:
+        db.execute(delete(DiagnosisResult))
+        db.execute(delete(DiagnosisRollup))
+        db.commit()
+    finally:
+        db.close()
+
+
+def _row(constitution_type, age, gender):
+    return {
+        'timestamp': datetime(2025, 1, 1, 12, 0),
+        'age': age,
+        'gender': gender,
+        'constitution_type': constitution_type,
+        'score': 50.0,
+        'confidence': 70.0,
+        'responses': {},
+        'free_text_concern': '',
+        'all_scores': {},
+        'rule_version': None,
+    }
+
+
+def _stats(monkeypatch, rollups):
+    monkeypatch.setattr(database, 'ROLLUPS_ENABLED', rollups)
+    stats = database.get_diagnosis_stats()
+    return {key: sorted(value) if isinstance(value, list) else value for key, value in stats.items()}
+
+
+def test_rollup_stats_match_direct_stats_with_nulls(empty_tables, monkeypatch):
+    rows = [
+        _row('気虚', '30-39歳', '女性'),
+        _row('気虚', None, '女性'),
+        _row(None, '30-39歳', None),
+        _row('瘀血', '', None),
+    ]
+    monkeypatch.setattr(database, 'ROLLUPS_ENABLED', True)
+    database.save_diagnosis_rows(rows)
+
+    rolled = _stats(monkeypatch, rollups=True)
+    direct = _stats(monkeypatch, rollups=False)
+    assert rolled == direct
+    assert rolled['total_diagnoses'] == 4
+    assert database.AgeCount('', 2) in rolled['age_stats']
+    assert database.GenderCount('', 2) in rolled['gender_stats']
+    assert database.ConstitutionCount('', 1) in rolled['constitution_stats']
+
+    database.rebuild_rollups()
+    assert _stats(monkeypatch, rollups=True) == direct
@@ -0,0 +1,67 @@
+"""reload_engine() によるルールの差し替えと、キャッシュ・スコアテーブルの引き継ぎ"""
+import json
+import random
+
+import pytest
+
+import diagnosis_engine
+from diagnosis_engine import DiagnosisEngine, get_engine, reload_engine
+from rule_sets import RuleSetError, default_rule_set
+from synthetic import generate_responses
+
+RESPONSES = [generate_responses(random.Random(seed)) for seed in range(200)]
+
+
+@pytest.fixture
+def current_engine(monkeypatch):
+    """差し替え前のエンジン（テスト後に元に戻す）。キャッシュを温めておく"""
+    engine = get_engine()
+    monkeypatch.setattr(diagnosis_engine, "_default_engine", engine)
+    for responses in RESPONSES:
+        engine.diagnose(responses)
+    return engine
+
+
+def _write_rules(tmp_path, rule_set):
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps(rule_set, ensure_ascii=False), encoding="utf-8")
+    return str(path)
+
+
+def test_reordered_constitutions_do_not_reuse_cache_or_table(tmp_path, current_engine):
+    rule_set = default_rule_set()
+    rule_set["version"] = "reordered"
+    rule_set["diagnosis_rules"] = dict(reversed(list(rule_set["diagnosis_rules"].items())))
+
+    engine = reload_engine(_write_rules(tmp_path, rule_set))
+
+    assert engine is get_engine()
+    assert engine.scoring_index.constitution_types == tuple(reversed(current_engine.scoring_index.constitution_types))
+    assert engine.score_cache is not current_engine.score_cache
+    assert engine.score_table is not current_engine.score_table
+    reference = DiagnosisEngine(jitter="off", cache_size=0, rule_set=rule_set)
+    for responses in RESPONSES:
+        expected = reference.diagnose(responses)["all_scores"]
+        assert engine.diagnose(responses)["all_scores"] == expected
+        # 並び順を変えても体質タイプごとのスコアは変わらない
+        assert expected == current_engine.diagnose(responses)["all_scores"]
+
+
+def test_keyword_only_change_reuses_cache(tmp_path, current_engine):
+    rule_set = default_rule_set()
+    rule_set["version"] = "keywords"
+    rule_set["free_text_keywords"]["気虚"].append("だるおも")
+
+    engine = reload_engine(_write_rules(tmp_path, rule_set))
+
+    assert engine.score_cache is current_engine.score_cache
+    assert engine.keyword_matcher is not current_engine.keyword_matcher
+
+
+def test_reorder_without_version_change_is_rejected(tmp_path, current_engine):
+    rule_set = default_rule_set()
+    rule_set["diagnosis_rules"] = dict(reversed(list(rule_set["diagnosis_rules"].items())))
+
+    with pytest.raises(RuleSetError):
+        reload_engine(_write_rules(tmp_path, rule_set))
+    assert get_engine() is current_engine
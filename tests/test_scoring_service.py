@@ -0,0 +1,106 @@
+"""scoring_service の入力検証（型の誤りは 500 ではなく 400 を返す）"""
+import asyncio
+import random
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+from diagnosis_engine import DiagnosisEngine
+from response_codec import CURRENT_VERSION, encode_responses
+from scoring_service import create_app
+from synthetic import generate_responses, generate_user
+
+
+class RecordingWriter:
+    def __init__(self):
+        self.rows = []
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def submit(self, user_data, diagnosis_result, responses):
+        self.rows.append((user_data, diagnosis_result, responses))
+
+
+def _post(path, body, writer=None):
+    async def run():
+        app = create_app(engine=DiagnosisEngine(jitter="off"), writer=writer or RecordingWriter())
+        async with TestClient(TestServer(app)) as client:
+            response = await client.post(path, json=body)
+            return response.status, await response.json()
+    return asyncio.run(run())
+
+
+INVALID_RESPONSES = [
+    pytest.param({"question_0_question": 5}, id="int-question-text"),
+    pytest.param({"question_0": ["x"]}, id="list-answer"),
+    pytest.param({"question_0": "はい", "question_0_follow_up_0": 1}, id="int-follow-up"),
+    pytest.param({"question_10": 5}, id="int-free-text"),
+    pytest.param({"question_0": "はい", "extra": "x"}, id="unknown-key"),
+    pytest.param({"v": CURRENT_VERSION, "a": [0] * 10, "t": [123]}, id="compact-int-text"),
+]
+
+
+@pytest.mark.parametrize("responses", INVALID_RESPONSES)
+def test_diagnose_rejects_invalid_responses(responses):
+    status, body = _post("/v1/diagnose", {"responses": responses})
+    assert status == 400
+    assert "error" in body
+
+
+@pytest.mark.parametrize("responses", INVALID_RESPONSES)
+def test_diagnose_batch_rejects_invalid_responses(responses):
+    valid = generate_responses(random.Random(0))
+    status, body = _post("/v1/diagnose/batch", {"items": [{"responses": valid}, {"responses": responses}]})
+    assert status == 400
+    assert body["error"].startswith("items[1]: ")
+
+
+def test_diagnose_accepts_legacy_and_compact_responses():
+    engine = DiagnosisEngine(jitter="off")
+    responses = generate_responses(random.Random(1))
+    expected = engine.diagnose(responses)
+    for payload in (responses, encode_responses(responses)):
+        status, body = _post("/v1/diagnose", {"responses": payload})
+        assert status == 200
+        assert body["all_scores"] == expected["all_scores"]
+
+
+INVALID_USERS = [
+    pytest.param({"age": "x" * 51}, id="age-too-long"),
+    pytest.param({"age": "35"}, id="age-not-an-option"),
+    pytest.param({"age": 35}, id="int-age"),
+    pytest.param({"gender": "x" * 21}, id="gender-too-long"),
+    pytest.param({"gender": ["女性"]}, id="list-gender"),
+]
+
+
+@pytest.mark.parametrize("user", INVALID_USERS)
+def test_diagnose_rejects_invalid_user(user):
+    responses = generate_responses(random.Random(0))
+    status, body = _post("/v1/diagnose", {"responses": responses, "user": user, "persist": True})
+    assert status == 400
+    assert body["error"].startswith("user.")
+
+
+@pytest.mark.parametrize("user", INVALID_USERS)
+def test_diagnose_batch_rejects_invalid_user(user):
+    valid = generate_responses(random.Random(0))
+    items = [{"responses": valid}, {"responses": valid, "user": user}]
+    status, body = _post("/v1/diagnose/batch", {"items": items, "persist": True})
+    assert status == 400
+    assert body["error"].startswith("items[1]: user.")
+
+
+def test_diagnose_accepts_listed_or_empty_user():
+    writer = RecordingWriter()
+    responses = generate_responses(random.Random(2))
+    for user in (generate_user(random.Random(2)), {"age": "", "gender": ""}, {}):
+        status, _ = _post("/v1/diagnose", {"responses": responses, "user": user, "persist": True}, writer)
+        assert status == 200
+    assert [user_data for user_data, _, _ in writer.rows] == [
+        generate_user(random.Random(2)), {"age": "", "gender": ""}, {"age": "", "gender": ""}
+    ]
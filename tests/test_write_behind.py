@@ -0,0 +1,132 @@
+"""write_behind の書き込み失敗時の退避・隔離・再投入"""
+import json
+import subprocess
+import sys
+from datetime import datetime
+
+import pytest
+from sqlalchemy import exc
+
+from write_behind import DiagnosisWriter
+
+
+def _row(n, age="30代"):
+    return {
+        "timestamp": datetime(2024, 1, 1, 9, 0, n % 60),
+        "age": age,
+        "gender": "女性",
+        "constitution_type": "気虚",
+        "score": n,
+        "confidence": 0.5,
+        "responses": {"v": 1, "a": [0]},
+        "free_text_concern": "",
+        "all_scores": {"気虚": n},
+        "rule_version": "test",
+    }
+
+
+class FakeDatabase:
+    """age が長すぎる行は保存できず、down の間は接続エラーになる save_rows"""
+
+    def __init__(self):
+        self.rows = []
+        self.down = False
+
+    def save_rows(self, rows):
+        if self.down:
+            raise exc.OperationalError("INSERT", {}, Exception("could not connect to server"))
+        if any(len(row["age"]) > 50 for row in rows):
+            raise exc.DataError("INSERT", {}, Exception("value too long for type character varying(50)"))
+        self.rows.extend(rows)
+
+
+@pytest.fixture
+def database():
+    return FakeDatabase()
+
+
+@pytest.fixture
+def make_writer(tmp_path, database):
+    writers = []
+
+    def make():
+        writer = DiagnosisWriter(save_rows=database.save_rows, batch_size=10, flush_interval=0.01,
+                                 spill_path=str(tmp_path / "pending.jsonl"))
+        writers.append(writer)
+        return writer
+
+    yield make
+    for writer in writers:
+        writer.close()
+
+
+def _put(writer, rows):
+    writer.start()
+    for row in rows:
+        writer._queue.put(row)
+    writer.flush()
+
+
+def _read_lines(path):
+    return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+
+
+def test_row_that_can_never_be_saved_is_rejected(tmp_path, database, make_writer):
+    writer = make_writer()
+    rows = [_row(n) for n in range(5)] + [_row(5, age="x" * 51)] + [_row(n) for n in range(6, 12)]
+
+    _put(writer, rows)
+
+    assert sorted(row["score"] for row in database.rows) == [n for n in range(12) if n != 5]
+    assert [row["score"] for row in _read_lines(tmp_path / "pending.jsonl.rejected")] == [5]
+    assert not (tmp_path / "pending.jsonl").exists()
+    assert writer.stats()["rejected"] == 1
+
+
+def test_rejected_spilled_row_does_not_block_later_rows(tmp_path, database, make_writer):
+    spill = tmp_path / "pending.jsonl"
+    rows = [_row(0), _row(1, age="x" * 51)] + [_row(n) for n in range(2, 25)]
+    spill.write_text("".join(json.dumps(row, default=str, ensure_ascii=False) + "\n" for row in rows),
+                     encoding="utf-8")
+
+    writer = make_writer()
+    _put(writer, [_row(99)])
+
+    assert sorted(row["score"] for row in database.rows) == [0] + list(range(2, 25)) + [99]
+    assert [row["score"] for row in _read_lines(tmp_path / "pending.jsonl.rejected")] == [1]
+    assert not spill.exists()
+
+
+def test_connection_error_spills_and_replays(tmp_path, database, make_writer):
+    writer = make_writer()
+    database.down = True
+    _put(writer, [_row(n) for n in range(3)])
+
+    assert database.rows == []
+    assert len(_read_lines(tmp_path / "pending.jsonl")) == 3
+    assert not (tmp_path / "pending.jsonl.rejected").exists()
+
+    database.down = False
+    _put(writer, [_row(3)])
+
+    assert sorted(row["score"] for row in database.rows) == [0, 1, 2, 3]
+    assert not (tmp_path / "pending.jsonl").exists()
+
+
+def test_corrupt_lines_and_leftover_replays_are_recovered(tmp_path, database, make_writer):
+    spill = tmp_path / "pending.jsonl"
+    spill.write_text(json.dumps(_row(0), default=str) + "\n{not json\n[1, 2]\n", encoding="utf-8")
+    # 再投入の途中で終了したプロセスが残したファイル
+    dead_pid = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    leftover = tmp_path / f"pending.jsonl.{dead_pid}.replay"
+    leftover.write_text(json.dumps(_row(1), default=str) + "\n", encoding="utf-8")
+
+    writer = make_writer()
+    _put(writer, [_row(2)])
+
+    assert sorted(row["score"] for row in database.rows) == [0, 1, 2]
+    assert (tmp_path / "pending.jsonl.corrupt").read_text(encoding="utf-8").splitlines() == ["{not json", "[1, 2]"]
+    assert not leftover.exists()
+    assert not spill.exists()
+    assert writer._thread.is_alive()
@@ -0,0 +1,230 @@
+"""diagnosis_rules の重みの感度分析（ウェイトスイープ）
+
+固定した回答コーパスを一度だけ特徴量行列にエンコードし、重みを変えた多数の候補
+（バリアント）で再スコアリングして、体質タイプの分布と信頼度がどう変わるかを集計する。
+重み行列はルールの各重みの線形和なので、バリアントの重みベクトルをまとめて
+重み行列に変換し、行列積でブロック単位に一括評価する。
+
+信頼度の微調整（jitter）は適用しない。基準（重みを変えない場合）の結果は
+DiagnosisEngine(jitter="off").diagnose_batch() と一致する。
+
+使い方:
+    python weight_sweep.py --input corpus.jsonl --mode random --variants 2000 [--scale 1] [--output sweep.jsonl]
+    python weight_sweep.py --mode one-at-a-time --deltas -2,-1,1,2   # --input 省略時は diagnosis_results から読み込む
+"""
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+from diagnosis_engine import DiagnosisEngine
+
+SWEEP_MODES = ("random", "one-at-a-time")
+# 1ブロックで評価する (バリアント数 x 件数 x 体質タイプ数) の上限要素数
+BLOCK_ELEMENTS = 2_000_000
+
+
+class WeightSweep:
+    """エンコード済みのコーパスに対して重みのバリアントを一括評価する"""
+
+    def __init__(self, engine, responses_list):
+        index = engine.scoring_index
+        self.constitution_types = index.constitution_types
+        self.entries = index.rule_entries
+        self.base_weights = np.array([entry[3] for entry in self.entries], dtype=np.float64)
+        self.answers, self.free_text_scores = engine.encode_batch(responses_list)
+
+        # ルールの重み -> 重み行列（特徴量 x 体質タイプを平坦化）への線形写像
+        size = len(self.constitution_types)
+        self._shape = (index.feature_count, size)
+        self._score_basis = np.zeros((len(self.entries), index.feature_count * size))
+        self._max_basis = np.zeros_like(self._score_basis)
+        self._primary_basis = np.zeros((len(self.entries), size))
+        for e, (constitution_type, section, _, _, feature) in enumerate(self.entries):
+            column = self.constitution_types.index(constitution_type)
+            self._score_basis[e, feature * size + column] = 1
+            if section == "primary_questions":
+                self._primary_basis[e, column] = 1
+            else:
+                self._max_basis[e, feature * size + column] = 1
+
+        self.baseline = self.evaluate(self.base_weights[None, :])
+        self.baseline = {key: value[0] for key, value in self.baseline.items()}
+
+    def evaluate(self, weights):
+        """重みのバリアント (バリアント数 x ルールの重み数) を評価
+
+        Returns:
+            dict: best_index, confidence（いずれも バリアント数 x 件数 の配列）
+        """
+        count = len(weights)
+        features, size = self._shape
+        # 得点・満点の重み行列を (特徴量, [得点/満点] x 体質タイプ x バリアント) に並べ、1回の行列積で計算する
+        score_weights = (weights @ self._score_basis).reshape(count, features, size)
+        max_weights = (weights @ self._max_basis).reshape(count, features, size)
+        stacked = np.concatenate([
+            score_weights.transpose(1, 2, 0).reshape(features, -1),
+            max_weights.transpose(1, 2, 0).reshape(features, -1)
+        ], axis=1)
+        products = self.answers @ stacked
+        primary_max = weights @ self._primary_basis
+
+        # DiagnosisEngine.score_batch と同じ計算を体質タイプごとに (件数 x バリアント) の配列で行い、
+        # 最高スコアとその位置・2番目のスコアを逐次更新する（同点は先の体質タイプを優先）
+        for column in range(size):
+            score = products[:, column * count:(column + 1) * count]
+            max_score = primary_max[:, column] + products[:, (size + column) * count:(size + column + 1) * count]
+            normalized = np.zeros_like(score)
+            np.divide(score, max_score, out=normalized, where=max_score > 0)
+            value = normalized * 100 + self.free_text_scores[:, column:column + 1]
+            if column == 0:
+                top, best_index, second = value, np.zeros(value.shape, dtype=np.int64), np.full(value.shape, -np.inf)
+            else:
+                greater = value > top
+                second = np.where(greater, top, np.maximum(second, value))
+                top = np.where(greater, value, top)
+                best_index = np.where(greater, column, best_index)
+
+        confidence = np.where(top > 0, np.minimum(95, 60 + (top - second) * 0.5), 75.0)
+        confidence = np.maximum(65, np.minimum(95, confidence))
+        best_index, confidence = best_index.T, confidence.T
+        return {"best_index": best_index, "confidence": confidence}
+
+    def distribution(self, best_index):
+        """体質タイプ別の割合"""
+        counts = np.bincount(best_index, minlength=len(self.constitution_types))
+        return counts / max(1, len(best_index))
+
+    def overrides(self, weights):
+        """基準から変更した重みだけを DiagnosisEngine(rules=...) 形式の辞書で返す"""
+        rules = {}
+        for (constitution_type, section, text, _, _), weight, base in zip(self.entries, weights, self.base_weights):
+            if weight != base:
+                rules.setdefault(constitution_type, {}).setdefault(section, {})[text] = int(weight)
+        return rules
+
+    def run(self, variants, block_size=None):
+        """バリアントごとの集計結果を順に返す"""
+        count = len(self.answers)
+        block_size = block_size or max(1, BLOCK_ELEMENTS // max(1, count * len(self.constitution_types)))
+        base_distribution = self.distribution(self.baseline["best_index"])
+        base_confidence = float(self.baseline["confidence"].mean()) if count else 0.0
+
+        for start in range(0, len(variants), block_size):
+            block = variants[start:start + block_size]
+            result = self.evaluate(block)
+            for offset, weights in enumerate(block):
+                best_index = result["best_index"][offset]
+                distribution = self.distribution(best_index)
+                confidence = float(result["confidence"][offset].mean()) if count else 0.0
+                yield {
+                    "variant": start + offset,
+                    "overrides": self.overrides(weights),
+                    "changed_rate": float((best_index != self.baseline["best_index"]).mean()) if count else 0.0,
+                    "distribution": dict(zip(self.constitution_types, distribution.tolist())),
+                    "distribution_shift": dict(zip(self.constitution_types, (distribution - base_distribution).tolist())),
+                    "confidence_mean": confidence,
+                    "confidence_shift": confidence - base_confidence,
+                }
+
+
+def random_variants(base_weights, count, scale=1, fraction=1.0, seed=0):
+    """各重みに -scale..+scale の整数を加えたバリアント（fraction の割合の重みのみ変更、0 未満は 0）"""
+    rng = np.random.default_rng(seed)
+    deltas = rng.integers(-scale, scale + 1, size=(count, len(base_weights)))
+    if fraction < 1.0:
+        deltas *= rng.random((count, len(base_weights))) < fraction
+    return np.maximum(0, base_weights + deltas)
+
+
+def one_at_a_time_variants(base_weights, deltas):
+    """重みを1つずつ deltas の各値だけ変えたバリアント（一因子ずつの感度分析）"""
+    variants = []
+    for e in range(len(base_weights)):
+        for delta in deltas:
+            weights = base_weights.copy()
+            weights[e] = max(0, weights[e] + delta)
+            if weights[e] != base_weights[e]:
+                variants.append(weights)
+    return np.array(variants).reshape(-1, len(base_weights))
+
+
+def load_corpus(path=None, limit=None):
+    """回答コーパスを読み込む（path 省略時は diagnosis_results テーブルから）"""
+    responses_list = []
+    if path:
+        from bulk_score import iter_chunks, parse_chunk
+
+        for chunk in iter_chunks(path):
+            responses_list.extend(parse_chunk(chunk)[1])
+            if limit and len(responses_list) >= limit:
+                break
+    else:
+        from database import iter_diagnosis_chunks
+        from response_codec import decode_responses
+
+        for chunk in iter_diagnosis_chunks(["responses"]):
+            responses_list.extend(decode_responses(row.responses) or {} for row in chunk)
+            if limit and len(responses_list) >= limit:
+                break
+    return responses_list[:limit] if limit else responses_list
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="diagnosis_rules の重みの感度分析")
+    parser.add_argument("--input", help="回答コーパス（.jsonl / .parquet）。省略時は diagnosis_results から読み込む")
+    parser.add_argument("--limit", type=int, help="コーパスの最大件数")
+    parser.add_argument("--mode", choices=SWEEP_MODES, default="random")
+    parser.add_argument("--variants", type=int, default=1000, help="random モードのバリアント数")
+    parser.add_argument("--scale", type=int, default=1, help="random モードで各重みに加える最大の増減")
+    parser.add_argument("--fraction", type=float, default=1.0, help="random モードで変更する重みの割合")
+    parser.add_argument("--deltas", default="-2,-1,1,2", help="one-at-a-time モードの増減（カンマ区切り）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--block-size", type=int, help="一度に評価するバリアント数（既定はメモリ量から自動）")
+    parser.add_argument("--output", help="バリアントごとの結果を書き出す JSON Lines ファイル")
+    parser.add_argument("--top", type=int, default=10, help="表示する影響の大きいバリアント数")
+    args = parser.parse_args(argv)
+
+    engine = DiagnosisEngine(jitter="off", cache_size=0)
+    started = time.perf_counter()
+    corpus = load_corpus(args.input, args.limit)
+    sweep = WeightSweep(engine, corpus)
+    encoded = time.perf_counter()
+
+    if args.mode == "random":
+        variants = random_variants(sweep.base_weights, args.variants, args.scale, args.fraction, args.seed)
+    else:
+        deltas = [int(d) for d in args.deltas.split(",") if d.strip()]
+        variants = one_at_a_time_variants(sweep.base_weights, deltas)
+
+    out = open(args.output, "w", encoding="utf-8") if args.output else None
+    results = []
+    try:
+        for result in sweep.run(variants, args.block_size):
+            if out:
+                out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            results.append({key: result[key] for key in ("variant", "changed_rate", "confidence_shift", "overrides")})
+    finally:
+        if out:
+            out.close()
+    finished = time.perf_counter()
+
+    base_distribution = sweep.distribution(sweep.baseline["best_index"])
+    print(f"corpus: {len(corpus)} responses (encoded in {encoded - started:.2f}s)", file=sys.stderr)
+    print(f"variants: {len(variants)} evaluated in {finished - encoded:.2f}s "
+          f"({len(variants) / max(finished - encoded, 1e-9):.0f} variants/s)", file=sys.stderr)
+    print("baseline: " + ", ".join(
+        f"{c} {share:.1%}" for c, share in zip(sweep.constitution_types, base_distribution)
+    ) + f"; confidence {sweep.baseline['confidence'].mean():.1f}")
+    print("most sensitive variants (changed constitution_type):")
+    for result in sorted(results, key=lambda r: r["changed_rate"], reverse=True)[:args.top]:
+        changed = sum(len(weights) for sections in result["overrides"].values() for weights in sections.values())
+        detail = json.dumps(result["overrides"], ensure_ascii=False) if changed <= 3 else f"({changed} weights changed)"
+        print(f"  #{result['variant']:<6} {result['changed_rate']:6.1%} changed, "
+              f"confidence {result['confidence_shift']:+.2f}  {detail}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,404 @@
+"""診断結果の非同期書き込みキュー（write-behind）
+
+診断結果は上限付きのキューに登録するだけで即座に返り、バックグラウンドのワーカースレッドが
+一定件数または一定時間ごとにまとめて INSERT する。データベースに接続できない場合は
+ローカルのスピルファイル（JSON Lines）に退避し、次に書き込みが成功した時点で再投入する。
+スピルファイルは複数のプロセス（scoring_service.py --workers）で共有するため、追記と取り出しは
+ロックファイル（<スピルファイル>.lock）の flock で排他する。
+プロセス終了時にはキューに残った結果を書き出してから終了する。
+
+接続エラー以外の理由（値が長すぎるなど）でまとめた保存が失敗した場合は1行ずつ保存し直し、
+それでも保存できない行は <スピルファイル>.rejected に移す。スピルファイルの読み取れない行は
+<スピルファイル>.corrupt に移す。どちらも後続の結果の保存を止めないための隔離で、内容を確認して
+修正した行はスピルファイルに追記すれば再投入される。
+
+database モジュール（SQLAlchemy）は最初の登録時に読み込むため、アプリの起動時には読み込まれない。
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows ではプロセス内の排他のみ
+    fcntl = None
+
+from instrumentation import span
+
+logger = logging.getLogger(__name__)
+
+# 書き込みキューの設定（環境変数で調整可能）
+WRITE_BATCH_SIZE = int(os.getenv('DIAGNOSIS_WRITE_BATCH_SIZE', '100'))
+WRITE_FLUSH_MS = int(os.getenv('DIAGNOSIS_WRITE_FLUSH_MS', '500'))
+WRITE_QUEUE_SIZE = int(os.getenv('DIAGNOSIS_WRITE_QUEUE_SIZE', '10000'))
+SPILL_PATH = os.getenv('DIAGNOSIS_SPILL_PATH', os.path.join('data', 'pending_diagnoses.jsonl'))
+SPILL_RETRY_SECONDS = 30
+
+_STOP = object()
+
+# 時間を置けば保存できる見込みがある（行の内容によらない）データベースのエラー
+_TRANSIENT_ERROR_NAMES = ('OperationalError', 'InterfaceError', 'DisconnectionError')
+
+
+def _is_transient(error):
+    """接続できない・タイムアウトなど、行の内容ではなく接続先の状態による失敗か"""
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    # SQLAlchemy の例外は名前で判定する（このモジュールの読み込み時に SQLAlchemy を読み込まないため）
+    names = {cls.__name__ for cls in type(error).__mro__}
+    if getattr(error, 'connection_invalidated', False) or names.intersection(_TRANSIENT_ERROR_NAMES):
+        return True
+    # プールの取得待ちのタイムアウト（sqlalchemy.exc.TimeoutError）
+    return 'TimeoutError' in names and type(error).__module__.startswith('sqlalchemy')
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+def _encode_row(row):
+    """スピルファイル用に datetime を ISO 形式へ変換"""
+    return {k: v.isoformat() if isinstance(v, datetime) else v for k, v in row.items()}
+
+
+def _decode_row(row):
+    if not isinstance(row, dict):
+        raise ValueError("spilled row is not a JSON object")
+    if row.get('timestamp'):
+        row['timestamp'] = datetime.fromisoformat(row['timestamp'])
+    # ルールのバージョンを記録する前に退避された行
+    row.setdefault('rule_version', None)
+    return row
+
+
+class DiagnosisWriter:
+    """診断結果をまとめて保存するバックグラウンドライター"""
+
+    def __init__(self, save_rows=None, batch_size=WRITE_BATCH_SIZE,
+                 flush_interval=WRITE_FLUSH_MS / 1000, max_queue=WRITE_QUEUE_SIZE,
+                 spill_path=SPILL_PATH):
+        self._save_rows = save_rows
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._spill_lock = threading.Lock()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.written = 0
+        self.batches = 0
+        self.spilled = 0
+        self.failures = 0
+        self.rejected = 0
+
+    def start(self):
+        """ワーカースレッドを起動（起動済みなら何もしない）"""
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="diagnosis-writer", daemon=True)
+                self._thread.start()
+
+    def save_rows(self, rows):
+        """まとめて保存（既定は database.save_diagnosis_rows）"""
+        if self._save_rows is None:
+            from database import save_diagnosis_rows
+            self._save_rows = save_diagnosis_rows
+        return self._save_rows(rows)
+
+    def submit(self, user_data, diagnosis_result, responses):
+        """診断結果を書き込みキューに登録（キューが満杯の場合はスピルファイルへ退避）"""
+        from database import build_diagnosis_row
+
+        row = build_diagnosis_row(user_data, diagnosis_result, responses)
+        self.start()
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self._spill([row])
+
+    def flush(self):
+        """キューに登録済みの結果がすべて処理されるまで待つ"""
+        self._queue.join()
+
+    def close(self, timeout=10):
+        """残りの結果を書き出してワーカーを停止"""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            # 書き込みが追いつかないまま終了する場合は、キューの残りをスピルファイルに退避する
+            pending = self._drain()
+            logger.warning("Diagnosis writer queue is full at shutdown; spilling %d results", len(pending))
+            self._spill(pending)
+            try:
+                self._queue.put_nowait(_STOP)
+            except queue.Full:
+                logger.warning("Diagnosis writer queue refilled during shutdown; not waiting for the worker")
+                return
+        self._thread.join(timeout)
+
+    def _drain(self):
+        """キューに残っている結果をすべて取り出す"""
+        rows = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return rows
+            if item is not _STOP:
+                rows.append(item)
+            self._queue.task_done()
+
+    def stats(self):
+        """書き込み件数・バッチ数・退避件数・キュー滞留数"""
+        return {
+            'written': self.written,
+            'batches': self.batches,
+            'spilled': self.spilled,
+            'failures': self.failures,
+            'rejected': self.rejected,
+            'queued': self._queue.qsize()
+        }
+
+    def _warm_up(self):
+        """database モジュールの読み込みと接続の準備をワーカースレッドで先に済ませる"""
+        if self._save_rows is not None:
+            return
+        try:
+            from database import get_db_engine
+            get_db_engine()
+        except Exception:
+            logger.exception("Diagnosis writer failed to prepare the database connection")
+
+    def _run(self):
+        self._warm_up()
+        self._recover_replays()
+        self._safe_replay()
+        stopping = False
+        while not stopping:
+            try:
+                item = self._queue.get(timeout=SPILL_RETRY_SECONDS)
+            except queue.Empty:
+                self._safe_replay()
+                continue
+
+            # 最初の1件から flush_interval 以内に届いた分を batch_size 件までまとめる
+            batch = []
+            taken = 1
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is _STOP:
+                    stopping = True
+                else:
+                    batch.append(item)
+                if stopping or len(batch) >= self.batch_size:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                    taken += 1
+                except queue.Empty:
+                    break
+
+            if stopping:
+                # 停止時はキューに残っている結果もすべて書き出す
+                while True:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    taken += 1
+                    if item is not _STOP:
+                        batch.append(item)
+
+            try:
+                self._write(batch)
+            except Exception:
+                logger.exception("Diagnosis writer failed to persist %d results", len(batch))
+            finally:
+                for _ in range(taken):
+                    self._queue.task_done()
+
+    def _write(self, batch):
+        succeeded = False
+        for start in range(0, len(batch), self.batch_size):
+            chunk = batch[start:start + self.batch_size]
+            pending = self._save(chunk)
+            if pending:
+                self.failures += 1
+                logger.warning("Spilling %d diagnosis results to %s", len(pending), self.spill_path)
+                self._spill(pending)
+            else:
+                succeeded = True
+        # データベースが復旧したら退避分も再投入する
+        if succeeded and os.path.exists(self.spill_path):
+            self._replay_spill()
+
+    def _save(self, rows):
+        """rows を保存し、接続先の障害で保存できなかった行（あとで再試行する行）を返す
+
+        行の内容による失敗は1行ずつ保存し直し、それでも保存できない行は .rejected ファイルに移す。
+        """
+        try:
+            with span("writer.save_batch", rows=len(rows)):
+                self.save_rows(rows)
+        except Exception as e:
+            if _is_transient(e):
+                logger.exception("Database unavailable; could not save %d diagnosis results", len(rows))
+                return rows
+            logger.warning("Saving %d diagnosis results failed (%s); retrying row by row", len(rows), e)
+        else:
+            self.written += len(rows)
+            self.batches += 1
+            return []
+
+        rejected = []
+        for n, row in enumerate(rows):
+            try:
+                self.save_rows([row])
+            except Exception as e:
+                if _is_transient(e):
+                    logger.exception("Database unavailable; could not save %d diagnosis results", len(rows) - n)
+                    self._reject(rejected)
+                    return rows[n:]
+                logger.error("Rejecting a diagnosis result that cannot be saved: %s", e)
+                rejected.append(row)
+                continue
+            self.written += 1
+            self.batches += 1
+        self._reject(rejected)
+        return []
+
+    def _reject(self, rows):
+        """保存できない行を .rejected ファイルに移す（スピルファイルには戻さない）"""
+        if not rows:
+            return
+        with self._locked_spill():
+            self._append_lines(f"{self.spill_path}.rejected",
+                               (json.dumps(_encode_row(row), ensure_ascii=False) for row in rows))
+            self.rejected += len(rows)
+
+    @contextmanager
+    def _locked_spill(self):
+        """スピルファイルを排他（スレッド間は _spill_lock、プロセス間はロックファイルの flock）"""
+        with self._spill_lock:
+            directory = os.path.dirname(self.spill_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            if fcntl is None:
+                yield
+                return
+            with open(f"{self.spill_path}.lock", 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                yield
+
+    def _spill(self, rows):
+        """保存できなかった結果をスピルファイルに追記"""
+        with self._locked_spill():
+            self._append_spill(rows)
+            self.spilled += len(rows)
+
+    def _append_spill(self, rows):
+        """スピルファイルに追記（_locked_spill() の中で呼ぶ）"""
+        self._append_lines(self.spill_path, (json.dumps(_encode_row(row), ensure_ascii=False) for row in rows))
+
+    @staticmethod
+    def _append_lines(path, lines):
+        with open(path, 'a', encoding='utf-8') as f:
+            for line in lines:
+                f.write(line.rstrip('\n') + '\n')
+
+    def _safe_replay(self):
+        """スピルファイルの再投入（失敗してもワーカースレッドを止めない）"""
+        try:
+            self._replay_spill()
+        except Exception:
+            logger.exception("Failed to replay spilled diagnosis results from %s", self.spill_path)
+
+    def _recover_replays(self):
+        """再投入の途中で終了したプロセスの取り出し済みファイル（<スピルファイル>.<pid>.replay）をスピルファイルに戻す
+
+        再投入済みのチャンクも戻るため、その分は重複して保存されうる（失うよりも重複を許容する）。
+        """
+        directory = os.path.dirname(self.spill_path) or '.'
+        prefix = os.path.basename(self.spill_path) + '.'
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return
+        for name in names:
+            pid = name[len(prefix):-len('.replay')] if name.startswith(prefix) and name.endswith('.replay') else ''
+            if not pid.isdigit() or (int(pid) != os.getpid() and _pid_alive(int(pid))):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                with self._locked_spill():
+                    with open(path, encoding='utf-8', errors='replace') as f:
+                        self._append_lines(self.spill_path, (line for line in f if line.strip()))
+                    os.remove(path)
+                logger.warning("Recovered spilled diagnosis results left in %s", path)
+            except OSError:
+                logger.exception("Failed to recover spilled diagnosis results from %s", path)
+
+    def _replay_spill(self):
+        """スピルファイルに退避した結果をデータベースへ再投入"""
+        replay_path = f"{self.spill_path}.{os.getpid()}.replay"
+        # 他のプロセスの追記中に取り出すと、取り出したファイルへの追記が失われるため排他する
+        with self._locked_spill():
+            if not os.path.exists(self.spill_path):
+                return
+            os.replace(self.spill_path, replay_path)
+
+        rows, corrupt = [], []
+        with open(replay_path, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    rows.append(_decode_row(json.loads(line)))
+                except (ValueError, TypeError):
+                    corrupt.append(line)
+        if corrupt:
+            logger.error("Moving %d unreadable spilled lines to %s.corrupt", len(corrupt), self.spill_path)
+            with self._locked_spill():
+                self._append_lines(f"{self.spill_path}.corrupt", corrupt)
+
+        for start in range(0, len(rows), self.batch_size):
+            pending = self._save(rows[start:start + self.batch_size])
+            if pending:
+                remaining = pending + rows[start + self.batch_size:]
+                logger.warning("Database still unavailable; keeping %d spilled results", len(remaining))
+                with self._locked_spill():
+                    self._append_spill(remaining)
+                break
+        os.remove(replay_path)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """プロセス全体で共有する書き込みキューを取得（終了時に自動で書き出す）"""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = DiagnosisWriter()
+                atexit.register(_writer.close)
+    return _writer